@@ -279,7 +279,7 @@ def onUpVoted(vote, post, user, timestamp=None):
             )
             author.save()
 
-            question = post.thread._question_post() # TODO: this is suboptimal if post is already a question
+            question = post.get_origin_post()
 
             reputation = Repute(user=author,
                        positive=askbot_settings.REP_GAIN_FOR_RECEIVING_UPVOTE,
@@ -314,7 +314,7 @@ def onUpVotedCanceled(vote, post, user, timestamp=None):
         )
         author.save()
 
-        question = post.thread._question_post() # TODO: this is suboptimal if post is already a question
+        question = post.get_origin_post()
 
         reputation = Repute(
             user=author,
@@ -343,7 +343,7 @@ def onDownVoted(vote, post, user, timestamp=None):
         )
         author.save()
 
-        question = post.thread._question_post() # TODO: this is suboptimal if post is already a question
+        question = post.get_origin_post()
 
         reputation = Repute(user=author,
                    negative=askbot_settings.REP_LOSS_FOR_RECEIVING_DOWNVOTE,
@@ -385,7 +385,7 @@ def onDownVotedCanceled(vote, post, user, timestamp=None):
         )
         author.save()
 
-        question = post.thread._question_post() # TODO: this is suboptimal if post is already a question
+        question = post.get_origin_post()
 
         reputation = Repute(user=author,
                 positive=\
@@ -230,3 +230,22 @@ settings.register(
         description = _('Enthusiast: minimum days')
     )
 )
+
+settings.register(
+    IntegerValue(
+        BADGES,
+        'BADGE_EVALUATION_DELAY',
+        default = 60,
+        description = _(
+            'Evaluate badges in batches every this many seconds'
+        ),
+        help_text = _(
+            'Badges are checked after the request by a celery task, '
+            'the command evaluate_badges should also run periodically '
+            'from cron to check badges queued when a task was lost. '
+            'Use 0 to check badges right away. '
+            'Without celery workers (CELERY_ALWAYS_EAGER = True) '
+            'badges are always checked right away.'
+        )
+    )
+)
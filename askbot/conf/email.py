@@ -48,6 +48,19 @@ settings.register(
     )
 )
 
+settings.register(
+    livesettings.IntegerValue(
+        EMAIL,
+        'EMAIL_BATCH_SIZE',
+        default=100,
+        description=_('Number of emails sent through one connection'),
+        help_text=_(
+            'Email alerts to many recipients are sent in batches, '
+            'each batch through one connection to the mail server'
+        )
+    )
+)
+
 settings.register(
     livesettings.StringValue(
         EMAIL,
@@ -380,6 +380,76 @@ settings.register(
     )
 )
 
+settings.register(
+    livesettings.IntegerValue(
+        FORUM_DATA_RULES,
+        'QUESTION_COUNT_CACHE_TIMEOUT',
+        default=300,
+        description=_(
+            'Cache the number of questions in the listings '
+            'for this many seconds'
+        ),
+        help_text=_(
+            'The count is shown in the paginator and the question '
+            'counter, it may be slightly off during this time. '
+            'Use 0 to always count questions exactly, '
+            'this may be slow on large sites.'
+        )
+    )
+)
+
+settings.register(
+    livesettings.IntegerValue(
+        FORUM_DATA_RULES,
+        'VIEW_COUNT_FLUSH_INTERVAL',
+        default=60,
+        description=_(
+            'Save question view counts to the database '
+            'every this many seconds'
+        ),
+        help_text=_(
+            'Views are counted in the cache and saved in batches, '
+            'run command flush_view_counts to save them right away. '
+            'Use 0 to save every view immediately.'
+        )
+    )
+)
+
+settings.register(
+    livesettings.IntegerValue(
+        FORUM_DATA_RULES,
+        'LAST_SEEN_UPDATE_INTERVAL',
+        default=300,
+        description=_(
+            'Save time when users were last seen '
+            'every this many seconds'
+        ),
+        help_text=_(
+            'Use 0 to save the time on every page view.'
+        )
+    )
+)
+
+settings.register(
+    livesettings.IntegerValue(
+        FORUM_DATA_RULES,
+        'QUESTION_VISIT_FLUSH_INTERVAL',
+        default=60,
+        description=_(
+            'Save visits of the questions by the users '
+            'every this many seconds'
+        ),
+        help_text=_(
+            'Notifications about the responses in the visited questions '
+            'are cleared when the visits are saved. The visits are saved '
+            'by a delayed celery task, without the celery workers '
+            '(CELERY_ALWAYS_EAGER = True) - on every visit. '
+            'Command flush_question_visits saves them right away. '
+            'Use 0 to save every visit immediately.'
+        )
+    )
+)
+
 settings.register(
     livesettings.StringValue(
         FORUM_DATA_RULES,
@@ -99,6 +99,36 @@ def clean_html_email(email_body):
     )
     return '\n\n'.join(phrases)
 
+def make_message(
+            subject_line = None,
+            body_text = None,
+            from_email = django_settings.DEFAULT_FROM_EMAIL,
+            recipient_list = None,
+            headers = None,
+            plain_text = None
+        ):
+    """returns email message with the html body
+    and the plain text alternative, for sending
+    with :func:`send_mass_mail`
+
+    ``plain_text`` - the text alternative, if it is already
+    prepared, then ``body_text`` must have absolute urls
+    """
+    if plain_text is None:
+        body_text = absolutize_urls(body_text)
+        plain_text = clean_html_email(body_text)
+    assert(subject_line is not None)
+    subject_line = prefix_the_subject_line(subject_line)
+    msg = mail.EmailMultiAlternatives(
+                    subject_line,
+                    plain_text,
+                    from_email,
+                    recipient_list,
+                    headers = headers
+                )
+    msg.attach_alternative(body_text, "text/html")
+    return msg
+
 def send_mail(
             subject_line = None,
             body_text = None,
@@ -122,18 +152,14 @@ def send_mail(
 
     if raise_on_failure is True, exceptions.EmailNotSent is raised
     """
-    body_text = absolutize_urls(body_text)
     try:
-        assert(subject_line is not None)
-        subject_line = prefix_the_subject_line(subject_line)
-        msg = mail.EmailMultiAlternatives(
-                        subject_line,
-                        clean_html_email(body_text),
-                        from_email,
-                        recipient_list,
-                        headers = headers
-                    )
-        msg.attach_alternative(body_text, "text/html")
+        msg = make_message(
+                    subject_line = subject_line,
+                    body_text = body_text,
+                    from_email = from_email,
+                    recipient_list = recipient_list,
+                    headers = headers
+                )
         msg.send()
         logging.debug('sent update to %s' % ','.join(recipient_list))
         if related_object is not None:
@@ -143,6 +169,52 @@ def send_mail(
         if raise_on_failure == True:
             raise exceptions.EmailNotSent(unicode(error))
 
+def send_mass_mail(messages, batch_size = None):
+    """sends messages made with :func:`make_message`,
+    one connection to the mail server is used
+    for each ``batch_size`` messages (by default - ``EMAIL_BATCH_SIZE``)
+
+    failure to send a message does not stop sending the others,
+    returns list with ``True`` for each sent message
+    and ``False`` for each failed one
+    """
+    if batch_size is None:
+        batch_size = askbot_settings.EMAIL_BATCH_SIZE
+    batch_size = max(batch_size, 1)
+
+    results = list()
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        connection = mail.get_connection()
+        try:
+            connection.open()
+        except Exception, error:
+            sys.stderr.write('\n' + unicode(error).encode('utf-8') + '\n')
+            results.extend([False] * len(batch))
+            continue
+
+        try:
+            for msg in batch:
+                try:
+                    connection.send_messages([msg])
+                except Exception, error:
+                    sys.stderr.write('\n' + unicode(error).encode('utf-8') + '\n')
+                    results.append(False)
+                    #the connection may be broken by the error,
+                    #if it can't be reopened here, the next message
+                    #will report the error
+                    try:
+                        connection.close()
+                        connection.open()
+                    except Exception:
+                        pass
+                else:
+                    logging.debug('sent update to %s' % ','.join(msg.to))
+                    results.append(True)
+        finally:
+            connection.close()
+    return results
+
 def mail_moderators(
             subject_line = '',
             body_text = '',
@@ -49,6 +49,8 @@ class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
         make_option('--noinput', action='store_false', dest='interactive', default=True,
             help='Do not prompt the user for input of any kind.'),
+        make_option('--scale', action='store', type='int', dest='scale', default=1,
+            help='Multiply the number of users, questions, answers and comments'),
     )
 
     def save_alert_settings(self):
@@ -89,7 +91,7 @@ class Command(NoArgsCommand):
 
         # Keeping the created users in array - we will iterate over them
         # several times, we don't want querying the model each and every time.
-        for i in range(NUM_USERS):
+        for i in range(self.num_users):
             s_idx = str(i)
             user = User.objects.create_user(USERNAME_TEMPLATE % s_idx,
                                             EMAIL_TEMPLATE % s_idx)
@@ -110,7 +112,7 @@ class Command(NoArgsCommand):
         active_question = None
         last_vote = False
         # Each user posts a question
-        for i in range(NUM_QUESTIONS):
+        for i in range(self.num_questions):
             user = users[i]
             # Downvote/upvote the questions - It's reproducible, yet
             # gives good randomized data
@@ -129,7 +131,7 @@ class Command(NoArgsCommand):
 
             # len(TAGS_TEMPLATE) tags per question - each tag is different
             tags = " ".join([t%user.id for t in TAGS_TEMPLATE])
-            if i < NUM_QUESTIONS/2:
+            if i < self.num_questions/2:
                 tags += ' one-tag'
 
             if i % 2 == 0:
@@ -154,7 +156,7 @@ class Command(NoArgsCommand):
         active_answer = None
         last_vote = False
         # Now, fill the last added question with answers
-        for user in users[:NUM_ANSWERS]:
+        for user in users[:self.num_answers]:
             # We don't need to test for data validation, so ONLY users
             # that aren't authors can post answer to the question
             if not active_question.author is user:
@@ -203,7 +205,7 @@ class Command(NoArgsCommand):
         active_question_comment = None
         active_answer_comment = None
 
-        for user in users[:NUM_COMMENTS]:
+        for user in users[:self.num_comments]:
             active_question_comment = user.post_comment(
                                     parent_post = active_question,
                                     body_text = COMMENT_TEMPLATE
@@ -220,7 +222,7 @@ class Command(NoArgsCommand):
 
         # Upvote active comments
         if active_question_comment and active_answer_comment:
-            num_upvotees = NUM_COMMENTS - 1
+            num_upvotees = self.num_comments - 1
             for user in users[:num_upvotees]:
                 user.upvote(active_question_comment)
                 user.upvote(active_answer_comment)
@@ -231,6 +233,11 @@ class Command(NoArgsCommand):
     def handle_noargs(self, **options):
         self.verbosity = int(options.get("verbosity", 1))
         self.interactive = options.get("interactive")
+        scale = int(options.get("scale") or 1)
+        self.num_users = NUM_USERS * scale
+        self.num_questions = NUM_QUESTIONS * scale
+        self.num_answers = NUM_ANSWERS * scale
+        self.num_comments = NUM_COMMENTS * scale
 
         if self.interactive:
             answer = choice_dialog("This command will DELETE ALL DATA in the current database, and will fill the database with test data. Are you absolutely sure you want to proceed?",
@@ -0,0 +1,84 @@
+"""benchmark of the conversion of the post texts to html
+over the posts stored in the database
+
+python manage.py benchmark_markdown --posts=500 --repeat=3
+"""
+import time
+from optparse import make_option
+import html5lib
+from html5lib import serializer, treebuilders, treewalkers
+from django.core.management.base import NoArgsCommand
+from askbot.models import Post
+from askbot.utils import markup
+from askbot.utils.html import HTMLSanitizer, sanitize_html
+
+def sanitize_html_with_dom(html):
+    """the previous implementation of the sanitizer,
+    which builds the document tree"""
+    p = html5lib.HTMLParser(tokenizer=HTMLSanitizer,
+                            tree=treebuilders.getTreeBuilder("dom"))
+    dom_tree = p.parseFragment(html)
+    walker = treewalkers.getTreeWalker("dom")
+    stream = walker(dom_tree)
+    s = serializer.HTMLSerializer(omit_optional_tags=False,
+                                  quote_attr_values=True)
+    return u''.join(s.serialize(stream))
+
+def render_with_new_parser(text):
+    """the previous pipeline - parser made for each post"""
+    return sanitize_html_with_dom(markup.make_parser().convert(text))
+
+def render_with_cached_parser(text):
+    return sanitize_html(markup.get_parser().convert(text))
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--posts',
+            action = 'store',
+            type = 'int',
+            dest = 'posts',
+            default = 500,
+            help = 'number of the latest posts to render'
+        ),
+        make_option('--repeat',
+            action = 'store',
+            type = 'int',
+            dest = 'repeat',
+            default = 3,
+            help = 'number of the timed renderings of the posts'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        texts = list(
+            Post.objects.filter(
+                post_type__in = ('question', 'answer')
+            ).order_by('-id').values_list('text', flat = True)[:options['posts']]
+        )
+        if len(texts) == 0:
+            print 'no posts to render'
+            return
+
+        differences = 0
+        for text in texts:
+            if render_with_new_parser(text) != render_with_cached_parser(text):
+                differences += 1
+
+        candidates = (
+            ('new parser, dom sanitizer', render_with_new_parser),
+            ('cached parser, streaming', render_with_cached_parser),
+        )
+        for name, function in candidates:
+            timings = list()
+            for attempt in range(options['repeat']):
+                start = time.time()
+                for text in texts:
+                    function(text)
+                timings.append(time.time() - start)
+            print '%-26s %8.2f milliseconds per post' % (
+                                    name, min(timings) * 1000 / len(texts)
+                                )
+        print '%d posts rendered, %d with differently nested html' % (
+                                                len(texts), differences
+                                            )
@@ -0,0 +1,94 @@
+"""measures number of queries, sql time and wall time
+of the main pages on a generated forum in a separate test database,
+saves the report in json format and compares the query counts
+with the thresholds
+
+python manage.py benchmark_page_loads --scale=3 --output=report.json
+"""
+from optparse import make_option
+from django.core import cache
+from django.core import management
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import CommandError, NoArgsCommand
+from django.conf import settings as django_settings
+from django.db import connection
+from askbot.utils import page_benchmark
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--scale',
+            action = 'store',
+            type = 'int',
+            dest = 'scale',
+            default = 1,
+            help = 'size of the generated forum, see askbot_add_test_content'
+        ),
+        make_option('--thousand-tags',
+            action = 'store_true',
+            dest = 'thousand_tags',
+            default = False,
+            help = 'add a thousand tags to the generated forum'
+        ),
+        make_option('--output',
+            action = 'store',
+            type = 'str',
+            dest = 'output',
+            default = 'page_load_report.json',
+            help = 'file name of the json report'
+        ),
+        make_option('--thresholds',
+            action = 'store',
+            type = 'str',
+            dest = 'thresholds',
+            default = page_benchmark.DEFAULT_THRESHOLDS_PATH,
+            help = 'json file with the maximum query counts'
+        ),
+        make_option('--save-thresholds',
+            action = 'store_true',
+            dest = 'save_thresholds',
+            default = False,
+            help = 'save current query counts as the thresholds'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        #the test database is created with the current model schema
+        if 'south' in django_settings.INSTALLED_APPS:
+            from south.management.commands import patch_for_test_db_setup
+            patch_for_test_db_setup()
+
+        old_cache = cache.cache
+        cache.cache = LocMemCache('page-benchmark', {})
+        old_database_name = connection.creation.create_test_db(
+                                                verbosity=0, autoclobber=True
+                                            )
+        try:
+            management.call_command(
+                'askbot_add_test_content',
+                verbosity=0,
+                interactive=False,
+                scale=options['scale']
+            )
+            if options['thousand_tags']:
+                management.call_command('create_thousand_tags')
+            report = page_benchmark.run_benchmark()
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            cache.cache = old_cache
+
+        page_benchmark.save_json(report, options['output'])
+        print page_benchmark.format_report(report)
+
+        thresholds_path = options['thresholds']
+        if options['save_thresholds']:
+            thresholds = page_benchmark.make_thresholds(report)
+            page_benchmark.save_json(thresholds, thresholds_path)
+            print 'saved thresholds to %s' % thresholds_path
+            return
+
+        thresholds = page_benchmark.load_json(thresholds_path)
+        errors = page_benchmark.check_thresholds(report, thresholds)
+        if errors:
+            raise CommandError(
+                'query count regressions:\n' + '\n'.join(errors)
+            )
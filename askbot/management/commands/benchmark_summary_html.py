@@ -0,0 +1,79 @@
+"""microbenchmark of filling the tag urls into
+the cached question summary snippets on the main page
+
+python manage.py benchmark_summary_html --tags=5 --repeat=2000
+"""
+import re
+import timeit
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from askbot import const
+from askbot.models import question
+from askbot.search.state_manager import SearchState
+
+SNIPPET_TEMPLATE = """<div class="short-summary">
+    <div class="counts">%(counts)s</div>
+    <h2><a href="/question/1/some-title/">Some title</a></h2>
+    <ul class="tags">%(tags)s</ul>
+</div>"""
+
+def make_snippet(tag_count):
+    """returns snippet similar to widgets/question_summary.html"""
+    counts = '<span class="item-count">1</span>' * 30
+    tags = ''.join(
+        ['<li><a href="<<<tag-%d>>>">tag-%d</a></li>' % (i, i) for i in range(tag_count)]
+    )
+    return SNIPPET_TEMPLATE % {'counts': counts, 'tags': tags}
+
+def fill_tag_urls_by_regex(html, search_state):
+    """the previous implementation - a search and replace per tag,
+    each tag url made from a copy of the search state"""
+    regex = re.compile(r'<<<(%s)>>>' % const.TAG_REGEX_BARE, re.UNICODE)
+    while True:
+        match = regex.search(html)
+        if not match:
+            break
+        full_url = search_state.add_tag(match.group(1)).full_url()
+        html = html.replace(match.group(0), full_url)
+    return html
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--tags',
+            action = 'store',
+            type = 'int',
+            dest = 'tags',
+            default = 5,
+            help = 'number of tags in the snippet'
+        ),
+        make_option('--repeat',
+            action = 'store',
+            type = 'int',
+            dest = 'repeat',
+            default = 2000,
+            help = 'number of renderings to time'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        html = make_snippet(options['tags'])
+        repeat = options['repeat']
+        search_state = SearchState(
+                            scope='all', sort='activity-desc', query=None,
+                            tags='python,django', author=None, page=3,
+                            user_logged_in=False
+                        )
+        expected = fill_tag_urls_by_regex(html, search_state)
+        assert(question.fill_tag_urls(html, search_state) == expected)
+
+        candidates = (
+            ('regex search and replace', fill_tag_urls_by_regex),
+            ('single pass', question.fill_tag_urls),
+        )
+        for name, function in candidates:
+            timer = timeit.Timer(lambda: function(html, search_state))
+            seconds = min(timer.repeat(repeat=3, number=repeat))
+            print '%-26s %8.1f microseconds per summary' % (
+                                            name, seconds * 1000000 / repeat
+                                        )
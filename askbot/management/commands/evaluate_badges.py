@@ -0,0 +1,15 @@
+"""considers awards of the badges queued
+with ``BADGE_EVALUATION_DELAY`` > 0 and celery workers.
+The queue is evaluated by a celery task, but this command
+should also run periodically from cron, e.g. every hour,
+to evaluate the badges whose scheduled task was lost
+
+python manage.py evaluate_badges
+"""
+from django.core.management.base import NoArgsCommand
+from askbot.models.badges import evaluate_queued_badges
+
+class Command(NoArgsCommand):
+    def handle_noargs(self, **options):
+        count = evaluate_queued_badges()
+        print 'evaluated %d badges' % count
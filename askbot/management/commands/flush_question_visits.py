@@ -0,0 +1,14 @@
+"""saves visits of the questions by the users accumulated in the cache
+to the database, normally they are saved by a delayed celery task,
+the command may be run periodically, e.g. from cron,
+in case the task is lost
+
+python manage.py flush_question_visits
+"""
+from django.core.management.base import NoArgsCommand
+from askbot import models
+
+class Command(NoArgsCommand):
+    def handle_noargs(self, **options):
+        count = models.flush_question_visits()
+        print 'saved %d question visits' % count
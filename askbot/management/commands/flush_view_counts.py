@@ -0,0 +1,12 @@
+"""saves question view counts accumulated in the cache
+to the database, may be run periodically, e.g. from cron
+
+python manage.py flush_view_counts
+"""
+from django.core.management.base import NoArgsCommand
+from askbot import models
+
+class Command(NoArgsCommand):
+    def handle_noargs(self, **options):
+        count = models.Thread.objects.flush_view_counts()
+        print 'saved view counts of %d questions' % count
@@ -0,0 +1,45 @@
+"""awards badges to all users who deserve them, but don't have them yet,
+e.g. after the badge thresholds were changed or after an import,
+badges are computed with a few queries each and awarded in bulk
+
+python manage.py recompute_badges [--dry-run] [badge-key ...]
+
+without the badge keys all badges are recomputed
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from askbot.models.badges import BADGES
+
+class Command(BaseCommand):
+    args = '[badge-key ...]'
+    help = 'Awards badges to all users who deserve them'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action = 'store_true',
+            dest = 'dry_run',
+            default = False,
+            help = 'Only count the new awards, do not save them'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        keys = args or sorted(BADGES.keys())
+        for key in keys:
+            if key not in BADGES:
+                raise CommandError('unknown badge "%s"' % key)
+
+        for key in keys:
+            start = time.time()
+            count = self.recompute_badge(key, options['dry_run'])
+            if count is None:
+                print '%s: can not be recomputed' % key
+            else:
+                print '%s: %d new awards (%.2f s)' % (
+                                        key, count, time.time() - start
+                                    )
+
+    @transaction.commit_on_success
+    def recompute_badge(self, key, dry_run):
+        return BADGES[key]().recompute(dry_run = dry_run)
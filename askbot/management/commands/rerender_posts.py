@@ -0,0 +1,176 @@
+"""re-renders html of the posts from their source text,
+for example after the markdown settings have been changed,
+the mentions are linked again, but no notifications are sent
+
+python manage.py rerender_posts --post-type=question,answer --since=2013-01-01
+"""
+import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from askbot.conf import settings as askbot_settings
+from askbot.models import Post, Thread, User
+from askbot.models import update_values_by_id
+from askbot.models.post import render_post_text
+from askbot.utils.console import ProgressBar
+from askbot.utils.html import replace_links_with_text
+try:
+    import multiprocessing
+    DEFAULT_WORKERS = multiprocessing.cpu_count()
+except ImportError:#python < 2.6
+    multiprocessing = None
+    DEFAULT_WORKERS = 1
+
+POST_TYPES = ('question', 'answer', 'comment', 'tag_wiki', 'reject_reason')
+
+def render_post(post_type_and_text):
+    """renders the post in the worker process"""
+    return render_post_text(*post_type_and_text)
+
+def iterate_chunks(posts, chunk_size):
+    """yields lists of the posts, ordered by id"""
+    last_id = 0
+    while True:
+        chunk = posts.filter(id__gt = last_id).order_by('id')[:chunk_size]
+        chunk = list(chunk.iterator())
+        if len(chunk) == 0:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--post-type',
+            action = 'store',
+            type = 'str',
+            dest = 'post_types',
+            default = ','.join(POST_TYPES),
+            help = 'comma separated types of the posts to re-render'
+        ),
+        make_option('--since',
+            action = 'store',
+            type = 'str',
+            dest = 'since',
+            default = None,
+            help = 'only posts added or edited since the date, YYYY-MM-DD'
+        ),
+        make_option('--resume-from-id',
+            action = 'store',
+            type = 'int',
+            dest = 'resume_from_id',
+            default = None,
+            help = 'start with the post of given id'
+        ),
+        make_option('--workers',
+            action = 'store',
+            type = 'int',
+            dest = 'workers',
+            default = DEFAULT_WORKERS,
+            help = 'number of the rendering processes'
+        ),
+        make_option('--chunk-size',
+            action = 'store',
+            type = 'int',
+            dest = 'chunk_size',
+            default = 500,
+            help = 'number of the posts loaded and saved together'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        post_types = options['post_types'].split(',')
+        for post_type in post_types:
+            if post_type not in POST_TYPES:
+                raise CommandError(
+                    'unknown post type %s, use one of: %s' % (
+                                        post_type, ', '.join(POST_TYPES)
+                                    )
+                )
+
+        posts = Post.objects.filter(post_type__in = post_types).only(
+                            'id', 'post_type', 'text', 'html',
+                            'author', 'thread', 'parent'
+                        )
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--since must be a date as YYYY-MM-DD')
+            posts = posts.filter(Q(added_at__gte = since) | Q(last_edited_at__gte = since))
+        if options['resume_from_id']:
+            posts = posts.filter(id__gte = options['resume_from_id'])
+
+        chunk_size = options['chunk_size']
+        count = posts.count()
+        chunk_count = (count + chunk_size - 1) / chunk_size
+
+        pool = None
+        if options['workers'] > 1:
+            if multiprocessing is None:
+                raise CommandError('--workers above 1 require python 2.6 or later')
+            #the forked workers must open their own connections
+            connection.close()
+            pool = multiprocessing.Pool(options['workers'])
+
+        message = 'Re-rendering %d posts' % count
+        self.updated_count = 0
+        chunk = None
+        try:
+            chunks = iterate_chunks(posts, chunk_size)
+            for chunk in ProgressBar(chunks, chunk_count, message):
+                self.rerender_chunk(chunk, pool)
+        except KeyboardInterrupt:
+            if chunk:
+                print '\ninterrupted, continue with --resume-from-id=%d' % chunk[0].id
+            raise
+        finally:
+            if pool:
+                pool.terminate()
+
+        print '%d of %d posts updated' % (self.updated_count, count)
+
+    def rerender_chunk(self, posts, pool):
+        """renders the posts, with the workers if given
+        and saves the changed html with one update per column"""
+        jobs = [(post.post_type, post.text) for post in posts]
+        if pool:
+            rendered = pool.map(render_post, jobs)
+        else:
+            rendered = map(render_post, jobs)
+
+        author_ids = set([post.author_id for post in posts])
+        authors = User.objects.filter(id__in = author_ids).only(
+                            'id', 'reputation', 'status', 'is_superuser', 'is_staff'
+                        ).in_bulk(author_ids)
+
+        html_by_id = dict()
+        summary_by_id = dict()
+        thread_ids = set()
+        for post, html in zip(posts, rendered):
+            if '@' in html:
+                #mentions are linked, but the notifications are not sent
+                html = post.mentionize_html(html)[1]
+
+            #same as User.fix_html_links, without the message to the author
+            author = authors[post.author_id]
+            if not author.is_administrator_or_moderator() and \
+                author.reputation < askbot_settings.MIN_REP_TO_INSERT_LINK:
+                html = replace_links_with_text(html)
+
+            if html != post.html:
+                post.html = html
+                html_by_id[post.id] = html
+                summary_by_id[post.id] = post.get_snippet()
+                if post.thread_id:
+                    thread_ids.add(post.thread_id)
+
+        if html_by_id:
+            update_values_by_id(Post, 'html', html_by_id)
+            update_values_by_id(Post, 'summary', summary_by_id)
+            self.updated_count += len(html_by_id)
+
+        for thread in Thread.objects.filter(id__in = thread_ids):
+            thread.invalidate_cached_thread_content_fragment()
+            thread.invalidate_cached_post_data()
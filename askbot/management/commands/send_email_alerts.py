@@ -1,10 +1,21 @@
+from __future__ import with_statement
 import datetime
-from django.core.management.base import NoArgsCommand
+import os
+import tempfile
+import time
+from optparse import make_option
+from django.core.management.base import CommandError, NoArgsCommand
 from django.core.urlresolvers import reverse
 from django.db import connection
-from django.db.models import Q, F
-from askbot.models import User, Post, PostRevision, Thread
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import simplejson
+from askbot.models import User, Post, PostRevision, Thread, QuestionView
 from askbot.models import Activity, EmailFeedSetting
+from askbot.models.user import AuthUserGroups
+from askbot.models.base import bulk_create
+from askbot.models.post import PostToGroup
+from askbot.models.tag import get_user_tag_preferences
 from django.utils.translation import ugettext as _
 from django.utils.translation import ungettext
 from django.conf import settings as django_settings
@@ -12,21 +23,22 @@ from askbot.conf import settings as askbot_settings
 from django.utils.datastructures import SortedDict
 from django.contrib.contenttypes.models import ContentType
 from askbot import const
+from askbot import forms
 from askbot import mail
 from askbot.utils.slug import slugify
+try:
+    import multiprocessing
+except ImportError:#python < 2.6
+    multiprocessing = None
 
 DEBUG_THIS_COMMAND = False
 
-def get_all_origin_posts(mentions):
-    origin_posts = set()
-    for mention in mentions:
-        post = mention.content_object
-        origin_posts.add(post.get_origin_post())
-    return list(origin_posts)
+#number of users whose digests are built together
+USER_BATCH_SIZE = 500
 
 #todo: refactor this as class
 def extend_question_list(
-                    src, dst, cutoff_time = None, 
+                    src, dst, cutoff_time = None,
                     limit=False, add_mention=False,
                     add_comment = False
                 ):
@@ -73,421 +85,1060 @@ def format_action_count(string, number, output):
     if number > 0:
         output.append(_(string) % {'num':number})
 
-class Command(NoArgsCommand):
-    def handle_noargs(self, **options):
-        if askbot_settings.ENABLE_EMAIL_ALERTS:
-            try:
-                try:
-                    self.send_email_alerts()
-                except Exception, e:
-                    print e
-            finally:
-                connection.close()
+def group_values(rows, key_field, value_field):
+    """returns dictionary key -> list of values"""
+    groups = dict()
+    for row in rows:
+        groups.setdefault(row[key_field], list()).append(row[value_field])
+    return groups
 
-    def get_updated_questions_for_user(self, user):
-        """
-        retreive relevant question updates for the user
-        according to their subscriptions and recorded question
-        views
+QUESTION_FIELDS = (
+    'id', 'thread_id', 'author_id', 'added_at',
+    'thread__last_activity_at', 'thread__last_activity_by'
+)
+
+
+class DigestBuilder(object):
+    """Collects updated questions for the email digests.
+
+    Instead of running a dozen queries per user and per question,
+    the data about the questions, the question views, the followed
+    threads, answers, comments, mentions, revisions and the previous
+    emails is loaded for a batch of users with a few bulk queries,
+    and the digests are put together in memory.
+
+    The digest of each user is the same as used to be built
+    by the per-user query sets: questions that the user
+    has not seen since their last update, grouped by the
+    subscription type and limited by ``MAX_ALERTS_PER_EMAIL``.
+
+    Only the threads changed since the oldest cutoff time of the
+    due feeds are loaded, see :meth:`get_oldest_cutoff_time`.
+    """
+
+    def __init__(self):
+        self.max_alerts = askbot_settings.MAX_ALERTS_PER_EMAIL
+        self.groups_enabled = askbot_settings.GROUPS_ENABLED
+        self.post_content_type = ContentType.objects.get_for_model(Post)
+        self.thread_tags = None
+        self.oldest_cutoff_time = self.get_oldest_cutoff_time()
+
+        self.questions = dict()
+        self.question_order = list()
+        self.question_by_thread = dict()
+        self.questions_by_author = dict()
+        self.position = dict()
+        questions = self.get_candidate_questions().filter(
+                            thread__last_activity_at__gte=self.oldest_cutoff_time
+                        )
+        self.add_candidates(questions.values(*QUESTION_FIELDS))
+
+    def get_oldest_cutoff_time(self):
+        """returns the time since which the threads are considered
+        for the due periodic feeds: the earliest cutoff time of their
+        previous reports, or the join time of the subscribers who were
+        not reported to yet. Older threads were either reported by the
+        previous runs or had no news for the subscribers.
+
+        Mentions and comments are not marked as reported,
+        their questions are loaded separately.
         """
+        now = datetime.datetime.now()
+        cutoff_times = [now]
+        feeds = EmailFeedSetting.objects.exclude(feed_type='m_and_c')
+        for frequency, delta in EmailFeedSetting.DELTA_TABLE.items():
+            if frequency in ('n', 'i'):
+                continue
+            due_feeds = feeds.filter(
+                                frequency=frequency
+                            ).filter(
+                                Q(reported_at__isnull=True) \
+                                | Q(reported_at__lte=now - delta)
+                            )
+            reported_at = due_feeds.aggregate(
+                                    Min('reported_at')
+                                )['reported_at__min']
+            if reported_at:
+                cutoff_times.append(reported_at - delta)
+            date_joined = due_feeds.filter(
+                                    reported_at__isnull=True
+                                ).aggregate(
+                                    Min('subscriber__date_joined')
+                                )['subscriber__date_joined__min']
+            if date_joined:
+                cutoff_times.append(date_joined)
+        return min(cutoff_times)
 
-        user_feeds = EmailFeedSetting.objects.filter(
-                                                subscriber=user
+    def get_candidate_questions(self):
+        """returns query set of the questions
+        that may appear in the digests, before the per-user filtering"""
+        questions = Post.objects.get_questions().exclude(
+                                                deleted=True
                                             ).exclude(
-                                                frequency__in=('n', 'i')
+                                                thread__closed=True
                                             )
+        if askbot_settings.ENABLE_CONTENT_MODERATION:
+            questions = questions.filter(approved = True)
+        return questions.order_by('-thread__last_activity_at')
 
-        should_proceed = False
-        for feed in user_feeds:
-            if feed.should_send_now() == True:
-                should_proceed = True
-                break
+    def add_candidates(self, rows):
+        """adds the question rows to the candidates for the digests,
+        keeping them in the order of the last activity"""
+        new_thread_ids = list()
+        for row in rows:
+            question_id = row['id']
+            if question_id in self.position:
+                continue
+            self.questions[question_id] = row
+            self.position[question_id] = len(self.question_order)
+            self.question_order.append(question_id)
+            self.question_by_thread[row['thread_id']] = question_id
+            self.questions_by_author.setdefault(
+                                    row['author_id'], list()
+                                ).append(question_id)
+            new_thread_ids.append(row['thread_id'])
 
-        #shortcircuit - if there is no ripe feed to work on for this user
-        if should_proceed == False:
-            return {}
+        if new_thread_ids and len(self.question_order) > len(new_thread_ids):
+            #sort is stable, the earlier candidates stay first among the ties
+            self.question_order.sort(
+                key=lambda question_id: \
+                    self.questions[question_id]['thread__last_activity_at'],
+                reverse=True
+            )
+            self.position = dict(
+                [(question_id, n) for n, question_id in enumerate(self.question_order)]
+            )
+            if self.thread_tags is not None:
+                self.load_thread_tags(
+                        Thread.tags.through.objects.filter(thread__in=new_thread_ids)
+                    )
 
-        #these are placeholders for separate query sets per question group
-        #there are four groups - one for each EmailFeedSetting.feed_type
-        #and each group has subtypes A and B
-        #that's because of the strange thing commented below
-        #see note on Q and F objects marked with todo tag
-        q_sel_A = None
-        q_sel_B = None
-
-        q_ask_A = None
-        q_ask_B = None
-
-        q_ans_A = None
-        q_ans_B = None
-
-        q_all_A = None
-        q_all_B = None
-
-        #base question query set for this user
-        #basic things - not deleted, not closed, not too old
-        #not last edited by the same user
-        base_qs = Post.objects.get_questions().exclude(
-                                thread__last_activity_by=user
-                            ).exclude(
-                                thread__last_activity_at__lt=user.date_joined#exclude old stuff
-                            ).exclude(
-                                deleted=True
-                            ).exclude(
-                                thread__closed=True
-                            ).order_by('-thread__last_activity_at')
+    def load_thread_tags(self, thread_tags):
+        for thread_id, tag_id in thread_tags.values_list('thread', 'tag'):
+            self.thread_tags.setdefault(thread_id, set()).add(tag_id)
 
-        if askbot_settings.ENABLE_CONTENT_MODERATION:
-            base_qs = base_qs.filter(approved = True)
-        #todo: for some reason filter on did not work as expected ~Q(viewed__who=user) | 
-        #      Q(viewed__who=user,viewed__when__lt=F('thread__last_activity_at'))
-        #returns way more questions than you might think it should
-        #so because of that I've created separate query sets Q_set2 and Q_set3
-        #plus two separate queries run faster!
-
-        #build two two queries based
-
-        #questions that are not seen by the user at all
-        not_seen_qs = base_qs.filter(~Q(viewed__who=user))
-        #questions that were seen, but before last modification
-        seen_before_last_mod_qs = base_qs.filter(
-                                    Q(
-                                        viewed__who=user,
-                                        viewed__when__lt=F('thread__last_activity_at')
-                                    )
-                                )
+    def get_thread_tags(self):
+        """returns dictionary thread id -> set of tag ids
+        for the threads of the candidate questions"""
+        if self.thread_tags is None:
+            self.thread_tags = dict()
+            through = Thread.tags.through
+            self.load_thread_tags(
+                through.objects.filter(
+                    thread__last_activity_at__gte=self.oldest_cutoff_time
+                )
+            )
+            #candidates added by the mentions
+            thread_ids = [
+                thread_id for thread_id in self.question_by_thread
+                if thread_id not in self.thread_tags
+            ]
+            if thread_ids:
+                self.load_thread_tags(through.objects.filter(thread__in=thread_ids))
+        return self.thread_tags
 
-        #shorten variables for convenience
-        Q_set_A = not_seen_qs
-        Q_set_B = seen_before_last_mod_qs
+    def sort_questions(self, question_ids):
+        """returns questions in the order of the last activity"""
+        question_ids = [qid for qid in question_ids if qid in self.position]
+        return sorted(set(question_ids), key=self.position.get)
 
-        for feed in user_feeds:
-            if feed.feed_type == 'm_and_c':
-                #alerts on mentions and comments are processed separately
-                #because comments to questions do not trigger change of last_updated
-                #this may be changed in the future though, see
-                #http://askbot.org/en/question/96/
+    def get_due_feeds(self, users):
+        """marks the due feeds as reported, returns dictionary
+        user id -> dictionary feed type -> cutoff time
+        for the users who have at least one due feed"""
+        feeds = EmailFeedSetting.objects.filter(
+                                    subscriber__in=users
+                                ).exclude(
+                                    frequency__in=('n', 'i')
+                                )
+        due_feeds = dict()
+        reported_ids = list()
+        for feed in feeds:
+            if feed.should_send_now() == False:
                 continue
+            if feed.feed_type != 'm_and_c':
+                #alerts on mentions and comments are not marked
+                reported_ids.append(feed.id)
+            cutoff_time = feed.get_previous_report_cutoff_time()
+            due_feeds.setdefault(feed.subscriber_id, dict())[feed.feed_type] = cutoff_time
 
-            #each group of updates represented by the corresponding
-            #query set has it's own cutoff time
-            #that cutoff time is computed for each user individually
-            #and stored as a parameter "cutoff_time"
-
-            #we won't send email for a given question if an email has been
-            #sent after that cutoff_time
-            if feed.should_send_now():
-                if DEBUG_THIS_COMMAND == False:
-                    feed.mark_reported_now()
-                cutoff_time = feed.get_previous_report_cutoff_time() 
-
-                if feed.feed_type == 'q_sel':
-                    q_sel_A = Q_set_A.filter(thread__followed_by=user)
-                    q_sel_A.cutoff_time = cutoff_time #store cutoff time per query set
-                    q_sel_B = Q_set_B.filter(thread__followed_by=user)
-                    q_sel_B.cutoff_time = cutoff_time #store cutoff time per query set
-
-                elif feed.feed_type == 'q_ask':
-                    q_ask_A = Q_set_A.filter(author=user)
-                    q_ask_A.cutoff_time = cutoff_time
-                    q_ask_B = Q_set_B.filter(author=user)
-                    q_ask_B.cutoff_time = cutoff_time
-
-                elif feed.feed_type == 'q_ans':
-                    q_ans_A = Q_set_A.filter(thread__posts__author=user, thread__posts__post_type='answer')
-                    q_ans_A = q_ans_A[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_ans_A.cutoff_time = cutoff_time
-
-                    q_ans_B = Q_set_B.filter(thread__posts__author=user, thread__posts__post_type='answer')
-                    q_ans_B = q_ans_B[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_ans_B.cutoff_time = cutoff_time
-
-                elif feed.feed_type == 'q_all':
-                    q_all_A = user.get_tag_filtered_questions(Q_set_A)
-                    q_all_B = user.get_tag_filtered_questions(Q_set_B)
-
-                    q_all_A = q_all_A[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_all_B = q_all_B[:askbot_settings.MAX_ALERTS_PER_EMAIL]
-                    q_all_A.cutoff_time = cutoff_time
-                    q_all_B.cutoff_time = cutoff_time
-
-        #build ordered list questions for the email report
-        q_list = SortedDict()
+        if reported_ids and DEBUG_THIS_COMMAND == False:
+            EmailFeedSetting.objects.filter(
+                                id__in=reported_ids
+                            ).update(
+                                reported_at=datetime.datetime.now()
+                            )
+        return due_feeds
 
-        #todo: refactor q_list into a separate class?
-        extend_question_list(q_sel_A, q_list)
-        extend_question_list(q_sel_B, q_list)
+    def load_user_data(self, users, due_feeds):
+        """loads per user data for the batch"""
+        user_ids = [user.id for user in users]
 
-        #build list of comment and mention responses here
-        #it is separate because posts are not marked as changed
-        #when people add comments
-        #mention responses could be collected in the loop above, but
-        #it is inconvenient, because feed_type m_and_c bundles the two
-        #also we collect metadata for these here
-        try:
-            feed = user_feeds.get(feed_type='m_and_c')
-            if feed.should_send_now():
-                cutoff_time = feed.get_previous_report_cutoff_time()
-                comments = Post.objects.get_comments().filter(
-                                            added_at__lt = cutoff_time,
-                                        ).exclude(
-                                            author = user
+        #question id -> list of view times, per user
+        self.views = dict()
+        views = QuestionView.objects.filter(
+                                    who__in=user_ids
+                                ).values_list('who', 'question', 'when')
+        for user_id, question_id, when in views:
+            user_views = self.views.setdefault(user_id, dict())
+            user_views.setdefault(question_id, list()).append(when)
+
+        followed = Thread.followed_by.through.objects.filter(
+                                    user__in=user_ids
+                                ).values('user', 'thread')
+        self.followed_threads = group_values(followed, 'user', 'thread')
+
+        #thread id -> number of answers, per user
+        self.answer_counts = dict()
+        answers = Post.objects.filter(
+                                post_type='answer',
+                                author__in=user_ids
+                            ).values_list('author', 'thread')
+        for author_id, thread_id in answers:
+            counts = self.answer_counts.setdefault(author_id, dict())
+            counts[thread_id] = counts.get(thread_id, 0) + 1
+
+        self.tag_preferences = get_user_tag_preferences(users)
+
+        self.user_groups = dict()
+        if self.groups_enabled:
+            memberships = AuthUserGroups.objects.filter(
+                                    user__in=user_ids
+                                ).values_list('user', 'group')
+            for user_id, group_id in memberships:
+                self.user_groups.setdefault(user_id, set()).add(group_id)
+
+        mc_user_ids = [
+            user_id for user_id, feeds in due_feeds.items() if 'm_and_c' in feeds
+        ]
+        self.load_comments(mc_user_ids)
+        self.load_mentions(mc_user_ids)
+
+    def load_comments(self, user_ids):
+        """comments to the posts of the users,
+        user id -> list of (comment author id, added at, origin question id)"""
+        self.comments = dict()
+        if not user_ids:
+            return
+        comments = Post.objects.get_comments().filter(
+                                    parent__author__in=user_ids
+                                ).order_by(
+                                    'id'
+                                ).values_list(
+                                    'author', 'added_at', 'parent',
+                                    'parent__author', 'parent__post_type',
+                                    'parent__thread'
+                                )
+        comments = list(comments)
+
+        #commented questions are reported even if they
+        #are not among the questions of the other subscriptions
+        question_ids = set()
+        thread_ids = set()
+        for comment in comments:
+            parent_id, parent_type, thread_id = comment[2], comment[4], comment[5]
+            if parent_type == 'question':
+                question_ids.add(parent_id)
+            elif thread_id not in self.question_by_thread:
+                thread_ids.add(thread_id)
+        question_ids.difference_update(self.questions.keys())
+        extra_question_by_thread = self.load_extra_questions(question_ids, thread_ids)
+
+        for author_id, added_at, parent_id, parent_author_id, \
+                parent_type, thread_id in comments:
+            if parent_type == 'question':
+                origin_id = parent_id
+            elif parent_type in ('tag_wiki', 'reject_reason'):
+                continue
+            else:
+                origin_id = self.question_by_thread.get(thread_id) \
+                            or extra_question_by_thread.get(thread_id)
+            if origin_id in self.questions:
+                self.comments.setdefault(parent_author_id, list()).append(
+                                            (author_id, added_at, origin_id)
                                         )
-                q_commented = list() 
-                for c in comments:
-                    post = c.parent
-                    if post.author != user:
-                        continue
 
-                    #skip is post was seen by the user after
-                    #the comment posting time
-                    q_commented.append(post.get_origin_post())
+    def load_extra_questions(self, question_ids, thread_ids):
+        """loads questions that are not candidates for the digests,
+        returns dictionary thread id -> question id
+        for the questions of the given threads"""
+        if not (question_ids or thread_ids):
+            return {}
+        questions = Post.objects.filter(
+                            Q(id__in=question_ids) | Q(
+                                post_type='question', thread__in=thread_ids
+                            )
+                        ).values(*QUESTION_FIELDS)
+        question_by_thread = dict()
+        for row in questions:
+            self.questions[row['id']] = row
+            if row['thread_id'] in thread_ids:
+                question_by_thread[row['thread_id']] = row['id']
+        return question_by_thread
+
+    def load_mentions(self, user_ids):
+        """user id -> list of (mentioned at, origin question id),
+        only the questions that may be in the digest are kept"""
+        self.mentions = dict()
+        if not user_ids:
+            return
+        mentions = Activity.objects.filter(
+                                activity_type=const.TYPE_ACTIVITY_MENTION,
+                                is_auditted=False,
+                                recipients__in=user_ids,
+                                content_type=self.post_content_type
+                            ).values_list(
+                                'recipients', 'active_at', 'object_id'
+                            )
+        mentions = list(mentions)
+        post_ids = set([mention[2] for mention in mentions])
+        posts = Post.objects.filter(
+                                id__in=post_ids
+                            ).values_list('id', 'post_type', 'thread')
+        posts = list(posts)
 
-                extend_question_list(
-                                q_commented,
-                                q_list,
-                                cutoff_time = cutoff_time,
-                                add_comment = True
+        #mentions may be older than the loaded threads
+        question_ids = set()
+        thread_ids = set()
+        for post_id, post_type, thread_id in posts:
+            if post_type == 'question' and post_id not in self.position:
+                question_ids.add(post_id)
+            elif post_type in ('answer', 'comment') \
+                and thread_id not in self.question_by_thread:
+                thread_ids.add(thread_id)
+        if question_ids or thread_ids:
+            questions = self.get_candidate_questions().filter(
+                                Q(id__in=question_ids) | Q(thread__in=thread_ids)
                             )
+            self.add_candidates(questions.values(*QUESTION_FIELDS))
+
+        origins = dict()
+        for post_id, post_type, thread_id in posts:
+            if post_type == 'question':
+                origins[post_id] = post_id
+            elif post_type in ('answer', 'comment'):
+                origins[post_id] = self.question_by_thread.get(thread_id)
 
-                mentions = Activity.objects.get_mentions(
-                                                    mentioned_at__lt = cutoff_time,
-                                                    mentioned_whom = user
+        for user_id, active_at, post_id in mentions:
+            origin_id = origins.get(post_id)
+            if origin_id:
+                self.mentions.setdefault(user_id, list()).append(
+                                                    (active_at, origin_id)
                                                 )
 
-                #print 'have %d mentions' % len(mentions)
-                #MM = Activity.objects.filter(activity_type = const.TYPE_ACTIVITY_MENTION)
-                #print 'have %d total mentions' % len(MM)
-                #for m in MM:
-                #    print m
+    def get_question_lists(self, user, due_feeds):
+        """returns ordered dictionary question id -> meta data,
+        the questions are collected in the same order and with
+        the same limits as by the per-user query sets"""
+        user_views = self.views.get(user.id, {})
+        max_alerts = self.max_alerts
 
-                mention_posts = get_all_origin_posts(mentions)
-                q_mentions_id = [q.id for q in mention_posts]
+        def is_base(question):
+            if question['thread__last_activity_by'] == user.id:
+                return False
+            return question['thread__last_activity_at'] >= user.date_joined
 
-                q_mentions_A = Q_set_A.filter(id__in = q_mentions_id)
-                q_mentions_A.cutoff_time = cutoff_time
-                extend_question_list(q_mentions_A, q_list, add_mention=True)
+        def count_not_seen(question):
+            #questions not seen by the user at all
+            if question['id'] in user_views:
+                return 0
+            return 1
 
-                q_mentions_B = Q_set_B.filter(id__in = q_mentions_id)
-                q_mentions_B.cutoff_time = cutoff_time
-                extend_question_list(q_mentions_B, q_list, add_mention=True)
-        except EmailFeedSetting.DoesNotExist:
-            pass
+        def count_seen_before_last_mod(question):
+            #number of views before the last modification
+            last_activity_at = question['thread__last_activity_at']
+            views = user_views.get(question['id'], ())
+            return len([when for when in views if when < last_activity_at])
+
+        def select(question_ids, count_matches, multiplier=None):
+            """returns question ids in the order of the last activity,
+            repeated as many times as the sql join would"""
+            result = list()
+            for question_id in self.sort_questions(question_ids):
+                question = self.questions[question_id]
+                if not is_base(question):
+                    continue
+                count = count_matches(question)
+                if multiplier:
+                    count *= multiplier(question)
+                result.extend([question_id] * count)
+            return result
+
+        cutoff_times = due_feeds[user.id]
+        question_lists = dict()
+
+        if 'q_sel' in cutoff_times:
+            thread_ids = self.followed_threads.get(user.id, ())
+            question_ids = [
+                self.question_by_thread[thread_id] for thread_id in thread_ids
+                if thread_id in self.question_by_thread
+            ]
+            question_lists['q_sel'] = (
+                select(question_ids, count_not_seen),
+                select(question_ids, count_seen_before_last_mod)
+            )
+
+        if 'q_ask' in cutoff_times:
+            question_ids = self.questions_by_author.get(user.id, ())
+            question_lists['q_ask'] = (
+                select(question_ids, count_not_seen),
+                select(question_ids, count_seen_before_last_mod)
+            )
+
+        if 'q_ans' in cutoff_times:
+            answer_counts = self.answer_counts.get(user.id, {})
+            question_ids = [
+                self.question_by_thread[thread_id] for thread_id in answer_counts
+                if thread_id in self.question_by_thread
+            ]
+            multiplier = lambda question: answer_counts[question['thread_id']]
+            question_lists['q_ans'] = (
+                select(question_ids, count_not_seen, multiplier)[:max_alerts],
+                select(question_ids, count_seen_before_last_mod, multiplier)[:max_alerts]
+            )
+
+        if 'q_all' in cutoff_times:
+            question_lists['q_all'] = self.get_tag_filtered_questions(
+                                                user,
+                                                is_base,
+                                                count_not_seen,
+                                                count_seen_before_last_mod
+                                            )
+
+        q_list = SortedDict()
+
+        def extend(feed_type, index, **kwargs):
+            if feed_type in question_lists:
+                extend_question_list(
+                    question_lists[feed_type][index],
+                    q_list,
+                    cutoff_time=cutoff_times[feed_type],
+                    **kwargs
+                )
+
+        extend('q_sel', 0)
+        extend('q_sel', 1)
+
+        if 'm_and_c' in cutoff_times:
+            cutoff_time = cutoff_times['m_and_c']
+            q_commented = [
+                origin_id for author_id, added_at, origin_id \
+                in self.comments.get(user.id, ())
+                if added_at < cutoff_time and author_id != user.id
+            ]
+            extend_question_list(
+                            q_commented,
+                            q_list,
+                            cutoff_time = cutoff_time,
+                            add_comment = True
+                        )
+
+            question_ids = [
+                origin_id for active_at, origin_id \
+                in self.mentions.get(user.id, ())
+                if active_at < cutoff_time
+            ]
+            extend_question_list(
+                            select(question_ids, count_not_seen),
+                            q_list,
+                            cutoff_time = cutoff_time,
+                            add_mention = True
+                        )
+            extend_question_list(
+                            select(question_ids, count_seen_before_last_mod),
+                            q_list,
+                            cutoff_time = cutoff_time,
+                            add_mention = True
+                        )
 
         if user.email_tag_filter_strategy == const.INCLUDE_INTERESTING:
-            extend_question_list(q_all_A, q_list)
-            extend_question_list(q_all_B, q_list)
+            extend('q_all', 0)
+            extend('q_all', 1)
 
-        extend_question_list(q_ask_A, q_list, limit=True)
-        extend_question_list(q_ask_B, q_list, limit=True)
+        extend('q_ask', 0, limit=True)
+        extend('q_ask', 1, limit=True)
 
-        extend_question_list(q_ans_A, q_list, limit=True)
-        extend_question_list(q_ans_B, q_list, limit=True)
+        extend('q_ans', 0, limit=True)
+        extend('q_ans', 1, limit=True)
 
         if user.email_tag_filter_strategy == const.EXCLUDE_IGNORED:
-            extend_question_list(q_all_A, q_list, limit=True)
-            extend_question_list(q_all_B, q_list, limit=True)
+            extend('q_all', 0, limit=True)
+            extend('q_all', 1, limit=True)
 
-        ctype = ContentType.objects.get_for_model(Post)
-        EMAIL_UPDATE_ACTIVITY = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+        return q_list
 
-        #up to this point we still don't know if emails about
-        #collected questions were sent recently
-        #the next loop examines activity record and decides
-        #for each question, whether it needs to be included or not
-        #into the report
+    def get_tag_filtered_questions(
+                self, user, is_base, count_not_seen, count_seen_before_last_mod
+            ):
+        """returns pair of lists of the first ``MAX_ALERTS_PER_EMAIL``
+        questions not seen and seen before the last modification,
+        filtered with the email tag filter strategy of the user"""
+        strategy = user.email_tag_filter_strategy
+        if strategy == const.EXCLUDE_IGNORED:
+            ignored_tag_ids = self.tag_preferences[user.id].get_tag_ids('bad')
+            selected_tag_ids = None
+        elif strategy == const.INCLUDE_INTERESTING:
+            if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
+                reason = 'subscribed'
+            else:
+                reason = 'good'
+            selected_tag_ids = self.tag_preferences[user.id].get_tag_ids(reason)
+            if len(selected_tag_ids) == 0:
+                return [], []
+            ignored_tag_ids = None
+        else:
+            #question lists are not used with other strategies
+            return [], []
 
-        for q, meta_data in q_list.items():
-            #this loop edits meta_data for each question
-            #so that user will receive counts on new edits new answers, etc
-            #and marks questions that need to be skipped
-            #because an email about them was sent recently enough
+        if ignored_tag_ids or selected_tag_ids:
+            thread_tags = self.get_thread_tags()
+        not_seen = list()
+        seen_before_last_mod = list()
+        for question_id in self.question_order:
+            if len(not_seen) >= self.max_alerts \
+                and len(seen_before_last_mod) >= self.max_alerts:
+                break
+            question = self.questions[question_id]
+            if not is_base(question):
+                continue
+            if ignored_tag_ids or selected_tag_ids:
+                tag_ids = thread_tags.get(question['thread_id'], ())
+                if ignored_tag_ids and ignored_tag_ids.intersection(tag_ids):
+                    continue
+                if selected_tag_ids and not selected_tag_ids.intersection(tag_ids):
+                    continue
+            #query sets are distinct, so each question is counted once
+            if count_not_seen(question) and len(not_seen) < self.max_alerts:
+                not_seen.append(question_id)
+            if count_seen_before_last_mod(question) \
+                and len(seen_before_last_mod) < self.max_alerts:
+                seen_before_last_mod.append(question_id)
+        return not_seen, seen_before_last_mod
 
-            #also it keeps a record of latest email activity per question per user
-            try:
-                #todo: is it possible to use content_object here, instead of
-                #content type and object_id pair?
-                update_info = Activity.objects.get(
-                                            user=user,
-                                            content_type=ctype,
-                                            object_id=q.id,
-                                            activity_type=EMAIL_UPDATE_ACTIVITY
-                                        )
-                emailed_at = update_info.active_at
-            except Activity.DoesNotExist:
-                update_info = Activity(
-                                        user=user, 
-                                        content_object=q, 
-                                        activity_type=EMAIL_UPDATE_ACTIVITY
-                                    )
-                emailed_at = datetime.datetime(1970, 1, 1)#long time ago
-            except Activity.MultipleObjectsReturned:
-                raise Exception(
-                                'server error - multiple question email activities '
-                                'found per user-question pair'
-                                )
+    def load_question_data(self, question_ids, user_ids):
+        """loads revisions, answers and email records
+        of the questions collected for the digests"""
+        questions = [self.questions[qid] for qid in question_ids]
+        thread_ids = set([question['thread_id'] for question in questions])
+
+        #question id -> list of (author id, revised at), latest first
+        self.question_revisions = dict()
+        revisions = PostRevision.objects.filter(
+                                    post__in=question_ids
+                                ).order_by(
+                                    '-revision'
+                                ).values_list('post', 'author', 'revised_at')
+        for post_id, author_id, revised_at in revisions:
+            self.question_revisions.setdefault(post_id, list()).append(
+                                                    (author_id, revised_at)
+                                                )
+
+        #thread id -> list of answers
+        self.thread_answers = dict()
+        answers = Post.objects.filter(
+                                post_type='answer',
+                                thread__in=thread_ids
+                            ).values('id', 'thread_id', 'author_id', 'added_at', 'deleted')
+        answers = list(answers)
+        for answer in answers:
+            answer['groups'] = set()
+            self.thread_answers.setdefault(answer['thread_id'], list()).append(answer)
+        answer_ids = [answer['id'] for answer in answers]
+
+        if self.groups_enabled:
+            answer_map = dict([(answer['id'], answer) for answer in answers])
+            post_groups = PostToGroup.objects.filter(
+                                    post__in=answer_ids
+                                ).values_list('post', 'group')
+            for post_id, group_id in post_groups:
+                answer_map[post_id]['groups'].add(group_id)
+
+        #answer id -> list of revision author ids
+        revisions = PostRevision.objects.filter(
+                                    post__in=answer_ids
+                                ).values('post', 'author')
+        self.answer_revision_authors = group_values(revisions, 'post', 'author')
+
+        #(user id, question id) -> list of (activity id, emailed at)
+        self.email_records = dict()
+        records = Activity.objects.filter(
+                                user__in=user_ids,
+                                content_type=self.post_content_type,
+                                object_id__in=question_ids,
+                                activity_type=const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+                            ).values_list('id', 'user', 'object_id', 'active_at')
+        for activity_id, user_id, question_id, active_at in records:
+            key = (user_id, question_id)
+            self.email_records.setdefault(key, list()).append(
+                                                    (activity_id, active_at)
+                                                )
+
+    def update_meta_data(self, user, question_id, meta_data):
+        """counts news about the question since the last email
+        to the user, marks question to be skipped if there are none,
+        returns id of the email activity record, ``False``
+        if it is to be created or ``None`` if question is skipped"""
+        records = self.email_records.get((user.id, question_id), ())
+        if len(records) > 1:
+            raise Exception(
+                            'server error - multiple question email activities '
+                            'found per user-question pair'
+                            )
+        if records:
+            activity_id, emailed_at = records[0]
+        else:
+            activity_id = False
+            emailed_at = datetime.datetime(1970, 1, 1)#long time ago
+
+        question = self.questions[question_id]
+        cutoff_time = meta_data['cutoff_time']#cutoff time for the question
 
-            cutoff_time = meta_data['cutoff_time']#cutoff time for the question
+        #skip question if we need to wait longer because
+        #the delay before the next email has not yet elapsed
+        #or if last email was sent after the most recent modification
+        if emailed_at > cutoff_time \
+            or emailed_at > question['thread__last_activity_at']:
+            meta_data['skip'] = True
+            return None
 
-            #skip question if we need to wait longer because
-            #the delay before the next email has not yet elapsed
-            #or if last email was sent after the most recent modification
-            if emailed_at > cutoff_time or emailed_at > q.thread.last_activity_at:
-                meta_data['skip'] = True
+        #collect info on all sorts of news that happened after
+        #the most recent emailing to the user about this question
+        q_rev = [
+            revised_at for author_id, revised_at \
+            in self.question_revisions.get(question_id, ())
+            if revised_at > emailed_at and author_id != user.id
+        ]
+        meta_data['q_rev'] = len(q_rev)
+        if len(q_rev) > 0 and question['added_at'] == q_rev[0]:
+            meta_data['q_rev'] = 0
+            meta_data['new_q'] = True
+        else:
+            meta_data['new_q'] = False
+
+        user_groups = self.user_groups.get(user.id, set())
+        ans_ids = list()
+        new_ans = 0
+        for answer in self.thread_answers.get(question['thread_id'], ()):
+            if answer['deleted'] or answer['added_at'] <= emailed_at:
+                continue
+            if self.groups_enabled and not (answer['groups'] & user_groups):
                 continue
+            ans_ids.append(answer['id'])
+            if answer['author_id'] != user.id:
+                new_ans += 1
+        meta_data['new_ans'] = new_ans
 
-            #collect info on all sorts of news that happened after
-            #the most recent emailing to the user about this question
-            q_rev = q.revisions.filter(revised_at__gt=emailed_at)
-            q_rev = q_rev.exclude(author=user)
+        ans_rev = 0
+        for answer_id in ans_ids:
+            for author_id in self.answer_revision_authors.get(answer_id, ()):
+                if author_id != user.id:
+                    ans_rev += 1
+        meta_data['ans_rev'] = ans_rev
 
-            #now update all sorts of metadata per question
-            meta_data['q_rev'] = len(q_rev)
-            if len(q_rev) > 0 and q.added_at == q_rev[0].revised_at:
-                meta_data['q_rev'] = 0
-                meta_data['new_q'] = True
-            else:
-                meta_data['new_q'] = False
-                
-            new_ans = Post.objects.get_answers(user).filter(
-                                            thread=q.thread,
-                                            added_at__gt=emailed_at,
-                                            deleted=False,
-                                        )
-            new_ans = new_ans.exclude(author=user)
-            meta_data['new_ans'] = len(new_ans)
-
-            ans_ids = Post.objects.get_answers(user).filter(
-                                            thread=q.thread,
-                                            added_at__gt=emailed_at,
-                                            deleted=False,
-                                        ).values_list(
-                                            'id', flat = True
-                                        )
-            ans_rev = PostRevision.objects.filter(post__id__in = ans_ids)
-            ans_rev = ans_rev.exclude(author=user).distinct()
-            meta_data['ans_rev'] = len(ans_rev)
-
-            comments = meta_data.get('comments', 0)
-            mentions = meta_data.get('mentions', 0)
-
-            #print meta_data
-            #finally skip question if there are no news indeed
-            if len(q_rev) + len(new_ans) + len(ans_rev) + comments + mentions == 0:
-                meta_data['skip'] = True
-                #print 'skipping'
-            else:
-                meta_data['skip'] = False
-                #print 'not skipping'
-                update_info.active_at = datetime.datetime.now() 
-                if DEBUG_THIS_COMMAND == False:
-                    update_info.save() #save question email update activity 
-        #q_list is actually an ordered dictionary
-        #print 'user %s gets %d' % (user.username, len(q_list.keys()))
-        #todo: sort question list by update time
-        return q_list 
-
-    def send_email_alerts(self):
-        #does not change the database, only sends the email
-        #todo: move this to template
-        for user in User.objects.all():
-            user.add_missing_askbot_subscriptions()
-            #todo: q_list is a dictionary, not a list
-            q_list = self.get_updated_questions_for_user(user)
-            if len(q_list.keys()) == 0:
+        comments = meta_data.get('comments', 0)
+        mentions = meta_data.get('mentions', 0)
+
+        #finally skip question if there are no news indeed
+        if len(q_rev) + new_ans + ans_rev + comments + mentions == 0:
+            meta_data['skip'] = True
+            return None
+        meta_data['skip'] = False
+        return activity_id
+
+    def save_email_records(self, records):
+        """records is a list of (user id, question id, activity id)"""
+        if DEBUG_THIS_COMMAND:
+            return
+        now = datetime.datetime.now()
+        activity_ids = [record[2] for record in records if record[2]]
+        if activity_ids:
+            Activity.objects.filter(id__in=activity_ids).update(active_at=now)
+        new_activities = list()
+        for user_id, question_id, activity_id in records:
+            if activity_id:
                 continue
-            num_q = 0
-            for question, meta_data in q_list.items():
-                if meta_data['skip']:
-                    del q_list[question]
-                else:
-                    num_q += 1
-            if num_q > 0:
-                url_prefix = askbot_settings.APP_URL
-
-                threads = Thread.objects.filter(id__in=[qq.thread_id for qq in q_list.keys()])
-                tag_summary = Thread.objects.get_tag_summary_from_threads(threads)
-
-                question_count = len(q_list.keys())
-
-                subject_line = ungettext(
-                    '%(question_count)d updated question about %(topics)s',
-                    '%(question_count)d updated questions about %(topics)s',
-                    question_count
-                ) % {
-                    'question_count': question_count,
-                    'topics': tag_summary
-                }
+            new_activities.append(
+                Activity(
+                    user_id=user_id,
+                    content_type=self.post_content_type,
+                    object_id=question_id,
+                    activity_type=const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT,
+                    active_at=now
+                )
+            )
+        if new_activities:
+            bulk_create(Activity, new_activities)
 
-                #todo: send this to special log
-                #print 'have %d updated questions for %s' % (num_q, user.username)
-                text = ungettext(
-                    '<p>Dear %(name)s,</p><p>The following question has been updated '
-                    '%(sitename)s</p>',
-                    '<p>Dear %(name)s,</p><p>The following %(num)d questions have been '
-                    'updated on %(sitename)s:</p>',
-                    num_q
-                ) % {
-                    'num':num_q,
-                    'name':user.username,
-                    'sitename': askbot_settings.APP_SHORT_NAME
-                }
+    def build(self, users):
+        """returns dictionary user id -> ordered dictionary
+        question -> meta data, with only the questions
+        to be reported in the email"""
+        due_feeds = self.get_due_feeds(users)
+        users = [user for user in users if user.id in due_feeds]
+        if not users:
+            return {}
 
-                text += '<ul>'
-                items_added = 0
-                items_unreported = 0
-                for q, meta_data in q_list.items():
-                    act_list = []
-                    if meta_data['skip']:
-                        continue
-                    if items_added >= askbot_settings.MAX_ALERTS_PER_EMAIL:
-                        items_unreported = num_q - items_added #may be inaccurate actually, but it's ok
-                        
-                    else:
-                        items_added += 1
-                        if meta_data['new_q']:
-                            act_list.append(_('new question'))
-                        format_action_count('%(num)d rev', meta_data['q_rev'],act_list)
-                        format_action_count('%(num)d ans', meta_data['new_ans'],act_list)
-                        format_action_count('%(num)d ans rev',meta_data['ans_rev'],act_list)
-                        act_token = ', '.join(act_list)
-                        text += '<li><a href="%s?sort=latest">%s</a> <font color="#777777">(%s)</font></li>' \
-                                    % (url_prefix + q.get_absolute_url(), q.thread.title, act_token)
-                text += '</ul>'
-                text += '<p></p>'
-                #if len(q_list.keys()) >= askbot_settings.MAX_ALERTS_PER_EMAIL:
-                #    text += _('There may be more questions updated since '
-                #                'you have logged in last time as this list is '
-                #                'abridged for your convinience. Please visit '
-                #                'the askbot and see what\'s new!<br>'
-                #              )
-
-                link = url_prefix + reverse(
-                                        'user_subscriptions', 
-                                        kwargs = {
-                                            'id': user.id,
-                                            'slug': slugify(user.username)
-                                        }
-                                    )
-
-                text += _(
-                    '<p>Please remember that you can always <a '
-                    'href="%(email_settings_link)s">adjust</a> frequency of the email updates or '
-                    'turn them off entirely.<br/>If you believe that this message was sent in an '
-                    'error, please email about it the forum administrator at %(admin_email)s.</'
-                    'p><p>Sincerely,</p><p>Your friendly %(sitename)s server.</p>'
-                ) % {
-                    'email_settings_link': link,
-                    'admin_email': django_settings.ADMINS[0][1],
-                    'sitename': askbot_settings.APP_SHORT_NAME
+        self.load_user_data(users, due_feeds)
+
+        question_lists = dict()
+        question_ids = set()
+        for user in users:
+            q_list = self.get_question_lists(user, due_feeds)
+            question_lists[user.id] = q_list
+            question_ids.update(q_list.keys())
+
+        self.load_question_data(question_ids, [user.id for user in users])
+
+        email_records = list()
+        reported_ids = set()
+        for user in users:
+            for question_id, meta_data in question_lists[user.id].items():
+                activity_id = self.update_meta_data(user, question_id, meta_data)
+                if meta_data['skip'] == False:
+                    email_records.append((user.id, question_id, activity_id))
+                    reported_ids.add(question_id)
+        self.save_email_records(email_records)
+
+        posts = Post.objects.filter(id__in=reported_ids).select_related('thread')
+        posts = dict([(post.id, post) for post in posts])
+        digests = dict()
+        for user in users:
+            q_list = SortedDict()
+            for question_id, meta_data in question_lists[user.id].items():
+                if meta_data['skip'] == False:
+                    q_list[posts[question_id]] = meta_data
+            digests[user.id] = q_list
+        return digests
+
+
+def get_shard_id_range(shard_index, shards):
+    """returns range of user ids ``(id_from, id_to)`` of the shard,
+    ``None`` stands for no limit; the span of user ids
+    is split into the ``shards`` equal ranges"""
+    id_range = User.objects.aggregate(Min('id'), Max('id'))
+    min_id = id_range['id__min'] or 0
+    max_id = id_range['id__max'] or 0
+    span = max_id - min_id + 1
+    id_from = min_id + span * shard_index / shards
+    id_to = min_id + span * (shard_index + 1) / shards
+    if shard_index == 0:
+        id_from = None
+    if shard_index == shards - 1:
+        id_to = None#new users go to the last shard
+    return id_from, id_to
+
+def run_shard(args):
+    """sends digests to the users of one shard,
+    used as the task of the worker processes"""
+    shard_index, shards, options = args
+    #connection inherited from the parent process must not be shared
+    connection.close()
+    try:
+        return Command().run_shard(shard_index, shards, options)
+    finally:
+        connection.close()
+
+def add_stats(total, stats):
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--shards',
+            action = 'store',
+            type = 'int',
+            dest = 'shards',
+            default = 1,
+            help = 'number of parts into which the users are split by id'
+        ),
+        make_option('--shard-index',
+            action = 'store',
+            type = 'int',
+            dest = 'shard_index',
+            default = 0,
+            help = 'zero based number of the part of the users to process'
+        ),
+        make_option('--workers',
+            action = 'store',
+            type = 'int',
+            dest = 'workers',
+            default = 1,
+            help = 'number of processes, each one takes a part of the shard'
+        ),
+        make_option('--resume',
+            action = 'store_true',
+            dest = 'resume',
+            default = False,
+            help = 'continue after the last user saved in the checkpoint'
+        ),
+        make_option('--checkpoint-dir',
+            action = 'store',
+            type = 'str',
+            dest = 'checkpoint_dir',
+            default = tempfile.gettempdir(),
+            help = 'directory for the files with the progress of the shards'
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        shards = options['shards']
+        shard_index = options['shard_index']
+        if shards < 1 or options['workers'] < 1:
+            raise CommandError('--shards and --workers must be positive')
+        if options['workers'] > 1 and multiprocessing is None:
+            raise CommandError('--workers above 1 require python 2.6 or later')
+        if shard_index < 0 or shard_index >= shards:
+            raise CommandError('--shard-index must be between 0 and %d' % (shards - 1))
+
+        if askbot_settings.ENABLE_EMAIL_ALERTS:
+            try:
+                try:
+                    stats = self.send_email_alerts(options)
+                    if int(options.get('verbosity', 1)) > 0:
+                        print self.format_summary(stats)
+                except Exception, e:
+                    print e
+            finally:
+                connection.close()
+
+    def add_missing_subscriptions(self, user_ids):
+        """same as ``User.add_missing_askbot_subscriptions``
+        for all users, but only the users who miss some
+        subscriptions are loaded"""
+        form = forms.EditUserEmailFeedsForm()
+        need_feed_types = set(form.get_db_model_subscription_type_names())
+        feeds = EmailFeedSetting.objects.filter(
+                                    subscriber__in=user_ids
+                                ).values('subscriber', 'feed_type')
+        have_feed_types = group_values(feeds, 'subscriber', 'feed_type')
+        incomplete_ids = [
+            user_id for user_id in user_ids
+            if need_feed_types - set(have_feed_types.get(user_id, ()))
+        ]
+        for user in User.objects.filter(id__in=incomplete_ids):
+            user.add_missing_askbot_subscriptions()
+
+    def send_email_alerts(self, options):
+        """returns dictionary with the counts of users, emails
+        and the time in seconds spent in each phase.
+
+        With several workers the shard is split into
+        the ``workers`` parts - each one is a shard of its own,
+        processed in a separate process."""
+        workers = options['workers']
+        shards = options['shards']
+        shard_index = options['shard_index']
+        if workers == 1:
+            return self.run_shard(shard_index, shards, options)
+
+        tasks = [
+            (shard_index * workers + n, shards * workers, options)
+            for n in range(workers)
+        ]
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(run_shard, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        stats = dict()
+        for result in results:
+            add_stats(stats, result)
+        return stats
+
+    def get_checkpoint_path(self, shard_index, shards, options):
+        file_name = 'askbot-email-alerts-%d-of-%d.json' % (shard_index, shards)
+        return os.path.join(options['checkpoint_dir'], file_name)
+
+    def load_checkpoint(self, path):
+        if not os.path.exists(path):
+            return None
+        checkpoint_file = open(path)
+        try:
+            return simplejson.load(checkpoint_file)
+        finally:
+            checkpoint_file.close()
+
+    def save_checkpoint(self, checkpoint, path):
+        #write and rename, so that the checkpoint is never half written
+        temp_path = path + '.tmp'
+        checkpoint_file = open(temp_path, 'w')
+        try:
+            simplejson.dump(checkpoint, checkpoint_file)
+        finally:
+            checkpoint_file.close()
+        os.rename(temp_path, path)
+
+    def run_shard(self, shard_index, shards, options):
+        """sends digests to the users of the shard in batches.
+
+        Changes to the database made for a batch are committed
+        after the emails are sent, then the id of the last user
+        of the batch is saved in the checkpoint file, so
+        the interrupted run can be continued with ``--resume``.
+        The checkpoint is removed when the shard is done."""
+        checkpoint_path = self.get_checkpoint_path(shard_index, shards, options)
+        checkpoint = None
+        if options['resume']:
+            checkpoint = self.load_checkpoint(checkpoint_path)
+        if checkpoint is None:
+            id_from, id_to = get_shard_id_range(shard_index, shards)
+            checkpoint = {
+                'id_from': id_from,
+                'id_to': id_to,
+                'last_user_id': None,
+                'stats': {
+                    'users_scanned': 0,
+                    'emails_built': 0,
+                    'emails_sent': 0,
+                    'subscriptions_time': 0,
+                    'build_time': 0,
+                    'send_time': 0
                 }
-                if DEBUG_THIS_COMMAND == True:
-                    recipient_email = django_settings.ADMINS[0][1]
-                else:
-                    recipient_email = user.email
-
-                mail.send_mail(
-                    subject_line = subject_line,
-                    body_text = text,
-                    recipient_list = [recipient_email]
-                )
+            }
+        stats = checkpoint['stats']
+
+        users = User.objects.order_by('id')
+        if checkpoint['id_from'] is not None:
+            users = users.filter(id__gte=checkpoint['id_from'])
+        if checkpoint['id_to'] is not None:
+            users = users.filter(id__lt=checkpoint['id_to'])
+        if checkpoint['last_user_id'] is not None:
+            users = users.filter(id__gt=checkpoint['last_user_id'])
+        user_ids = list(users.values_list('id', flat=True))
+
+        start = time.time()
+        self.add_missing_subscriptions(user_ids)
+        stats['subscriptions_time'] += time.time() - start
+
+        builder = DigestBuilder()
+        for start in range(0, len(user_ids), USER_BATCH_SIZE):
+            batch_ids = user_ids[start:start + USER_BATCH_SIZE]
+            with transaction.commit_on_success():
+                users = list(User.objects.filter(id__in=batch_ids).order_by('id'))
+
+                build_start = time.time()
+                digests = builder.build(users)
+                messages = list()
+                for user in users:
+                    q_list = digests.get(user.id)
+                    if q_list:
+                        messages.append(self.make_digest_message(user, q_list))
+                send_start = time.time()
+                stats['build_time'] += send_start - build_start
+                stats['emails_built'] += len(messages)
+
+                results = mail.send_mass_mail(messages)
+                stats['emails_sent'] += results.count(True)
+                stats['send_time'] += time.time() - send_start
+                stats['users_scanned'] += len(users)
+
+            checkpoint['last_user_id'] = batch_ids[-1]
+            self.save_checkpoint(checkpoint, checkpoint_path)
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return stats
+
+    def format_summary(self, stats):
+        total_time = stats['subscriptions_time'] \
+                        + stats['build_time'] + stats['send_time']
+        return 'users scanned: %d, emails built: %d, emails sent: %d\n' \
+            'time: subscriptions %.1fs, build %.1fs, send %.1fs, total %.1fs' % (
+                stats['users_scanned'], stats['emails_built'],
+                stats['emails_sent'], stats['subscriptions_time'],
+                stats['build_time'], stats['send_time'], total_time
+            )
+
+    def make_digest_message(self, user, q_list):
+        #todo: move this to template
+        num_q = len(q_list.keys())
+        url_prefix = askbot_settings.APP_URL
+
+        threads = Thread.objects.filter(id__in=[qq.thread_id for qq in q_list.keys()])
+        tag_summary = Thread.objects.get_tag_summary_from_threads(threads)
+
+        question_count = len(q_list.keys())
+
+        subject_line = ungettext(
+            '%(question_count)d updated question about %(topics)s',
+            '%(question_count)d updated questions about %(topics)s',
+            question_count
+        ) % {
+            'question_count': question_count,
+            'topics': tag_summary
+        }
+
+        #todo: send this to special log
+        #print 'have %d updated questions for %s' % (num_q, user.username)
+        text = ungettext(
+            '<p>Dear %(name)s,</p><p>The following question has been updated '
+            '%(sitename)s</p>',
+            '<p>Dear %(name)s,</p><p>The following %(num)d questions have been '
+            'updated on %(sitename)s:</p>',
+            num_q
+        ) % {
+            'num':num_q,
+            'name':user.username,
+            'sitename': askbot_settings.APP_SHORT_NAME
+        }
+
+        text += '<ul>'
+        items_added = 0
+        items_unreported = 0
+        for q, meta_data in q_list.items():
+            act_list = []
+            if items_added >= askbot_settings.MAX_ALERTS_PER_EMAIL:
+                items_unreported = num_q - items_added #may be inaccurate actually, but it's ok
+
+            else:
+                items_added += 1
+                if meta_data['new_q']:
+                    act_list.append(_('new question'))
+                format_action_count('%(num)d rev', meta_data['q_rev'],act_list)
+                format_action_count('%(num)d ans', meta_data['new_ans'],act_list)
+                format_action_count('%(num)d ans rev',meta_data['ans_rev'],act_list)
+                act_token = ', '.join(act_list)
+                text += '<li><a href="%s?sort=latest">%s</a> <font color="#777777">(%s)</font></li>' \
+                            % (url_prefix + q.get_absolute_url(), q.thread.title, act_token)
+        text += '</ul>'
+        text += '<p></p>'
+        #if len(q_list.keys()) >= askbot_settings.MAX_ALERTS_PER_EMAIL:
+        #    text += _('There may be more questions updated since '
+        #                'you have logged in last time as this list is '
+        #                'abridged for your convinience. Please visit '
+        #                'the askbot and see what\'s new!<br>'
+        #              )
+
+        link = url_prefix + reverse(
+                                'user_subscriptions',
+                                kwargs = {
+                                    'id': user.id,
+                                    'slug': slugify(user.username)
+                                }
+                            )
+
+        text += _(
+            '<p>Please remember that you can always <a '
+            'href="%(email_settings_link)s">adjust</a> frequency of the email updates or '
+            'turn them off entirely.<br/>If you believe that this message was sent in an '
+            'error, please email about it the forum administrator at %(admin_email)s.</'
+            'p><p>Sincerely,</p><p>Your friendly %(sitename)s server.</p>'
+        ) % {
+            'email_settings_link': link,
+            'admin_email': django_settings.ADMINS[0][1],
+            'sitename': askbot_settings.APP_SHORT_NAME
+        }
+        if DEBUG_THIS_COMMAND == True:
+            recipient_email = django_settings.ADMINS[0][1]
+        else:
+            recipient_email = user.email
+
+        return mail.make_message(
+            subject_line = subject_line,
+            body_text = text,
+            recipient_list = [recipient_email]
+        )
@@ -27,6 +27,8 @@ from django.utils.translation import ungettext
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 from django.db import models
+from django.db import connection
+from django.db import transaction
 from django.conf import settings as django_settings
 from django.contrib.contenttypes.models import ContentType
 from django.core import cache
@@ -43,7 +45,13 @@ from askbot.models.question import QuestionView, AnonymousQuestion
 from askbot.models.question import DraftQuestion
 from askbot.models.question import FavoriteQuestion
 from askbot.models.tag import Tag, MarkedTag
+from askbot.models.tag import WildcardTagSelection
+from askbot.models.tag import update_wildcard_selection_index
 from askbot.models.tag import format_personal_group_name
+from askbot.models.tag import update_tag_name_map
+from askbot.models.tag import forget_tag_selections
+from askbot.models.tag import get_user_tag_preferences
+from askbot.models.tag import invalidate_user_tag_preferences
 from askbot.models.user import EmailFeedSetting, ActivityAuditStatus, Activity
 from askbot.models.user import GroupMembership
 from askbot.models.user import Group
@@ -53,6 +61,7 @@ from askbot.models.post import PostFlagReason, AnonymousAnswer
 from askbot.models.post import PostToGroup
 from askbot.models.post import DraftAnswer
 from askbot.models.reply_by_email import ReplyAddress
+from askbot.models.base import bulk_create
 from askbot.models import signals
 from askbot.models.badges import award_badges_signal, get_badge, BadgeData
 from askbot.models.repute import Award, Repute, Vote
@@ -61,10 +70,12 @@ from askbot import auth
 from askbot.utils.decorators import auto_now_timestamp
 from askbot.utils.markup import URL_RE
 from askbot.utils.slug import slugify
+from askbot.utils.html import absolutize_urls
 from askbot.utils.html import replace_links_with_text
 from askbot.utils.html import sanitize_html
 from askbot.utils.diff import textDiff as htmldiff
 from askbot.utils.url_utils import strip_path
+from askbot.utils.write_behind import WriteBehindBuffer, can_buffer
 from askbot import mail
 
 from django import VERSION
@@ -321,7 +332,18 @@ def user_get_old_vote_for_post(self, post):
 
     raises assertion_error is number of old votes is > 1
     which is illegal
+
+    does not query the database when the post was loaded with
+    :meth:`~askbot.models.post.PostQuerySet.get_for_voting`
+    for this user and the user did not vote
     """
+    if getattr(post, 'voter_id', None) == self.id:
+        if post.user_vote_id is None:
+            return None
+        vote = Vote.objects.get(id=post.user_vote_id)
+        vote.user = self
+        vote.voted_post = post
+        return vote
     try:
         return Vote.objects.get(user=self, voted_post=post)
     except Vote.DoesNotExist:
@@ -365,6 +387,11 @@ def user_get_marked_tag_names(self, reason):
 
     return tag_names
 
+def user_get_tag_preferences(self):
+    """returns cached :class:`~askbot.models.tag.UserTagPreferences`
+    of the user"""
+    return get_user_tag_preferences([self])[self.id]
+
 def user_has_affinity_to_question(self, question = None, affinity_type = None):
     """returns True if number of tag overlap of the user tag
     selection with the question is 0 and False otherwise
@@ -626,7 +653,7 @@ def user_assert_can_vote_for_post(
     :param:direction can be 'up' or 'down'
     :param:post can be instance of question or answer
     """
-    if self == post.author:
+    if self.id == post.author_id:
         raise django_exceptions.PermissionDenied(
             _('Sorry, you cannot vote for your own posts')
         )
@@ -1218,6 +1245,73 @@ def user_assert_can_delete_comment(self, comment = None):
     )
 
 
+def user_get_comment_permissions(self, comments):
+    """returns a dictionary keyed by the comment id, with
+    values ``(can_delete, can_edit)`` - same as the outcomes of
+    :meth:`assert_can_delete_comment` and :meth:`assert_can_edit_comment`,
+    but computed for all the comments at once
+
+    ``comments`` must contain all the comments of their parent posts,
+    as the age limit to edit a comment does not apply to the last one;
+    the comment authors are not loaded, and at most one query is made
+    - for the posts moderated by the user, if groups are enabled
+    """
+    comments = list(comments)
+    is_admin_or_mod = self.is_administrator_or_moderator()
+
+    moderated_ids = set()
+    if askbot_settings.GROUPS_ENABLED and not is_admin_or_mod \
+        and self.reputation < askbot_settings.MIN_REP_TO_DELETE_OTHERS_COMMENTS:
+        group_ids = self.get_groups().values_list('id', flat=True)
+        moderated_ids = set(
+            PostToGroup.objects.filter(
+                post__id__in = [comment.id for comment in comments],
+                group__id__in = group_ids,
+                group__is_vip = True
+            ).values_list('post_id', flat=True)
+        )
+
+    last_added_at = dict()
+    for comment in comments:
+        added_at = last_added_at.get(comment.parent_id)
+        if added_at is None or comment.added_at > added_at:
+            last_added_at[comment.parent_id] = comment.added_at
+
+    edit_deadline = None
+    if askbot_settings.USE_TIME_LIMIT_TO_EDIT_COMMENT:
+        delta_seconds = 60 * askbot_settings.MINUTES_TO_EDIT_COMMENT
+        edit_deadline = datetime.datetime.now() - \
+                            datetime.timedelta(0, delta_seconds)
+
+    permissions = dict()
+    for comment in comments:
+        is_owner = (comment.author_id == self.id)
+
+        if self.is_blocked():
+            can_delete = False
+        elif is_owner:
+            can_delete = True
+        elif self.is_suspended():
+            can_delete = False
+        elif is_admin_or_mod or comment.id in moderated_ids:
+            can_delete = True
+        else:
+            can_delete = \
+                (self.reputation >= askbot_settings.MIN_REP_TO_DELETE_OTHERS_COMMENTS)
+
+        if is_admin_or_mod:
+            can_edit = True
+        elif is_owner:
+            can_edit = edit_deadline is None \
+                or comment.added_at >= edit_deadline \
+                or comment.added_at == last_added_at[comment.parent_id]
+        else:
+            can_edit = False
+
+        permissions[comment.id] = (can_delete, can_edit)
+    return permissions
+
+
 def user_assert_can_revoke_old_vote(self, vote):
     """raises exceptions.PermissionDenied if old vote
     cannot be revoked due to age of the vote
@@ -1228,17 +1322,35 @@ def user_assert_can_revoke_old_vote(self, vote):
             _('sorry, but older votes cannot be revoked')
         )
 
+def get_used_votes_cache_key(user_id, day):
+    return 'used-votes-%d-%s' % (user_id, day.isoformat())
+
+def update_used_votes_count(vote, delta):
+    """changes the cached number of votes used by the voter
+    on the day of the vote, if that number is in the cache"""
+    cache_key = get_used_votes_cache_key(vote.user_id, vote.voted_at.date())
+    try:
+        if delta > 0:
+            cache.cache.incr(cache_key, delta)
+        else:
+            cache.cache.decr(cache_key, -delta)
+    except ValueError:
+        pass#not in the cache, will be counted in the database
+
 def user_get_unused_votes_today(self):
     """returns number of votes that are
     still available to the user today
+
+    the votes used today are counted in the database once
+    and then the count is kept in the cache under the key
+    of the day, it is updated when votes are added or deleted
     """
     today = datetime.date.today()
-    one_day_interval = (today, today + datetime.timedelta(1))
-
-    used_votes = Vote.objects.filter(
-                                user = self,
-                                voted_at__range = one_day_interval
-                            ).count()
+    cache_key = get_used_votes_cache_key(self.id, today)
+    used_votes = cache.cache.get(cache_key)
+    if used_votes is None:
+        used_votes = Vote.objects.get_votes_count_today_from_user(self)
+        cache.cache.set(cache_key, used_votes, 60*60*24)
 
     available_votes = askbot_settings.MAX_VOTES_PER_USER_PER_DAY - used_votes
     return max(0, available_votes)
@@ -1400,6 +1512,7 @@ def user_mark_tags(
                 marked_ts.update(reason=reason)
             cleaned_tagnames = tagnames
 
+    invalidate_user_tag_preferences(self)
     return cleaned_tagnames, cleaned_wildcards
 
 @auto_now_timestamp
@@ -1523,6 +1636,7 @@ def user_delete_question(
     question.deleted_by = self
     question.deleted_at = timestamp
     question.save()
+    question.thread.update_listing_index()
 
     for tag in list(question.thread.tags.all()):
         if tag.used_count == 1:
@@ -1947,47 +2061,14 @@ def user_visit_question(self, question = None, timestamp = None):
     if timestamp is None:
         timestamp = datetime.datetime.now()
 
-    try:
-        QuestionView.objects.filter(
-            who=self, question=question
-        ).update(
-            when = timestamp
-        )
-    except QuestionView.DoesNotExist:
-        QuestionView(
-            who=self,
-            question=question,
-            when = timestamp
-        ).save()
-
-    #filter memo objects on response activities directed to the qurrent user
-    #that refer to the children of the currently
-    #viewed question and clear them for the current user
-    ACTIVITY_TYPES = const.RESPONSE_ACTIVITY_TYPES_FOR_DISPLAY
-    ACTIVITY_TYPES += (const.TYPE_ACTIVITY_MENTION,)
-
-    audit_records = ActivityAuditStatus.objects.filter(
-                        user = self,
-                        status = ActivityAuditStatus.STATUS_NEW,
-                        activity__question = question
-                    )
-
-    cleared_record_count = audit_records.filter(
-                                activity__activity_type__in = ACTIVITY_TYPES
-                            ).update(
-                                status=ActivityAuditStatus.STATUS_SEEN
-                            )
-    if cleared_record_count > 0:
-        self.update_response_counts()
-
-    #finally, mark admin memo objects if applicable
-    #the admin response counts are not denormalized b/c they are easy to obtain
-    if self.is_moderator() or self.is_administrator():
-        audit_records.filter(
-                activity__activity_type = const.TYPE_ACTIVITY_MARK_OFFENSIVE
-        ).update(
-            status=ActivityAuditStatus.STATUS_SEEN
-        )
+    cleared_counts = record_question_visits([(self.id, question.id, timestamp)])
+    if cleared_counts.get(self.id):
+        #counts were adjusted in the database
+        counts = User.objects.filter(id = self.id).values(
+                            'new_response_count', 'seen_response_count'
+                        )[0]
+        self.new_response_count = counts['new_response_count']
+        self.seen_response_count = counts['seen_response_count']
 
 
 def user_is_username_taken(cls,username):
@@ -2248,38 +2329,24 @@ def user_get_tag_filtered_questions(self, questions = None):
 
     if self.email_tag_filter_strategy == const.EXCLUDE_IGNORED:
 
-        ignored_tags = Tag.objects.filter(
-                                user_selections__reason = 'bad',
-                                user_selections__user = self
+        ignored_tag_ids = self.get_tag_preferences().get_tag_ids('bad')
+        if ignored_tag_ids:
+            questions = questions.exclude(
+                                thread__tags__id__in = ignored_tag_ids
                             )
-
-        wk = self.ignored_tags.strip().split()
-        ignored_by_wildcards = Tag.objects.get_by_wildcards(wk)
-
-        return questions.exclude(
-                        thread__tags__in = ignored_tags
-                    ).exclude(
-                        thread__tags__in = ignored_by_wildcards
-                    ).distinct()
+        return questions.distinct()
     elif self.email_tag_filter_strategy == const.INCLUDE_INTERESTING:
         if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
             reason = 'subscribed'
-            wk = self.subscribed_tags.strip().split()
         else:
             reason = 'good'
-            wk = self.interesting_tags.strip().split()
-
-        selected_tags = Tag.objects.filter(
-                                user_selections__reason = reason,
-                                user_selections__user = self
-                            )
-
-        selected_by_wildcards = Tag.objects.get_by_wildcards(wk)
-
-        tag_filter = models.Q(thread__tags__in = list(selected_tags)) \
-                    | models.Q(thread__tags__in = list(selected_by_wildcards))
 
-        return questions.filter( tag_filter ).distinct()
+        selected_tag_ids = self.get_tag_preferences().get_tag_ids(reason)
+        if len(selected_tag_ids) == 0:
+            return questions.none()
+        return questions.filter(
+                        thread__tags__id__in = selected_tag_ids
+                    ).distinct()
     else:
         return questions
 
@@ -2479,10 +2546,9 @@ def _process_vote(user, post, timestamp=None, cancel=False, vote_type=None):
     """
     #get or create the vote object
     #return with noop in some situations
-    try:
-        vote = Vote.objects.get(user = user, voted_post=post)
-    except Vote.DoesNotExist:
-        vote = None
+    vote = user.get_old_vote_for_post(post)
+    #the vote preloaded with the post will be stale
+    post.voter_id = None
     if cancel:
         if vote == None:
             return
@@ -2526,6 +2592,7 @@ def _process_vote(user, post, timestamp=None, cancel=False, vote_type=None):
         post.thread.points = post.points
         post.thread.save()
         post.thread.update_summary_html()
+        post.thread.update_listing_index()
 
     if cancel:
         return None
@@ -2744,6 +2811,8 @@ def user_update_wildcard_tag_selections(
     self.ignored_tags = ' '.join(ignored)
     self.subscribed_tags = ' '.join(subscribed)
     self.save()
+    update_wildcard_selection_index(self)
+    invalidate_user_tag_preferences(self)
     return new_tags
 
 
@@ -2828,6 +2897,7 @@ User.add_to_class('get_gravatar_url', user_get_gravatar_url)
 User.add_to_class('get_or_create_fake_user', user_get_or_create_fake_user)
 User.add_to_class('get_marked_tags', user_get_marked_tags)
 User.add_to_class('get_marked_tag_names', user_get_marked_tag_names)
+User.add_to_class('get_tag_preferences', user_get_tag_preferences)
 User.add_to_class('get_groups', user_get_groups)
 User.add_to_class('get_foreign_groups', user_get_foreign_groups)
 User.add_to_class('get_group_membership', user_get_group_membership)
@@ -2945,6 +3015,7 @@ User.add_to_class('assert_can_delete_post', user_assert_can_delete_post)
 User.add_to_class('assert_can_restore_post', user_assert_can_restore_post)
 User.add_to_class('assert_can_delete_comment', user_assert_can_delete_comment)
 User.add_to_class('assert_can_edit_comment', user_assert_can_edit_comment)
+User.add_to_class('get_comment_permissions', user_get_comment_permissions)
 User.add_to_class('assert_can_delete_answer', user_assert_can_delete_answer)
 User.add_to_class('assert_can_delete_question', user_assert_can_delete_question)
 User.add_to_class('assert_can_accept_best_answer', user_assert_can_accept_best_answer)
@@ -2958,6 +3029,215 @@ User.add_to_class(
 )
 
 #todo: move this to askbot/mail ?
+class InstantNotificationRenderer(object):
+    """renders instant notifications about the update
+    of the post for many recipients.
+
+    The template is rendered, urls absolutized and the plain
+    text extracted once per update, with placeholders in place
+    of the parts that differ between the recipients.
+    For each recipient only the placeholders are replaced.
+    The thread summary is rendered once per each set
+    of the thread posts visible to the recipients.
+
+    Only update_types in const.RESPONSE_ACTIVITY_TYPE_MAP_FOR_TEMPLATES
+    are supported.
+    """
+
+    def __init__(
+                self,
+                from_user = None,
+                post = None,
+                update_type = None,
+                template = None
+            ):
+        if update_type == 'question_comment':
+            assert(isinstance(post, Post) and post.is_comment())
+            assert(post.parent and post.parent.is_question())
+        elif update_type == 'answer_comment':
+            assert(isinstance(post, Post) and post.is_comment())
+            assert(post.parent and post.parent.is_answer())
+        elif update_type == 'answer_update':
+            assert(isinstance(post, Post) and post.is_answer())
+        elif update_type == 'new_answer':
+            assert(isinstance(post, Post) and post.is_answer())
+        elif update_type == 'question_update':
+            assert(isinstance(post, Post) and post.is_question())
+        elif update_type == 'new_question':
+            assert(isinstance(post, Post) and post.is_question())
+        elif update_type == 'post_shared':
+            pass
+        else:
+            raise ValueError('unexpected update_type %s' % update_type)
+
+        self.post = post
+        self.update_type = update_type
+        self.template = template
+        self.site_url = askbot_settings.APP_URL
+        self.origin_post = post.get_origin_post()
+
+        #placeholders of the per-recipient parts
+        token = uuid.uuid4().hex
+        self.thread_summary_token = 'thread-summary-' + token
+        self.reply_separator_token = 'reply-separator-' + token
+        self.reply_address_token = 'reply-address-' + token
+        self.subscriptions_url_token = 'subscriptions-url-' + token
+
+        if update_type.endswith('update'):
+            assert('comment' not in update_type)
+            revisions = post.revisions.all()[:2]
+            assert(len(revisions) == 2)
+            content_preview = htmldiff(
+                    sanitize_html(revisions[1].html),
+                    sanitize_html(revisions[0].html),
+                    ins_start = '<b><u style="background-color:#cfc">',
+                    ins_end = '</u></b>',
+                    del_start = '<del style="color:#600;background-color:#fcc">',
+                    del_end = '</del>'
+                )
+            #todo: remove hardcoded style
+        else:
+            content_preview = post.format_for_email(is_leaf_post = True)
+
+        #add indented summaries for the parent posts
+        content_preview += post.format_for_email_as_parent_thread_summary()
+
+        content_preview += '<p>======= Full thread summary =======</p>'
+
+        #the placeholder is on a separate line, so that
+        #it is a separate phrase in the plain text
+        content_preview += '\n%s\n' % self.thread_summary_token
+        self.content_preview = content_preview
+
+        if update_type == 'post_shared':
+            user_action = _('%(user)s shared a %(post_link)s.')
+        elif post.is_comment():
+            if update_type.endswith('update'):
+                user_action = _('%(user)s edited a %(post_link)s.')
+            else:
+                user_action = _('%(user)s posted a %(post_link)s')
+        elif post.is_answer():
+            if update_type.endswith('update'):
+                user_action = _('%(user)s edited an %(post_link)s.')
+            else:
+                user_action = _('%(user)s posted an %(post_link)s.')
+        elif post.is_question():
+            if update_type.endswith('update'):
+                user_action = _('%(user)s edited a %(post_link)s.')
+            else:
+                user_action = _('%(user)s posted a %(post_link)s.')
+        else:
+            raise ValueError('unrecognized post type')
+
+        base_url = strip_path(self.site_url)
+        self.post_url = base_url + post.get_absolute_url()
+        user_url = base_url + from_user.get_absolute_url()
+        self.user_action = user_action % {
+            'user': '<a href="%s">%s</a>' % (user_url, from_user.username),
+            'post_link': '<a href="%s">%s</a>' % (self.post_url, _(post.post_type))
+            #'post_link': '%s <a href="%s">>>></a>' % (_(post.post_type), post_url)
+        }
+        self.from_user = from_user
+        self.subject_line = _('"%(title)s"') % {
+                                    'title': self.origin_post.thread.title
+                                }
+
+        self.documents = dict()#can_reply -> (html, text)
+        self.thread_summaries = dict()#post data cache key -> (html, text)
+
+    def get_document(self, can_reply):
+        """returns html and plain text of the email
+        with the placeholders"""
+        if can_reply not in self.documents:
+            update_data = {
+                'update_author_name': self.from_user.username,
+                'reply_by_email_karma_threshold': askbot_settings.MIN_REP_TO_POST_BY_EMAIL,
+                'can_reply': can_reply,
+                'content_preview': self.content_preview,#post.get_snippet()
+                'update_type': self.update_type,
+                'post_url': self.post_url,
+                'origin_post_title': self.origin_post.thread.title,
+                'user_subscriptions_url': self.subscriptions_url_token,
+                'reply_separator': self.reply_separator_token,
+                'reply_address': self.reply_address_token
+            }
+            html = absolutize_urls(self.template.render(Context(update_data)))
+            self.documents[can_reply] = (html, mail.clean_html_email(html))
+        return self.documents[can_reply]
+
+    def get_thread_summary(self, to_user):
+        """returns html and plain text of the thread summary"""
+        thread = self.post.thread
+        key = thread.get_post_data_cache_key('votes', to_user)
+        if key not in self.thread_summaries:
+            html = absolutize_urls(thread.format_for_email(user = to_user))
+            self.thread_summaries[key] = (html, mail.clean_html_email(html))
+        return self.thread_summaries[key]
+
+    def get_reply_separator(self, can_reply, alt_reply_address):
+        if can_reply:
+            reply_separator = const.SIMPLE_REPLY_SEPARATOR_TEMPLATE % \
+                        _('To reply, PLEASE WRITE ABOVE THIS LINE.')
+            if self.post.post_type == 'question' and alt_reply_address:
+                data = {
+                    'addr': alt_reply_address,
+                    'subject': urllib.quote(
+                            ('Re: ' + self.post.thread.title).encode('utf-8')
+                        )
+                }
+                reply_separator += '<p>' + \
+                    const.REPLY_WITH_COMMENT_TEMPLATE % data
+                reply_separator += '</p>'
+            else:
+                reply_separator = '<p>%s</p>' % reply_separator
+
+            reply_separator += self.user_action
+        else:
+            reply_separator = self.user_action
+        return reply_separator
+
+    def render(self, to_user = None, reply_address = None, alt_reply_address = None):
+        """returns subject line, html and plain text of the email"""
+        can_reply = to_user.can_post_by_email()
+        html, text = self.get_document(can_reply)
+
+        user_subscriptions_url = self.site_url + \
+                                reverse(
+                                    'user_subscriptions',
+                                    kwargs = {
+                                        'id': to_user.id,
+                                        'slug': slugify(to_user.username)
+                                    }
+                                )
+        reply_separator = absolutize_urls(
+                        self.get_reply_separator(can_reply, alt_reply_address)
+                    )
+        thread_summary = self.get_thread_summary(to_user)
+        if reply_address is None:
+            reply_address = ''
+        parts = (
+            (self.thread_summary_token, thread_summary),
+            (
+                self.reply_separator_token,
+                (reply_separator, mail.clean_html_email(reply_separator))
+            ),
+            (self.reply_address_token, (reply_address, reply_address)),
+            (self.subscriptions_url_token, (user_subscriptions_url, ''))
+        )
+
+        #placeholders are the whole phrases of the plain text
+        phrases = dict([(token, part[1]) for token, part in parts])
+        text = '\n\n'.join(
+            [
+                phrases.get(phrase, phrase) for phrase in text.split('\n\n')
+                if phrases.get(phrase, phrase)
+            ]
+        )
+        for token, part in parts:
+            html = html.replace(token, part[0])
+        return self.subject_line, html, text
+
+
 def format_instant_notification_email(
                                         to_user = None,
                                         from_user = None,
@@ -2973,131 +3253,20 @@ def format_instant_notification_email(
 
     that is built when post is updated
     only update_types in const.RESPONSE_ACTIVITY_TYPE_MAP_FOR_TEMPLATES
-    are supported
+    are supported, to format notification for many
+    users use :class:`InstantNotificationRenderer`
     """
-    site_url = askbot_settings.APP_URL
-    origin_post = post.get_origin_post()
-    #todo: create a better method to access "sub-urls" in user views
-    user_subscriptions_url = site_url + \
-                                reverse(
-                                    'user_subscriptions',
-                                    kwargs = {
-                                        'id': to_user.id,
-                                        'slug': slugify(to_user.username)
-                                    }
-                                )
-
-    if update_type == 'question_comment':
-        assert(isinstance(post, Post) and post.is_comment())
-        assert(post.parent and post.parent.is_question())
-    elif update_type == 'answer_comment':
-        assert(isinstance(post, Post) and post.is_comment())
-        assert(post.parent and post.parent.is_answer())
-    elif update_type == 'answer_update':
-        assert(isinstance(post, Post) and post.is_answer())
-    elif update_type == 'new_answer':
-        assert(isinstance(post, Post) and post.is_answer())
-    elif update_type == 'question_update':
-        assert(isinstance(post, Post) and post.is_question())
-    elif update_type == 'new_question':
-        assert(isinstance(post, Post) and post.is_question())
-    elif update_type == 'post_shared':
-        pass
-    else:
-        raise ValueError('unexpected update_type %s' % update_type)
-
-    if update_type.endswith('update'):
-        assert('comment' not in update_type)
-        revisions = post.revisions.all()[:2]
-        assert(len(revisions) == 2)
-        content_preview = htmldiff(
-                sanitize_html(revisions[1].html),
-                sanitize_html(revisions[0].html),
-                ins_start = '<b><u style="background-color:#cfc">',
-                ins_end = '</u></b>',
-                del_start = '<del style="color:#600;background-color:#fcc">',
-                del_end = '</del>'
-            )
-        #todo: remove hardcoded style
-    else:
-        content_preview = post.format_for_email(is_leaf_post = True)
-
-    #add indented summaries for the parent posts
-    content_preview += post.format_for_email_as_parent_thread_summary()
-
-    content_preview += '<p>======= Full thread summary =======</p>'
-
-    content_preview += post.thread.format_for_email(user=to_user)
-
-    if update_type == 'post_shared':
-        user_action = _('%(user)s shared a %(post_link)s.')
-    elif post.is_comment():
-        if update_type.endswith('update'):
-            user_action = _('%(user)s edited a %(post_link)s.')
-        else:
-            user_action = _('%(user)s posted a %(post_link)s')
-    elif post.is_answer():
-        if update_type.endswith('update'):
-            user_action = _('%(user)s edited an %(post_link)s.')
-        else:
-            user_action = _('%(user)s posted an %(post_link)s.')
-    elif post.is_question():
-        if update_type.endswith('update'):
-            user_action = _('%(user)s edited a %(post_link)s.')
-        else:
-            user_action = _('%(user)s posted a %(post_link)s.')
-    else:
-        raise ValueError('unrecognized post type')
-
-    base_url = strip_path(site_url)
-    post_url = base_url + post.get_absolute_url()
-    user_url = base_url + from_user.get_absolute_url()
-    user_action = user_action % {
-        'user': '<a href="%s">%s</a>' % (user_url, from_user.username),
-        'post_link': '<a href="%s">%s</a>' % (post_url, _(post.post_type))
-        #'post_link': '%s <a href="%s">>>></a>' % (_(post.post_type), post_url)
-    }
-
-    can_reply = to_user.can_post_by_email()
-
-    if can_reply:
-        reply_separator = const.SIMPLE_REPLY_SEPARATOR_TEMPLATE % \
-                    _('To reply, PLEASE WRITE ABOVE THIS LINE.')
-        if post.post_type == 'question' and alt_reply_address:
-            data = {
-                'addr': alt_reply_address,
-                'subject': urllib.quote(
-                        ('Re: ' + post.thread.title).encode('utf-8')
-                    )
-            }
-            reply_separator += '<p>' + \
-                const.REPLY_WITH_COMMENT_TEMPLATE % data
-            reply_separator += '</p>'
-        else:
-            reply_separator = '<p>%s</p>' % reply_separator
-
-        reply_separator += user_action
-    else:
-        reply_separator = user_action
-
-    update_data = {
-        'update_author_name': from_user.username,
-        'receiving_user_name': to_user.username,
-        'receiving_user_karma': to_user.reputation,
-        'reply_by_email_karma_threshold': askbot_settings.MIN_REP_TO_POST_BY_EMAIL,
-        'can_reply': can_reply,
-        'content_preview': content_preview,#post.get_snippet()
-        'update_type': update_type,
-        'post_url': post_url,
-        'origin_post_title': origin_post.thread.title,
-        'user_subscriptions_url': user_subscriptions_url,
-        'reply_separator': reply_separator,
-        'reply_address': reply_address
-    }
-    subject_line = _('"%(title)s"') % {'title': origin_post.thread.title}
-
-    content = template.render(Context(update_data))
-
+    renderer = InstantNotificationRenderer(
+                                from_user = from_user,
+                                post = post,
+                                update_type = update_type,
+                                template = template
+                            )
+    subject_line, content, text = renderer.render(
+                                to_user = to_user,
+                                reply_address = reply_address,
+                                alt_reply_address = alt_reply_address
+                            )
     return subject_line, content
 
 def get_reply_to_addresses(user, post):
@@ -3116,32 +3285,42 @@ def get_reply_to_addresses(user, post):
     "comment" or "answer", the address will be for posting
     a "comment".
     """
-    #these variables will contain return values
-    primary_addr = django_settings.DEFAULT_FROM_EMAIL
-    secondary_addr = None
-    if user.can_post_by_email():
-        if user.reputation >= askbot_settings.MIN_REP_TO_POST_BY_EMAIL:
-
-            reply_args = {
-                'post': post,
-                'user': user,
-                'reply_action': 'post_comment'
-            }
-            if post.post_type in ('answer', 'comment'):
-                reply_args['reply_action'] = 'post_comment'
-            elif post.post_type == 'question':
-                reply_args['reply_action'] = 'post_answer'
-
-            primary_addr = ReplyAddress.objects.create_new(
-                                                    **reply_args
-                                                ).as_email_address()
+    return get_reply_to_addresses_for_users([user], post)[user.id]
+
+def get_reply_to_addresses_for_users(users, post):
+    """same as :func:`get_reply_to_addresses` for many users,
+    returns dictionary user id -> pair of addresses,
+    the reply address records are created with one insert"""
+    addresses = dict()
+    records = list()
+    if post.post_type == 'question':
+        reply_action = 'post_answer'
+    else:
+        reply_action = 'post_comment'
+    for user in users:
+        addresses[user.id] = (django_settings.DEFAULT_FROM_EMAIL, None)
+        if user.can_post_by_email():
+            if user.reputation >= askbot_settings.MIN_REP_TO_POST_BY_EMAIL:
+                records.append(
+                    {'post': post, 'user': user, 'reply_action': reply_action}
+                )
+                if post.post_type == 'question':
+                    records.append(
+                        {'post': post, 'user': user, 'reply_action': 'post_comment'}
+                    )
 
-            if post.post_type == 'question':
-                reply_args['reply_action'] = 'post_comment'
-                secondary_addr = ReplyAddress.objects.create_new(
-                                                    **reply_args
-                                                ).as_email_address()
-    return primary_addr, secondary_addr
+    if records:
+        reply_addresses = ReplyAddress.objects.create_many(records)
+        primary = dict()
+        secondary = dict()
+        for reply_address in reply_addresses:
+            if reply_address.reply_action == reply_action:
+                primary[reply_address.user_id] = reply_address.as_email_address()
+            else:
+                secondary[reply_address.user_id] = reply_address.as_email_address()
+        for user_id, primary_addr in primary.items():
+            addresses[user_id] = (primary_addr, secondary.get(user_id))
+    return addresses
 
 
 def notify_author_of_published_revision(
@@ -3277,23 +3456,259 @@ def record_answer_accepted(instance, created, **kwargs):
                                 )
         activity.add_recipients(recipients)
 
+LAST_VISIT_CACHE_KEY_TPL = 'user-last-visit-%d'
+
+last_seen_buffer = WriteBehindBuffer('user-last-seen')
+
+def get_previous_visit(user):
+    """returns time of the previous visit of the user,
+    ``user.last_seen`` is saved to the database with a delay
+    and may be older than that"""
+    record = cache.cache.get(LAST_VISIT_CACHE_KEY_TPL % user.id)
+    if record:
+        saved_last_seen, last_visit = record
+        #record is valid only if made for the same saved value,
+        #some databases drop the microseconds
+        if saved_last_seen and user.last_seen \
+            and abs(saved_last_seen - user.last_seen) < datetime.timedelta(seconds=1):
+            return last_visit
+    return user.last_seen
+
+def update_values_by_id(model, column, values):
+    """sets different values of the ``column``
+    in many rows with one query,
+    ``values`` is a dictionary of row id -> value"""
+    quote_name = connection.ops.quote_name
+    whens = list()
+    params = list()
+    for row_id, value in values.items():
+        whens.append('WHEN %s THEN %s')
+        params.extend([row_id, value])
+    params.extend(values.keys())
+    sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                quote_name(model._meta.db_table),
+                quote_name(column),
+                quote_name('id'),
+                ' '.join(whens),
+                quote_name('id'),
+                ', '.join(['%s'] * len(values))
+            )
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+def flush_last_seen():
+    """saves buffered times of the user visits
+    with one multi-row update,
+    returns number of the updated users"""
+    visits = last_seen_buffer.take()
+    if not visits:
+        return 0
+
+    update_values_by_id(User, 'last_seen', visits)
+
+    records = dict()
+    for user_id, timestamp in visits.items():
+        records[LAST_VISIT_CACHE_KEY_TPL % user_id] = (timestamp, timestamp)
+    cache.cache.set_many(records, const.LONG_TIME)
+    return len(visits)
+
+#number of question visits saved together
+QUESTION_VISIT_BATCH_SIZE = 100
+
+question_visits_buffer = WriteBehindBuffer('question-visits')
+
+def save_question_views(views):
+    """updates or creates ``QuestionView`` records,
+    ``views`` is a dictionary of (user id, question id) -> timestamp"""
+    user_ids = set([user_id for user_id, question_id in views])
+    question_ids = set([question_id for user_id, question_id in views])
+    saved_views = QuestionView.objects.filter(
+                            who__in = user_ids,
+                            question__in = question_ids
+                        ).values_list('id', 'who', 'question')
+    updated_views = dict()
+    saved_pairs = set()
+    for view_id, user_id, question_id in saved_views:
+        if (user_id, question_id) in views:
+            updated_views[view_id] = views[(user_id, question_id)]
+            saved_pairs.add((user_id, question_id))
+    if updated_views:
+        update_values_by_id(QuestionView, 'when', updated_views)
+
+    bulk_create(QuestionView, [
+        QuestionView(who_id = user_id, question_id = question_id, when = timestamp)
+        for (user_id, question_id), timestamp in views.items()
+        if (user_id, question_id) not in saved_pairs
+    ])
+
+def clear_question_responses(visits):
+    """marks notifications about the responses and mentions
+    in the visited questions as seen, for the moderators - also
+    the notifications about the flagged posts,
+    ``visits`` - list of (user id, question id) pairs,
+    returns dictionary of user id -> number of the responses marked as seen
+    """
+    RESPONSE_TYPES = const.RESPONSE_ACTIVITY_TYPES_FOR_DISPLAY
+    RESPONSE_TYPES += (const.TYPE_ACTIVITY_MENTION,)
+    FLAG_TYPE = const.TYPE_ACTIVITY_MARK_OFFENSIVE
+
+    user_ids = set([user_id for user_id, question_id in visits])
+    question_ids = set([question_id for user_id, question_id in visits])
+    audit_records = ActivityAuditStatus.objects.filter(
+                        user__in = user_ids,
+                        status = ActivityAuditStatus.STATUS_NEW,
+                        activity__question__in = question_ids,
+                        activity__activity_type__in = RESPONSE_TYPES + (FLAG_TYPE,)
+                    ).values_list(
+                        'id', 'user', 'activity__question', 'activity__activity_type'
+                    )
+    visits = set(visits)
+    audit_records = [record for record in audit_records if record[1:3] in visits]
+
+    #the admin response counts are not denormalized b/c they are easy to obtain
+    flag_user_ids = set([
+        record[1] for record in audit_records if record[3] == FLAG_TYPE
+    ])
+    moderator_ids = set()
+    if flag_user_ids:
+        for user in User.objects.filter(id__in = flag_user_ids).only(
+                                'id', 'status', 'is_superuser', 'is_staff'
+                            ):
+            if user.is_moderator() or user.is_administrator():
+                moderator_ids.add(user.id)
+
+    seen_record_ids = list()
+    cleared_counts = dict()
+    for record_id, user_id, question_id, activity_type in audit_records:
+        if activity_type == FLAG_TYPE:
+            if user_id in moderator_ids:
+                seen_record_ids.append(record_id)
+        else:
+            seen_record_ids.append(record_id)
+            cleared_counts[user_id] = cleared_counts.get(user_id, 0) + 1
+
+    if seen_record_ids:
+        ActivityAuditStatus.objects.filter(
+            id__in = seen_record_ids
+        ).update(
+            status = ActivityAuditStatus.STATUS_SEEN
+        )
+    return cleared_counts
+
+def record_question_visits(visits):
+    """saves visits of the questions given as
+    (user id, question id, timestamp) tuples - in batches:
+    updates or creates ``QuestionView`` records,
+    marks notifications about the responses in the questions as seen
+    and adjusts the response counts of the users,
+    returns dictionary of user id -> number of the responses marked as seen
+    """
+    latest_visits = dict()
+    for user_id, question_id, timestamp in visits:
+        key = (user_id, question_id)
+        if key not in latest_visits or latest_visits[key] < timestamp:
+            latest_visits[key] = timestamp
+
+    keys = latest_visits.keys()
+    cleared_counts = dict()
+    for start in range(0, len(keys), QUESTION_VISIT_BATCH_SIZE):
+        batch = keys[start:start + QUESTION_VISIT_BATCH_SIZE]
+        save_question_views(dict([(key, latest_visits[key]) for key in batch]))
+        for user_id, count in clear_question_responses(batch).items():
+            cleared_counts[user_id] = cleared_counts.get(user_id, 0) + count
+
+    user_ids_by_count = dict()
+    for user_id, count in cleared_counts.items():
+        user_ids_by_count.setdefault(count, list()).append(user_id)
+    for count, user_ids in user_ids_by_count.items():
+        User.objects.filter(id__in = user_ids).update(
+            new_response_count = models.F('new_response_count') - count,
+            seen_response_count = models.F('seen_response_count') + count
+        )
+    return cleared_counts
+
+def flush_question_visits():
+    """saves buffered question visits,
+    returns number of the saved visits"""
+    visits = question_visits_buffer.take()
+    #the visits buffered while the flush was due are
+    #saved by the next flush, scheduled right here
+    question_visits_buffer.reset_flush_due()
+    if not question_visits_buffer.is_empty():
+        schedule_question_visits_flush()
+    if not visits:
+        return 0
+    record_question_visits([
+        map(int, key.split(':')) + [timestamp]
+        for key, timestamp in visits.items()
+    ])
+    return len(visits)
+
+def schedule_question_visits_flush():
+    """starts the celery task saving the buffered visits
+    in ``QUESTION_VISIT_FLUSH_INTERVAL`` seconds,
+    unless it is already scheduled
+    """
+    interval = askbot_settings.QUESTION_VISIT_FLUSH_INTERVAL
+    if question_visits_buffer.is_flush_due(interval):
+        from askbot.tasks import flush_question_visits_celery_task
+        flush_question_visits_celery_task.apply_async(countdown = interval)
+
+def save_question_visit(user, question, timestamp = None):
+    """records visit of the question by the user,
+    with ``QUESTION_VISIT_FLUSH_INTERVAL`` > 0 the visits
+    are saved in batches by a delayed celery task"""
+    if timestamp is None:
+        timestamp = datetime.datetime.now()
+    interval = askbot_settings.QUESTION_VISIT_FLUSH_INTERVAL
+    if interval > 0 and can_buffer() \
+            and not django_settings.CELERY_ALWAYS_EAGER:
+        question_visits_buffer.set('%d:%d' % (user.id, question.id), timestamp)
+        schedule_question_visits_flush()
+    else:
+        user.visit_question(question, timestamp)
+
 def record_user_visit(user, timestamp, **kwargs):
     """
     when user visits any pages, we update the last_seen and
     consecutive_days_visit_count
+
+    with ``LAST_SEEN_UPDATE_INTERVAL`` > 0 the last_seen is
+    saved in batches, except on the next day visit
     """
-    prev_last_seen = user.last_seen or datetime.datetime.now()
+    saved_last_seen = user.last_seen
+    prev_last_seen = get_previous_visit(user) or datetime.datetime.now()
     user.last_seen = timestamp
-    if (user.last_seen - prev_last_seen).days == 1:
+    is_next_day_visit = (user.last_seen - prev_last_seen).days == 1
+    if is_next_day_visit:
         user.consecutive_days_visit_count += 1
+        #saved right away, the badge may be evaluated later
+        User.objects.filter(id = user.id).update(
+            last_seen = timestamp,
+            consecutive_days_visit_count = user.consecutive_days_visit_count
+        )
+        saved_last_seen = timestamp
         award_badges_signal.send(None,
             event = 'site_visit',
             actor = user,
             context_object = user,
             timestamp = timestamp
         )
-    #somehow it saves on the query as compared to user.save()
-    User.objects.filter(id = user.id).update(last_seen = timestamp)
+
+    interval = askbot_settings.LAST_SEEN_UPDATE_INTERVAL
+    if interval > 0 and can_buffer():
+        cache.cache.set(
+            LAST_VISIT_CACHE_KEY_TPL % user.id,
+            (saved_last_seen, timestamp),
+            const.LONG_TIME
+        )
+        last_seen_buffer.set(user.id, timestamp)
+        if last_seen_buffer.is_flush_due(interval):
+            flush_last_seen()
+    elif not is_next_day_visit:
+        #somehow it saves on the query as compared to user.save()
+        User.objects.filter(id = user.id).update(last_seen = timestamp)
 
 
 def record_vote(instance, created, **kwargs):
@@ -3314,6 +3729,7 @@ def record_vote(instance, created, **kwargs):
                     )
         #todo: problem cannot access receiving user here
         activity.save()
+        update_used_votes_count(instance, 1)
 
 
 def record_cancel_vote(instance, **kwargs):
@@ -3328,6 +3744,7 @@ def record_cancel_vote(instance, **kwargs):
                 )
     #todo: same problem - cannot access receiving user here
     activity.save()
+    update_used_votes_count(instance, -1)
 
 
 #todo: weird that there is no record delete answer or comment
@@ -3625,6 +4042,9 @@ if 'avatar' in django_settings.INSTALLED_APPS:
     django_signals.post_delete.connect(update_user_avatar_type_flag, sender=Avatar)
 
 django_signals.post_delete.connect(record_cancel_vote, sender=Vote)
+django_signals.post_save.connect(update_tag_name_map, sender=Tag)
+django_signals.post_delete.connect(update_tag_name_map, sender=Tag)
+django_signals.pre_delete.connect(forget_tag_selections, sender=Tag)
 
 #change this to real m2m_changed with Django1.2
 signals.delete_question_or_answer.connect(record_delete_question, sender=Post)
@@ -3663,6 +4083,7 @@ __all__ = [
         'Vote',
         'PostFlagReason',
         'MarkedTag',
+        'WildcardTagSelection',
 
         'BadgeData',
         'Award',
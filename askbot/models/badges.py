@@ -18,17 +18,24 @@ corresponding event name, actor (user object), context_object and optionally
 - timestamp
 """
 import datetime
+from django.conf import settings as django_settings
+from django.contrib.auth.models import User
+from django.db.models import Count, F, Max, Min
 from django.template.defaultfilters import slugify
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
 from django.dispatch import Signal
-from askbot.models.repute import BadgeData, Award
-from askbot.models.user import Activity
+from askbot.models.base import bulk_create
+from askbot.models.repute import BadgeData, Award, Vote
+from askbot.models.user import Activity, ActivityAuditStatus
 from askbot.models.question import FavoriteQuestion as Fave#name collision
+from askbot.models.question import Thread
 from askbot.models.post import Post
+from askbot.models.tag import Tag
 from askbot import const
 from askbot.conf import settings as askbot_settings
 from askbot.utils.decorators import auto_now_timestamp
+from askbot.utils.write_behind import WriteBehindBuffer, can_buffer
 
 class Badge(object):
     """base class for the badges
@@ -123,6 +130,58 @@ class Badge(object):
         """
         return self.award(actor, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        """returns model of the context objects and
+        an iterable of (recipient id, context object id) pairs
+        for all objects that deserve the badge, used to recompute
+        the badges in bulk, with a few queries,
+
+        badges that can't be recomputed return None
+        """
+        return None
+
+    def recompute(self, dry_run = False, timestamp = None):
+        """awards the badge to all eligible recipients
+        who don't have it yet, see ``get_eligible_awards``,
+        returns number of the new awards or None
+        if the badge can't be recomputed
+        """
+        eligible_awards = self.get_eligible_awards()
+        if eligible_awards is None:
+            return None
+
+        model, pairs = eligible_awards
+        content_type = ContentType.objects.get_for_model(model)
+        badge = self.get_stored_data()
+        awards = Award.objects.filter(badge = badge)
+        if self.multiple:
+            awarded = set(
+                awards.filter(
+                    content_type = content_type
+                ).values_list('user', 'object_id')
+            )
+        else:
+            awarded = set(awards.values_list('user', flat = True))
+
+        new_awards = list()
+        #single badge is given for the earliest object
+        for recipient_id, object_id in sorted(pairs, key = lambda pair: pair[1]):
+            if recipient_id is None:
+                continue
+            if self.multiple:
+                key = (recipient_id, object_id)
+            else:
+                key = recipient_id
+            if key not in awarded:
+                awarded.add(key)
+                new_awards.append((recipient_id, object_id))
+
+        if new_awards and not dry_run:
+            award_in_bulk(
+                badge, self.level, content_type, new_awards, timestamp
+            )
+        return len(new_awards)
+
 class Disciplined(Badge):
     def __init__(self):
         description = _(
@@ -145,6 +204,14 @@ class Disciplined(Badge):
             askbot_settings.DISCIPLINED_BADGE_MIN_UPVOTES:
             return self.award(actor, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        posts = Post.objects.filter(
+                    deleted = True,
+                    deleted_by = F('author'),
+                    points__gte = askbot_settings.DISCIPLINED_BADGE_MIN_UPVOTES
+                )
+        return Post, posts.values_list('author', 'id')
+
 class PeerPressure(Badge):
     def __init__(self):
         description = _(
@@ -168,6 +235,15 @@ class PeerPressure(Badge):
             return self.award(actor, context_object, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        min_downvotes = askbot_settings.PEER_PRESSURE_BADGE_MIN_DOWNVOTES
+        posts = Post.objects.filter(
+                    deleted = True,
+                    deleted_by = F('author'),
+                    points__lte = -1 * min_downvotes
+                )
+        return Post, posts.values_list('author', 'id')
+
 class Teacher(Badge):
     def __init__(self):
         description = _(
@@ -190,6 +266,14 @@ class Teacher(Badge):
             return self.award(context_object.author, context_object, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        answers = Post.objects.filter(
+                    post_type = 'answer',
+                    deleted = False,
+                    points__gte = askbot_settings.TEACHER_BADGE_MIN_UPVOTES
+                )
+        return Post, answers.values_list('author', 'id')
+
 class FirstVote(Badge):
     """this badge is not awarded directly, but through
     Supporter and Critic, which must provide
@@ -210,6 +294,14 @@ class FirstVote(Badge):
             return False
         return self.award(actor, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        votes = Vote.objects.filter(
+                    vote = self.vote,
+                    voted_post__post_type__in = ('question', 'answer')
+                )
+        votes = votes.values_list('user').annotate(first_post = Min('voted_post'))
+        return Post, votes.order_by()
+
 class Supporter(FirstVote):
     """first upvote"""
     def __new__(cls):
@@ -217,6 +309,7 @@ class Supporter(FirstVote):
         self.key = 'supporter'
         self.name = _('Supporter')
         self.description = _('First upvote')
+        self.vote = Vote.VOTE_UP
         return self
 
 class Critic(FirstVote):
@@ -226,6 +319,7 @@ class Critic(FirstVote):
         self.key = 'critic'
         self.name = _('Critic')
         self.description = _('First downvote')
+        self.vote = Vote.VOTE_DOWN
         return self
 
 class CivicDuty(Badge):
@@ -247,6 +341,15 @@ class CivicDuty(Badge):
         if actor.votes.count() == askbot_settings.CIVIC_DUTY_BADGE_MIN_VOTES:
             return self.award(actor, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        votes = Vote.objects.values('user').annotate(
+                    vote_count = Count('id'),
+                    last_post = Max('voted_post')
+                ).filter(
+                    vote_count__gte = askbot_settings.CIVIC_DUTY_BADGE_MIN_VOTES
+                ).order_by()
+        return Post, [(vote['user'], vote['last_post']) for vote in votes]
+
 class SelfLearner(Badge):
     def __init__(self):
         description = _('Answered own question with at least %(num)s up votes')
@@ -271,6 +374,16 @@ class SelfLearner(Badge):
         if question.author == answer.author and answer.points >= min_upvotes:
             self.award(context_object.author, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        answers = Post.objects.filter(
+                    post_type = 'answer',
+                    deleted = False,
+                    points__gte = askbot_settings.SELF_LEARNER_BADGE_MIN_UPVOTES,
+                    thread__posts__post_type = 'question',
+                    thread__posts__author = F('author')
+                )
+        return Post, answers.values_list('author', 'id')
+
 class QualityPost(Badge):
     """Generic Badge for Nice/Good/Great Question or Answer
     this badge is not used directly but is instantiated
@@ -298,6 +411,14 @@ class QualityPost(Badge):
             return self.award(context_object.author, context_object, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        posts = Post.objects.filter(
+                    post_type = self.post_type,
+                    deleted = False,
+                    points__gte = self.min_votes
+                )
+        return Post, posts.values_list('author', 'id')
+
 class NiceAnswer(QualityPost):
     def __new__(cls):
         self = super(NiceAnswer, cls).__new__(cls)
@@ -408,6 +529,14 @@ class FrequentedQuestion(Badge):
             return self.award(context_object.author, context_object, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        questions = Post.objects.filter(
+                    post_type = 'question',
+                    deleted = False,
+                    thread__view_count__gte = self.min_views
+                )
+        return Post, questions.values_list('author', 'id')
+
 class PopularQuestion(FrequentedQuestion):
     def __new__(cls):
         self = super(PopularQuestion, cls).__new__(cls)
@@ -465,6 +594,13 @@ class Scholar(Badge):
             return False
         return self.award(actor, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        questions = Post.objects.filter(
+                    post_type = 'question',
+                    thread__accepted_answer__isnull = False
+                )
+        return Post, questions.values_list('author', 'thread__accepted_answer')
+
 class VotedAcceptedAnswer(Badge):
     """superclass for Enlightened and Guru badges
     not awarded directly
@@ -488,6 +624,14 @@ class VotedAcceptedAnswer(Badge):
         if answer.points >= self.min_votes and answer.accepted():
             return self.award(answer.author, answer, timestamp)
 
+    def get_eligible_awards(self):
+        threads = Thread.objects.filter(
+                    accepted_answer__points__gte = self.min_votes
+                )
+        return Post, threads.values_list(
+                            'accepted_answer__author', 'accepted_answer'
+                        )
+
 class Enlightened(VotedAcceptedAnswer):
     def __new__(cls):
         self = super(Enlightened, cls).__new__(cls)
@@ -541,6 +685,19 @@ class Necromancer(Badge):
             return self.award(answer.author, answer, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        delta = datetime.timedelta(askbot_settings.NECROMANCER_BADGE_MIN_DELAY)
+        answers = Post.objects.filter(
+                    post_type = 'answer',
+                    deleted = False,
+                    points__gte = askbot_settings.NECROMANCER_BADGE_MIN_UPVOTES
+                ).values_list('author', 'id', 'added_at', 'thread__added_at')
+        return Post, [
+            (author_id, answer_id)
+            for author_id, answer_id, answered_at, asked_at in answers
+            if answered_at - asked_at >= delta
+        ]
+
 class CitizenPatrol(Badge):
     def __init__(self):
         super(CitizenPatrol, self).__init__(
@@ -551,6 +708,13 @@ class CitizenPatrol(Badge):
             description = _('First flagged post')
         )
 
+    def get_eligible_awards(self):
+        flags = Activity.objects.filter(
+                    activity_type = const.TYPE_ACTIVITY_MARK_OFFENSIVE
+                )
+        flags = flags.values_list('user').annotate(first_post = Min('object_id'))
+        return Post, flags.order_by()
+
 class Cleanup(Badge):
     """This badge is inactive right now.
     to make it live we need to be able to either
@@ -605,6 +769,21 @@ class EditorTypeBadge(Badge):
         if Activity.objects.filter(**filters).count() == self.min_edits:
             return self.award(actor, context_object, timestamp)
 
+    def get_eligible_awards(self):
+        atypes = (
+            const.TYPE_ACTIVITY_UPDATE_QUESTION,
+            const.TYPE_ACTIVITY_UPDATE_ANSWER
+        )
+        edits = Activity.objects.filter(
+                    activity_type__in = atypes
+                ).values('user').annotate(
+                    edit_count = Count('id'),
+                    last_post = Max('object_id')
+                ).filter(
+                    edit_count__gte = self.min_edits
+                ).order_by()
+        return Post, [(edit['user'], edit['last_post']) for edit in edits]
+
 class Editor(EditorTypeBadge):
     def __new__(cls):
         self = super(Editor, cls).__new__(cls)
@@ -637,6 +816,13 @@ class Organizer(Badge):
             description = _('First retag')
         )
 
+    def get_eligible_awards(self):
+        retags = Activity.objects.filter(
+                    activity_type = const.TYPE_ACTIVITY_UPDATE_TAGS
+                )
+        retags = retags.values_list('user').annotate(first_post = Min('object_id'))
+        return Post, retags.order_by()
+
 class Autobiographer(Badge):
     def __init__(self):
         super(Autobiographer, self).__init__(
@@ -655,6 +841,12 @@ class Autobiographer(Badge):
             return self.award(user, user, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        users = User.objects.all()
+        for field in ('email', 'real_name', 'website', 'location', 'about'):
+            users = users.exclude(**{field: ''})
+        return User, users.values_list('id', 'id')
+
 class FavoriteTypeBadge(Badge):
     """subclass must use __new__ and in addition
     must provide min_stars property for the badge
@@ -682,6 +874,27 @@ class FavoriteTypeBadge(Badge):
             return self.award(question.author, question, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        #denormalized count includes stars of the question authors,
+        #so it only narrows down the candidates
+        questions = Post.objects.filter(
+                    post_type = 'question',
+                    thread__favourite_count__gte = self.min_stars
+                ).values_list('thread', 'author', 'id')
+        questions = dict([(row[0], row[1:]) for row in questions])
+        faves = Fave.objects.filter(
+                    thread__favourite_count__gte = self.min_stars
+                ).values_list('thread', 'user')
+        star_counts = dict()
+        for thread_id, user_id in faves:
+            if thread_id in questions and user_id != questions[thread_id][0]:
+                star_counts[thread_id] = star_counts.get(thread_id, 0) + 1
+        return Post, [
+            questions[thread_id]
+            for thread_id, count in star_counts.items()
+            if count >= self.min_stars
+        ]
+
 class StellarQuestion(FavoriteTypeBadge):
     def __new__(cls):
         self = super(StellarQuestion, cls).__new__(cls)
@@ -722,6 +935,13 @@ class Enthusiast(Badge):
             return self.award(actor, context_object, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        users = User.objects.filter(
+            consecutive_days_visit_count__gte = \
+                askbot_settings.ENTHUSIAST_BADGE_MIN_DAYS
+        )
+        return User, users.values_list('id', 'id')
+
 class Commentator(Badge):
     """Commentator is a bronze badge that is
     awarded once when user posts a certain number of
@@ -744,6 +964,19 @@ class Commentator(Badge):
             return self.award(actor, context_object, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        comments = Post.objects.get_comments().values('author').annotate(
+                        comment_count = Count('id'),
+                        last_comment = Max('id')
+                    ).filter(
+                        comment_count__gte = \
+                            askbot_settings.COMMENTATOR_BADGE_MIN_COMMENTS
+                    ).order_by()
+        return Post, [
+            (comment['author'], comment['last_comment'])
+            for comment in comments
+        ]
+
 class Taxonomist(Badge):
     """Stub badge"""
     def __init__(self):
@@ -766,6 +999,12 @@ class Taxonomist(Badge):
             return self.award(tag.created_by, tag, timestamp)
         return False
 
+    def get_eligible_awards(self):
+        tags = Tag.objects.filter(
+                    used_count__gte = askbot_settings.TAXONOMIST_BADGE_MIN_USE_COUNT
+                )
+        return Tag, tags.values_list('created_by', 'id')
+
 class Expert(Badge):
     """Stub badge"""
     def __init__(self):
@@ -794,6 +1033,100 @@ extra badges from stackexchange
     (_('Alpha'), 2, _('alpha'), _('Actively participated in the private alpha'), False, 0),
 """
 
+#rows inserted with one statement
+BULK_INSERT_SIZE = 100
+
+LEVEL_COUNTERS = {
+    const.GOLD_BADGE: 'gold',
+    const.SILVER_BADGE: 'silver',
+    const.BRONZE_BADGE: 'bronze',
+}
+
+def award_in_bulk(badge, level, content_type, awards, timestamp = None):
+    """saves awards of the badge (a ``BadgeData`` object)
+    given as (recipient id, context object id) pairs,
+    together with the activities and the badge counters,
+    like ``record_award_event`` does for a single award,
+    the messages about the new badges are not sent
+    """
+    if timestamp is None:
+        timestamp = datetime.datetime.now()
+    #the new awards are found by the time, some databases drop the microseconds
+    timestamp = timestamp.replace(microsecond = 0)
+    award_type = ContentType.objects.get_for_model(Award)
+
+    for start in range(0, len(awards), BULK_INSERT_SIZE):
+        batch = awards[start:start + BULK_INSERT_SIZE]
+        last_award_id = Award.objects.aggregate(Max('id'))['id__max'] or 0
+        bulk_create(Award, [
+            Award(
+                user_id = recipient_id,
+                badge = badge,
+                content_type = content_type,
+                object_id = object_id,
+                awarded_at = timestamp
+            )
+            for recipient_id, object_id in batch
+        ])
+        #awards saved meanwhile one by one already have the activities
+        prize_activities = Activity.objects.filter(
+                                activity_type = const.TYPE_ACTIVITY_PRIZE,
+                                content_type = award_type,
+                                object_id__gt = last_award_id
+                            )
+        saved_awards = Award.objects.filter(
+                                id__gt = last_award_id,
+                                badge = badge,
+                                content_type = content_type,
+                                awarded_at = timestamp,
+                                user__in = set([award[0] for award in batch])
+                            ).exclude(
+                                id__in = prize_activities.values('object_id')
+                            ).values_list('id', 'user', 'object_id')
+        #only the awards of the batch
+        batch_awards = set(batch)
+        new_awards = [
+            (award_id, recipient_id)
+            for award_id, recipient_id, object_id in saved_awards
+            if (recipient_id, object_id) in batch_awards
+        ]
+
+        bulk_create(Activity, [
+            Activity(
+                user_id = recipient_id,
+                active_at = timestamp,
+                content_type = award_type,
+                object_id = award_id,
+                activity_type = const.TYPE_ACTIVITY_PRIZE
+            )
+            for award_id, recipient_id in new_awards
+        ])
+        activities = Activity.objects.filter(
+                                activity_type = const.TYPE_ACTIVITY_PRIZE,
+                                content_type = award_type,
+                                object_id__in = [award[0] for award in new_awards]
+                            ).values_list('id', 'user')
+        bulk_create(ActivityAuditStatus, [
+            ActivityAuditStatus(user_id = recipient_id, activity_id = activity_id)
+            for activity_id, recipient_id in activities
+        ])
+
+    BadgeData.objects.filter(id = badge.id).update(
+                        awarded_count = F('awarded_count') + len(awards)
+                    )
+    award_counts = dict()
+    for recipient_id, object_id in awards:
+        award_counts[recipient_id] = award_counts.get(recipient_id, 0) + 1
+    recipient_ids_by_count = dict()
+    for recipient_id, count in award_counts.items():
+        recipient_ids_by_count.setdefault(count, list()).append(recipient_id)
+    counter = LEVEL_COUNTERS[level]
+    for count, recipient_ids in recipient_ids_by_count.items():
+        for start in range(0, len(recipient_ids), BULK_INSERT_SIZE):
+            User.objects.filter(
+                id__in = recipient_ids[start:start + BULK_INSERT_SIZE]
+            ).update(**{counter: F(counter) + count})
+
 BADGES = {
     'strunk-and-white': AssociateEditor,#legacy slug name
     'autobiographer': Autobiographer,
@@ -893,16 +1226,106 @@ award_badges_signal = Signal(
 #event - string name of the event, e.g 'downvote'
 #context_object - database object related to the event, e.g. question
 
+#badges are evaluated later, in batches - see ``evaluate_queued_badges``
+#queued are badge keys with ids of the actor and the context object,
+#the same badge is considered once per actor and object within the batch
+badge_queue = WriteBehindBuffer('badge-evaluation-queue')
+
+BADGE_KEYS = dict([(badge, key) for key, badge in BADGES.items()])
+
+def enqueue_badges(badges, actor, context_object, timestamp):
+    """adds badges to the evaluation queue and schedules
+    the evaluation, at most once in ``BADGE_EVALUATION_DELAY`` seconds
+    """
+    content_type = ContentType.objects.get_for_model(context_object)
+    for badge in badges:
+        item = '%s:%d:%d:%d' % (
+                        BADGE_KEYS[badge],
+                        actor.id,
+                        content_type.id,
+                        context_object.id
+                    )
+        #keep time of the first event
+        badge_queue.add(item, timestamp)
+
+    schedule_badge_evaluation()
+
+def schedule_badge_evaluation():
+    """starts the celery task evaluating the queue
+    in ``BADGE_EVALUATION_DELAY`` seconds, unless it is already scheduled
+    """
+    delay = askbot_settings.BADGE_EVALUATION_DELAY
+    if badge_queue.is_flush_due(delay):
+        from askbot.tasks import evaluate_queued_badges_celery_task
+        evaluate_queued_badges_celery_task.apply_async(countdown = delay)
+
+def evaluate_queued_badges():
+    """considers awards of the queued badges,
+    actors and context objects are loaded with
+    one query per model, returns number of the evaluated badges
+    """
+    #keep time of the first event
+    items = badge_queue.take(merge = min)
+    #badges queued from now on schedule the next evaluation,
+    #the ones queued while the queue was taken - right here
+    badge_queue.reset_flush_due()
+    if not badge_queue.is_empty():
+        schedule_badge_evaluation()
+    if not items:
+        return 0
+
+    parsed_items = list()
+    object_ids = dict()
+    for item, timestamp in items.items():
+        key, actor_id, content_type_id, object_id = item.split(':')
+        actor_id, content_type_id, object_id = \
+            int(actor_id), int(content_type_id), int(object_id)
+        parsed_items.append(
+            (key, actor_id, content_type_id, object_id, timestamp)
+        )
+        object_ids.setdefault(content_type_id, set()).add(object_id)
+
+    actor_ids = set([item[1] for item in parsed_items])
+    actors = User.objects.in_bulk(list(actor_ids))
+    objects = dict()
+    for content_type_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        objects[content_type_id] = model.objects.in_bulk(list(ids))
+
+    count = 0
+    #evaluate in the order of the events
+    parsed_items.sort(key = lambda item: item[4])
+    for key, actor_id, content_type_id, object_id, timestamp in parsed_items:
+        actor = actors.get(actor_id)
+        context_object = objects[content_type_id].get(object_id)
+        if actor is None or context_object is None:
+            continue#deleted in the meantime
+        BADGES[key]().consider_award(actor, context_object, timestamp)
+        count += 1
+    return count
+
 @auto_now_timestamp
 def award_badges(event = None, actor = None,
                 context_object = None, timestamp = None, **kwargs):
-    """function that is called when signal `award_badges_signal` is sent
+    """function that is called when signal `award_badges_signal` is sent,
+    with ``BADGE_EVALUATION_DELAY`` > 0 and celery workers
+    the badges are queued and evaluated later
     """
     try:
         consider_badges = EVENTS_TO_BADGES[event]
     except KeyError:
         raise NotImplementedError('event "%s" is not implemented' % event)
 
+    if len(consider_badges) == 0:
+        return
+
+    #without the celery workers the queue would be evaluated
+    #within some later request anyway
+    if askbot_settings.BADGE_EVALUATION_DELAY > 0 and can_buffer() \
+        and not django_settings.CELERY_ALWAYS_EAGER:
+        enqueue_badges(consider_badges, actor, context_object, timestamp)
+        return
+
     for badge in consider_badges:
         badge_instance = badge()
         badge_instance.consider_award(actor, context_object, timestamp)
@@ -1,5 +1,8 @@
 import datetime
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
 
 class BaseQuerySetManager(models.Manager):
@@ -41,6 +44,43 @@ class BaseQuerySetManager(models.Manager):
             return getattr(self.get_query_set(), attr, *args)
 
 
+def bulk_create(model_class, objects):
+    """inserts the model instances with one query, like
+    ``QuerySet.bulk_create`` of django 1.4, which is used when available.
+    The primary keys of the objects are not set
+    and the post_save signals are not sent.
+    """
+    if hasattr(QuerySet, 'bulk_create'):
+        model_class._default_manager.bulk_create(objects)
+    else:
+        insert_many(model_class, objects)
+
+def insert_many(model_class, objects):
+    """inserts the objects with one ``executemany`` call,
+    for django 1.3, which has no ``QuerySet.bulk_create``"""
+    if not objects:
+        return
+    opts = model_class._meta
+    fields = [
+        field for field in opts.local_fields
+        if not isinstance(field, models.AutoField)
+    ]
+    quote_name = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        quote_name(opts.db_table),
+        ', '.join([quote_name(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields))
+    )
+    rows = list()
+    for obj in objects:
+        rows.append([
+            field.get_db_prep_save(field.pre_save(obj, True), connection)
+            for field in fields
+        ])
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+
 class DraftContent(models.Model):
     """Base class for AnonymousQuestion and AnonymousAnswer"""
     session_key = models.CharField(max_length=40)  #session id for anonymous questions
@@ -10,10 +10,12 @@ from django.utils import html
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import urlresolvers
+from django.db import connection
 from django.db import models
 from django.utils import html as html_utils
 from django.utils.translation import ugettext as _
 from django.utils.http import urlquote as django_urlquote
+from django.utils.datastructures import SortedDict
 from django.core import exceptions as django_exceptions
 from django.core import cache
 from django.core.exceptions import ValidationError
@@ -28,8 +30,9 @@ from askbot.models.user import Activity
 from askbot.models.user import EmailFeedSetting
 from askbot.models.user import Group
 from askbot.models.user import GroupMembership
+from askbot.models.user import find_mentions
 from askbot.models.tag import Tag, MarkedTag
-from askbot.models.tag import tags_match_some_wildcard
+from askbot.models.tag import get_wildcard_selector_ids
 from askbot.conf import settings as askbot_settings
 from askbot import exceptions
 from askbot.utils import markup
@@ -67,6 +70,34 @@ class PostQuerySet(models.query.QuerySet):
         else:
             return self
 
+    def get_for_voting(self, user):
+        """returns query set of posts with the authors and threads
+        and with the id of the vote of the user on each post
+        (attribute ``user_vote_id``, None if there is no vote),
+        all loaded with one query,
+        see :meth:`~askbot.models.User.get_old_vote_for_post`
+        """
+        from askbot.models.repute import Vote
+        qn = connection.ops.quote_name
+        vote_table = qn(Vote._meta.db_table)
+        vote_query = 'SELECT %(vote)s.%(id)s FROM %(vote)s ' + \
+                    'WHERE %(vote)s.%(post_id)s = %(post)s.%(id)s ' + \
+                    'AND %(vote)s.%(user_id)s = %%s'
+        vote_query = vote_query % {
+                        'vote': vote_table,
+                        'post': qn(self.model._meta.db_table),
+                        'id': qn('id'),
+                        'post_id': qn('voted_post_id'),
+                        'user_id': qn('user_id')
+                    }
+        select = SortedDict()
+        select['voter_id'] = '%s'
+        select['user_vote_id'] = vote_query
+        return self.select_related('author', 'thread').extra(
+                                    select = select,
+                                    select_params = (user.id, user.id)
+                                )
+
     def get_by_text_query(self, search_query):
         """returns a query set of questions,
         matching the full text query
@@ -289,43 +320,67 @@ class PostManager(BaseQuerySetManager):
         Fetches comments for given posts, and stores them in post._cached_comments
         Additionally, annotates posts with ``upvoted_by_user`` parameter, if visitor is logged in
 
+        The comments, their authors and the votes of the visitor
+        are loaded with one query.
         """
-        qs = Post.objects.get_comments().filter(parent__in=for_posts).select_related('author')
-
-        if visitor.is_anonymous():
-            comments = list(qs.order_by('added_at'))
-        else:
-            upvoted_by_user = list(qs.filter(votes__user=visitor).distinct())
-            not_upvoted_by_user = list(qs.exclude(votes__user=visitor).distinct())
-
-            for c in upvoted_by_user:
-                c.upvoted_by_user = 1  # numeric value to maintain compatibility with previous version of this code
-
-            comments = upvoted_by_user + not_upvoted_by_user
-            comments.sort(key=operator.attrgetter('added_at'))
+        qs = Post.objects.get_comments().filter(
+                                parent__in=for_posts
+                            ).select_related('author').order_by('added_at', 'id')
+
+        if visitor.is_authenticated():
+            from askbot.models.repute import Vote
+            qn = connection.ops.quote_name
+            vote_table = qn(Vote._meta.db_table)
+            vote_query = 'SELECT COUNT(*) FROM %(vote)s ' + \
+                        'WHERE %(vote)s.%(post_id)s = %(post)s.%(id)s ' + \
+                        'AND %(vote)s.%(user_id)s = %%s'
+            vote_query = vote_query % {
+                            'vote': vote_table,
+                            'post': qn(self.model._meta.db_table),
+                            'id': qn('id'),
+                            'post_id': qn('voted_post_id'),
+                            'user_id': qn('user_id')
+                        }
+            #numeric value to maintain compatibility with previous version of this code
+            qs = qs.extra(
+                    select = {'upvoted_by_user': vote_query},
+                    select_params = (visitor.id,)
+                )
 
         post_map = defaultdict(list)
-        for cm in comments:
+        for cm in qs:
             post_map[cm.parent_id].append(cm)
         for post in for_posts:
             post.set_cached_comments(post_map[post.id])
 
-        # Old Post.get_comment(self, visitor=None) method:
-        #        if visitor.is_anonymous():
-        #            return self.comments.order_by('added_at')
-        #        else:
-        #            upvoted_by_user = list(self.comments.filter(votes__user=visitor).distinct())
-        #            not_upvoted_by_user = list(self.comments.exclude(votes__user=visitor).distinct())
-        #
-        #            for c in upvoted_by_user:
-        #                c.upvoted_by_user = 1  # numeric value to maintain compatibility with previous version of this code
-        #
-        #            comments = upvoted_by_user + not_upvoted_by_user
-        #            comments.sort(key=operator.attrgetter('added_at'))
-        #
-        #            return comments
 
 
+def render_post_text(post_type, text):
+    """renders source text of the post of given type into html,
+    does not touch the @mentions, because those
+    need to be looked up in the database"""
+    if post_type in ('question', 'answer', 'tag_wiki', 'reject_reason'):
+        _urlize = False
+        _use_markdown = (askbot_settings.EDITOR_TYPE == 'markdown')
+        _escape_html = False #markdow does the escaping
+    elif post_type == 'comment':
+        _urlize = True
+        _use_markdown = (askbot_settings.EDITOR_TYPE == 'markdown')
+        _escape_html = True
+    else:
+        raise NotImplementedError
+
+    if _escape_html:
+        text = cgi.escape(text)
+
+    if _urlize:
+        text = html.urlize(text)
+
+    if _use_markdown:
+        text = markup.markdown_to_html(text)
+
+    return text
+
 
 class Post(models.Model):
     post_type = models.CharField(max_length=255, db_index=True)
@@ -413,27 +468,7 @@ class Post(models.Model):
         removed_mentions - list of mention <Activity> objects - for removed ones
         """
 
-        if self.post_type in ('question', 'answer', 'tag_wiki', 'reject_reason'):
-            _urlize = False
-            _use_markdown = (askbot_settings.EDITOR_TYPE == 'markdown')
-            _escape_html = False #markdow does the escaping
-        elif self.is_comment():
-            _urlize = True
-            _use_markdown = (askbot_settings.EDITOR_TYPE == 'markdown')
-            _escape_html = True
-        else:
-            raise NotImplementedError
-
-        text = self.text
-
-        if _escape_html:
-            text = cgi.escape(text)
-
-        if _urlize:
-            text = html.urlize(text)
-
-        if _use_markdown:
-            text = sanitize_html(markup.get_parser().convert(text))
+        text = render_post_text(self.post_type, self.text)
 
         #todo, add markdown parser call conditional on
         #self.use_markdown flag
@@ -441,28 +476,7 @@ class Post(models.Model):
         mentioned_authors = list()
         removed_mentions = list()
         if '@' in text:
-            op = self.get_origin_post()
-            anticipated_authors = op.get_author_list(
-                include_comments = True,
-                recursive = True
-            )
-
-            extra_name_seeds = markup.extract_mentioned_name_seeds(text)
-
-            extra_authors = set()
-            for name_seed in extra_name_seeds:
-                extra_authors.update(
-                    User.objects.filter(username__istartswith = name_seed)
-                )
-
-            #it is important to preserve order here so that authors of post
-            #get mentioned first
-            anticipated_authors += list(extra_authors)
-
-            mentioned_authors, post_html = markup.mentionize_text(
-                text,
-                anticipated_authors
-            )
+            mentioned_authors, post_html = self.mentionize_html(text)
 
             #find mentions that were removed and identify any previously
             #entered mentions so that we can send alerts on only new ones
@@ -492,6 +506,48 @@ class Post(models.Model):
             }
         return data
 
+    def mentionize_html(self, text):
+        """replaces @mentions of the users in the html ``text``
+        with the links to their profiles, returns tuple
+        of the list of mentioned users and the new html
+
+        the mentioned users are loaded with one query, when
+        several usernames match - the participants of the thread
+        get mentioned first
+        """
+        mentions = find_mentions(
+                        text,
+                        preferred_user_ids = self.get_origin_post().get_participant_ids
+                    )
+        if len(mentions) == 0:
+            return list(), text
+
+        mentioned_authors = list()
+        for pos, end, user in mentions:
+            if user not in mentioned_authors:
+                mentioned_authors.append(user)
+
+        return mentioned_authors, markup.replace_mentions(text, mentions)
+
+    def get_participant_ids(self):
+        """returns set of ids of the users who wrote or edited
+        the post, its comments and, for the question,
+        the answers and their comments"""
+        if self.is_question():
+            posts = Post.objects.filter(thread = self.thread_id, deleted = False)
+            posts = posts.filter(post_type__in = ('question', 'answer', 'comment'))
+        else:
+            posts = Post.objects.filter(
+                models.Q(id = self.id) | models.Q(parent = self.id, post_type = 'comment')
+            )
+        participant_ids = set(posts.values_list('author', flat = True))
+        participant_ids.update(
+            PostRevision.objects.filter(
+                post__in = posts
+            ).values_list('author', flat = True)
+        )
+        return participant_ids
+
     #todo: when models are merged, it would be great to remove author parameter
     def parse_and_save(self, author=None, **kwargs):
         """generic method to use with posts to be used prior to saving
@@ -599,6 +655,8 @@ class Post(models.Model):
             for group in groups:
                 for comment in comments:
                     PostToGroup.objects.get_or_create(post=comment, group=group)
+        if self.thread_id:
+            self.thread.invalidate_visibility_info()
 
     def remove_from_groups(self, groups):
         PostToGroup.objects.filter(post=self, group__in=groups).delete()
@@ -608,6 +666,8 @@ class Post(models.Model):
                         post__id__in=comment_ids,
                         group__in=groups
                     ).delete()
+        if self.thread_id:
+            self.thread.invalidate_visibility_info()
 
 
     def issue_update_notifications(
@@ -797,6 +857,10 @@ class Post(models.Model):
 
         super(Post, self).delete(**kwargs)
 
+        if self.is_question():
+            #thread without the question post leaves the listings
+            self.thread.update_listing_index()
+
     def __unicode__(self):
         if self.is_question():
             return self.thread.title
@@ -954,130 +1018,122 @@ class Post(models.Model):
 
         return comment_post
 
-    def get_global_tag_based_subscribers(
-            self,
-            tag_mark_reason = None,
-            subscription_records = None
-    ):
-        """returns a list of users who either follow or "do not ignore"
-        the given set of tags, depending on the tag_mark_reason
+    def get_tag_based_subscriber_ids(self, candidates, tag_mark_reason):
+        """returns set of ids of the users who either follow
+        or "do not ignore" the tags of the post, depending
+        on the tag_mark_reason
+
+        ``candidates`` - users with global subscriptions, only those
+        whose email tag filter strategy corresponds to the
+        tag mark reason are considered
 
-        ``subscription_records`` - query set of ``~askbot.models.EmailFeedSetting``
-        this argument is used to reduce number of database queries
+        Tag selections are loaded with one query and the
+        wildcard selections - with another, from the index in
+        :class:`~askbot.models.tag.WildcardTagSelection`
         """
         if tag_mark_reason == 'good':
             email_tag_filter_strategy = const.INCLUDE_INTERESTING
-            user_set_getter = User.objects.filter
         elif tag_mark_reason == 'bad':
             email_tag_filter_strategy = const.EXCLUDE_IGNORED
-            user_set_getter = User.objects.exclude
         elif tag_mark_reason == 'subscribed':
             email_tag_filter_strategy = const.INCLUDE_SUBSCRIBED
-            user_set_getter = User.objects.filter
         else:
             raise ValueError('Uknown value of tag mark reason %s' % tag_mark_reason)
 
-        #part 1 - find users who follow or not ignore the set of tags
+        candidates = [
+            user for user in candidates
+            if user.email_tag_filter_strategy == email_tag_filter_strategy
+        ]
+        if len(candidates) == 0:
+            return set()
+
+        #part 1 - users who marked the tags
         tag_names = self.get_tag_names()
         tag_selections = MarkedTag.objects.filter(
-            tag__name__in = tag_names,
-            reason = tag_mark_reason
-        )
-        subscribers = set(
-            user_set_getter(
-                tag_selections__in = tag_selections
-            ).filter(
-                email_tag_filter_strategy = email_tag_filter_strategy,
-                notification_subscriptions__in = subscription_records
-            )
-        )
+                                        tag__name__in = tag_names,
+                                        reason = tag_mark_reason
+                                    )
+        marked_user_ids = set(tag_selections.values_list('user', flat = True))
 
-        #part 2 - find users who follow or not ignore tags via wildcard selections
-        #inside there is a potentially time consuming loop
+        #part 2 - users who marked the tags via wildcard selections
         if askbot_settings.USE_WILDCARD_TAGS:
-            #todo: fix this
-            #this branch will not scale well
-            #because we have to loop through the list of users
-            #in python
-            if tag_mark_reason == 'good':
-                empty_wildcard_filter = {'interesting_tags__exact': ''}
-                wildcard_tags_attribute = 'interesting_tags'
-                update_subscribers = lambda the_set, item: the_set.add(item)
-            elif tag_mark_reason == 'bad':
-                empty_wildcard_filter = {'ignored_tags__exact': ''}
-                wildcard_tags_attribute = 'ignored_tags'
-                update_subscribers = lambda the_set, item: the_set.discard(item)
-            elif tag_mark_reason == 'subscribed':
-                empty_wildcard_filter = {'subscribed_tags__exact': ''}
-                wildcard_tags_attribute = 'subscribed_tags'
-                update_subscribers = lambda the_set, item: the_set.add(item)
-
-            potential_wildcard_subscribers = User.objects.filter(
-                notification_subscriptions__in = subscription_records
-            ).filter(
-                email_tag_filter_strategy = email_tag_filter_strategy
-            ).exclude(
-                **empty_wildcard_filter #need this to limit size of the loop
+            marked_user_ids.update(
+                get_wildcard_selector_ids(tag_names, tag_mark_reason)
             )
-            for potential_subscriber in potential_wildcard_subscribers:
-                wildcard_tags = getattr(
-                    potential_subscriber,
-                    wildcard_tags_attribute
-                ).split(' ')
-
-                if tags_match_some_wildcard(tag_names, wildcard_tags):
-                    update_subscribers(subscribers, potential_subscriber)
 
-        return subscribers
-
-    def get_global_instant_notification_subscribers(self):
-        """returns a set of subscribers to post according to tag filters
-        both - subscribers who ignore tags or who follow only
-        specific tags
+        candidate_ids = set([user.id for user in candidates])
+        if tag_mark_reason == 'bad':
+            return candidate_ids - marked_user_ids
+        else:
+            return candidate_ids & marked_user_ids
 
-        this method in turn calls several more specialized
-        subscriber retrieval functions
-        todo: retrieval of wildcard tag followers ignorers
-              won't scale at all
+    def filter_global_subscribers(self, candidates):
+        """returns set of users among the ``candidates``
+        (users who subscribe to all questions)
+        whose tag filters allow notifications about the post
         """
-        subscriber_set = set()
-
-        global_subscriptions = EmailFeedSetting.objects.filter(
-            feed_type = 'q_all',
-            frequency = 'i'
-        )
-
         #segment of users who have tag filter turned off
-        global_subscribers = User.objects.filter(
-            models.Q(email_tag_filter_strategy=const.INCLUDE_ALL)
-            & models.Q(
-                notification_subscriptions__feed_type='q_all',
-                notification_subscriptions__frequency='i'
-            )
-        )
-        subscriber_set.update(global_subscribers)
+        subscriber_ids = set([
+            user.id for user in candidates
+            if user.email_tag_filter_strategy == const.INCLUDE_ALL
+        ])
 
         #segment of users who want emails on selected questions only
         if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
             good_mark_reason = 'subscribed'
         else:
             good_mark_reason = 'good'
-        subscriber_set.update(
-            self.get_global_tag_based_subscribers(
-                subscription_records = global_subscriptions,
-                tag_mark_reason = good_mark_reason
-            )
+        subscriber_ids.update(
+            self.get_tag_based_subscriber_ids(candidates, good_mark_reason)
         )
 
         #segment of users who want to exclude ignored tags
-        subscriber_set.update(
-            self.get_global_tag_based_subscribers(
-                subscription_records = global_subscriptions,
-                tag_mark_reason = 'bad'
-            )
+        subscriber_ids.update(
+            self.get_tag_based_subscriber_ids(candidates, 'bad')
         )
-        return subscriber_set
+        return set([user for user in candidates if user.id in subscriber_ids])
+
+    def get_global_instant_notification_subscribers(self):
+        """returns a set of subscribers to post according to tag filters
+        both - subscribers who ignore tags or who follow only
+        specific tags
+        """
+        global_subscriptions = EmailFeedSetting.objects.filter(
+            feed_type = 'q_all',
+            frequency = 'i'
+        ).select_related('subscriber')
+        candidates = set([feed.subscriber for feed in global_subscriptions])
+        return self.filter_global_subscribers(candidates)
+
+    def get_instant_subscribers_by_feed_type(self, candidates):
+        """returns dictionary keyed by the feed type
+        of sets of users who have instant email subscriptions
+        of that type, all subscriptions are loaded with one query
+
+        ``candidates`` - dictionary keyed by the feed type,
+        values are lists of user ids or query sets giving
+        the user ids, or None - to get all subscribers
+        """
+        feed_filters = list()
+        for feed_type, user_ids in candidates.items():
+            if user_ids is None:
+                feed_filters.append(models.Q(feed_type = feed_type))
+            elif isinstance(user_ids, models.query.QuerySet) or user_ids:
+                feed_filters.append(
+                    models.Q(feed_type = feed_type, subscriber__in = user_ids)
+                )
+
+        subscribers = defaultdict(set)
+        if len(feed_filters) == 0:
+            return subscribers
 
+        feeds = EmailFeedSetting.objects.filter(
+                        reduce(operator.or_, feed_filters),
+                        frequency = 'i'
+                    ).select_related('subscriber')
+        for feed in feeds:
+            subscribers[feed.feed_type].add(feed.subscriber)
+        return subscribers
 
     def _qa__get_instant_notification_subscribers(
             self,
@@ -1112,70 +1168,37 @@ class Post(models.Model):
           on questions that they asked
         * authors or any answers who subsribe to instant updates
           on the questions which they answered
-        """
-        #print '------------------'
-        #print 'in content function'
-        subscriber_set = set()
-        #print 'potential subscribers: ', potential_subscribers
-
-        #1) mention subscribers - common to questions and answers
-        if mentioned_users:
-            mention_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                potential_subscribers = mentioned_users,
-                feed_type = 'm_and_c',
-                frequency = 'i'
-            )
-            subscriber_set.update(mention_subscribers)
 
+        Candidates and their subscriptions are loaded
+        with one query, see :meth:`get_instant_subscribers_by_feed_type`
+        """
         origin_post = self.get_origin_post()
-
-        #print origin_post
-
-        #2) individually selected - make sure that users
-        #are individual subscribers to this question
         # TODO: The line below works only if origin_post is Question !
-        selective_subscribers = origin_post.thread.followed_by.all()
-        #print 'question followers are ', [s for s in selective_subscribers]
-        if selective_subscribers:
-            selective_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                potential_subscribers = selective_subscribers,
-                feed_type = 'q_sel',
-                frequency = 'i'
-            )
-            subscriber_set.update(selective_subscribers)
-            #print 'selective subscribers: ', selective_subscribers
-
-        #3) whole forum subscribers
-        global_subscribers = origin_post.get_global_instant_notification_subscribers()
-        subscriber_set.update(global_subscribers)
-
-        #4) question asked by me (todo: not "edited_by_me" ???)
-        question_author = origin_post.author
-        if EmailFeedSetting.objects.filter(
-            subscriber = question_author,
-            frequency = 'i',
-            feed_type = 'q_ask'
-        ).exists():
-            subscriber_set.add(question_author)
-
-        #4) questions answered by me -make sure is that people
-        #are authors of the answers to this question
-        #todo: replace this with a query set method
-        answer_authors = set()
-        for answer in origin_post.thread.posts.get_answers().all():
-            authors = answer.get_author_list()
-            answer_authors.update(authors)
-
-        if answer_authors:
-            answer_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                potential_subscribers = answer_authors,
-                frequency = 'i',
-                feed_type = 'q_ans',
-            )
-            subscriber_set.update(answer_subscribers)
-            #print 'answer subscribers: ', answer_subscribers
+        thread = origin_post.thread
+        answers = thread.posts.get_answers()
+        answer_authors = PostRevision.objects.filter(
+                                    post__in = answers
+                                ).values_list('author', flat = True)
+
+        subscribers = self.get_instant_subscribers_by_feed_type({
+            #1) mention subscribers - common to questions and answers
+            'm_and_c': [user.id for user in mentioned_users or ()],
+            #2) individually selected - question followers
+            'q_sel': thread.followed_by.values_list('id', flat = True),
+            #3) whole forum subscribers, tag filters are applied below
+            'q_all': None,
+            #4) question asked by me (todo: not "edited_by_me" ???)
+            'q_ask': [origin_post.author_id],
+            #5) questions answered by me
+            'q_ans': answer_authors,
+        })
 
-        #print 'exclude_list is ', exclude_list
+        subscriber_set = set()
+        for feed_type in ('m_and_c', 'q_sel', 'q_ask', 'q_ans'):
+            subscriber_set.update(subscribers[feed_type])
+        subscriber_set.update(
+            origin_post.filter_global_subscribers(subscribers['q_all'])
+        )
         return subscriber_set - set(exclude_list)
 
     def _comment__get_instant_notification_subscribers(
@@ -1199,11 +1222,6 @@ class Post(models.Model):
         * all global subscribers
           (tag filtered, and subject to personalized settings)
         """
-        #print 'in meta function'
-        #print 'potential subscribers: ', potential_subscribers
-
-        subscriber_set = set()
-
         if potential_subscribers:
             potential_subscribers = set(potential_subscribers)
         else:
@@ -1212,36 +1230,21 @@ class Post(models.Model):
         if mentioned_users:
             potential_subscribers.update(mentioned_users)
 
-        if potential_subscribers:
-            comment_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                                        potential_subscribers = potential_subscribers,
-                                        feed_type = 'm_and_c',
-                                        frequency = 'i'
-                                    )
-            subscriber_set.update(comment_subscribers)
-            #print 'comment subscribers: ', comment_subscribers
-
         origin_post = self.get_origin_post()
         # TODO: The line below works only if origin_post is Question !
-        selective_subscribers = origin_post.thread.followed_by.all()
-        if selective_subscribers:
-            selective_subscribers = EmailFeedSetting.objects.filter_subscribers(
-                                    potential_subscribers = selective_subscribers,
-                                    feed_type = 'q_sel',
-                                    frequency = 'i'
-                                )
-            for subscriber in selective_subscribers:
-                if origin_post.passes_tag_filter_for_user(subscriber):
-                    subscriber_set.add(subscriber)
-
-            subscriber_set.update(selective_subscribers)
-            #print 'selective subscribers: ', selective_subscribers
-
-        global_subscribers = origin_post.get_global_instant_notification_subscribers()
-        #print 'global subscribers: ', global_subscribers
-
-        subscriber_set.update(global_subscribers)
+        thread = origin_post.thread
+        subscribers = self.get_instant_subscribers_by_feed_type({
+            'm_and_c': [user.id for user in potential_subscribers],
+            'q_sel': thread.followed_by.values_list('id', flat = True),
+            'q_all': None,
+        })
 
+        subscriber_set = set()
+        subscriber_set.update(subscribers['m_and_c'])
+        subscriber_set.update(subscribers['q_sel'])
+        subscriber_set.update(
+            origin_post.filter_global_subscribers(subscribers['q_all'])
+        )
         return subscriber_set - set(exclude_list)
 
     def get_instant_notification_subscribers(
@@ -2164,8 +2167,7 @@ class PostRevision(models.Model):
 
     @property
     def html(self, **kwargs):
-        markdowner = markup.get_parser()
-        sanitized_html = sanitize_html(markdowner.convert(self.text))
+        sanitized_html = markup.markdown_to_html(self.text)
 
         if self.post.is_question():
             return self.QUESTION_REVISION_TEMPLATE_NO_TAGS % {
@@ -4,6 +4,7 @@ import re
 
 from django.conf import settings as django_settings
 from django.db import models
+from django.db import connection
 from django.contrib.auth.models import User
 from django.core import cache  # import cache, not from cache import cache, to be able to monkey-patch cache.cache in test cases
 from django.core import exceptions as django_exceptions
@@ -23,17 +24,73 @@ from askbot.models.tag import Tag
 from askbot.models.tag import get_tags_by_names
 from askbot.models.tag import filter_accepted_tags, filter_suggested_tags
 from askbot.models.tag import separate_unused_tags
+from askbot.models.tag import resolve_tag_names
 from askbot.models.base import DraftContent, BaseQuerySetManager
 from askbot.models.post import Post, PostRevision
 from askbot.models.post import PostToGroup
 from askbot.models.user import Group, PERSONAL_GROUP_NAME_PREFIX
 from askbot.models import signals
+from askbot.models import view_counter
 from askbot import const
 from askbot.utils.lists import LazyList
 from askbot.search import mysql
 from askbot.utils.slug import slugify
+from askbot.utils.functions import generate_random_key
 from askbot.search.state_manager import DummySearchState
 
+QUESTION_ORDER_BY_MAP = {
+    'age-desc': '-added_at',
+    'age-asc': 'added_at',
+    'activity-desc': '-last_activity_at',
+    'activity-asc': 'last_activity_at',
+    'answers-desc': '-answer_count',
+    'answers-asc': 'answer_count',
+    'votes-desc': '-points',
+    'votes-asc': 'points',
+
+    'relevance-desc': '-relevance', # special Postgresql-specific ordering, 'relevance' quaso-column is added by get_for_query()
+}
+
+TAG_PLACEHOLDER_RE = re.compile(
+                        r'<<<(%s)>>>' % const.TAG_REGEX_BARE,
+                        re.UNICODE
+                    )
+SUMMARY_SEGMENTS_CACHE_SIZE = 1000
+summary_segments_cache = dict()
+
+def split_summary_html(html):
+    """returns tuple of segments of the summary snippet,
+    static html at even positions and tag names
+    at the odd ones. Splits of recently seen
+    snippets are kept in the process memory"""
+    segments = summary_segments_cache.get(html)
+    if segments is None:
+        segments = tuple(TAG_PLACEHOLDER_RE.split(html))
+        if len(summary_segments_cache) >= SUMMARY_SEGMENTS_CACHE_SIZE:
+            summary_segments_cache.clear()
+        summary_segments_cache[html] = segments
+    return segments
+
+def fill_tag_urls(html, search_state):
+    """replaces tag placeholders ``<<<tag-name>>>`` in the summary
+    snippet with urls of the search state with the tag added,
+    in one pass over the snippet"""
+    segments = split_summary_html(html)
+    if len(segments) == 1:
+        return html
+    output = list(segments)
+    for position in range(1, len(output), 2):
+        output[position] = search_state.get_tag_url(output[position])
+    return u''.join(output)
+
+def get_user_group_ids(user):
+    """returns ids of groups through which
+    the user may see the threads"""
+    if user is None or user.is_anonymous():
+        return [Group.objects.get_global_group().id]
+    return list(user.get_groups().values_list('id', flat=True))
+
+
 class ThreadQuerySet(models.query.QuerySet):
     def get_visible(self, user):
         """filters out threads not belonging to the user groups"""
@@ -43,6 +100,32 @@ class ThreadQuerySet(models.query.QuerySet):
             groups = [Group.objects.get_global_group()]
         return self.filter(groups__in=groups).distinct()
 
+    def filter_by_tag_ids(self, tag_ids):
+        """returns threads tagged with all of the given tags,
+        when there is more than one tag - with a single
+        ``GROUP BY ... HAVING`` subquery on the thread-tag table,
+        instead of joining the table once per tag"""
+        tag_ids = list(set(tag_ids))
+        if len(tag_ids) == 1:
+            return self.filter(tags__id=tag_ids[0])
+
+        qn = connection.ops.quote_name
+        through_meta = self.model.tags.through._meta
+        thread_column = through_meta.get_field('thread').column
+        tag_column = through_meta.get_field('tag').column
+        subquery = '%s.%s IN (SELECT %s FROM %s WHERE %s IN (%s) ' \
+                    'GROUP BY %s HAVING COUNT(*) = %d)' % (
+                        qn(self.model._meta.db_table),
+                        qn(self.model._meta.pk.column),
+                        qn(thread_column),
+                        qn(through_meta.db_table),
+                        qn(tag_column),
+                        ', '.join(['%s'] * len(tag_ids)),
+                        qn(thread_column),
+                        len(tag_ids)
+                    )
+        return self.extra(where=[subquery], params=tag_ids)
+
     def get_for_title_query(self, search_query):
         """returns threads matching title query
         todo: possibly add tags
@@ -70,6 +153,38 @@ class ThreadManager(BaseQuerySetManager):
     def get_query_set(self):
         return ThreadQuerySet(self.model)
 
+    def flush_view_counts(self):
+        """saves view counts accumulated in the cache,
+        threads with the same number of new views are
+        updated with one query, summaries are regenerated
+        only for the threads whose displayed view count changed,
+        returns number of the updated threads
+        """
+        views = view_counter.take_pending_views()
+        if not views:
+            return 0
+
+        old_counts = dict(
+            self.filter(id__in=views.keys()).values_list('id', 'view_count')
+        )
+        thread_ids_by_increment = dict()
+        for thread_id, increment in views.items():
+            thread_ids_by_increment.setdefault(increment, list()).append(thread_id)
+        for increment, thread_ids in thread_ids_by_increment.items():
+            self.filter(id__in=thread_ids).update(
+                            view_count=models.F('view_count') + increment
+                        )
+
+        changed_ids = list()
+        for thread_id, old_count in old_counts.items():
+            new_count = old_count + views[thread_id]
+            if view_counter.get_view_count_display(old_count) \
+                != view_counter.get_view_count_display(new_count):
+                changed_ids.append(thread_id)
+        for thread in self.filter(id__in=changed_ids):
+            thread.update_summary_html()
+        return len(old_counts)
+
     def get_tag_summary_from_threads(self, threads):
         """returns a humanized string containing up to
         five most frequently used
@@ -290,30 +405,28 @@ class ThreadManager(BaseQuerySetManager):
         tags = search_state.unified_tags()
         if len(tags) > 0:
 
+            #all tag names are resolved at once, names
+            #seen before are taken from the in-process map
+            #tags are AND-ed here, not OR-ed (i.e. we fetch only threads with all tags)
             if askbot_settings.TAG_SEARCH_INPUT_ENABLED:
                 #todo: this may be gone or disabled per option
                 #"tag_search_box_enabled"
-                existing_tags = set()
-                non_existing_tags = set()
-                #we're using a one-by-one tag retreival, b/c
-                #we want to take advantage of case-insensitive search indexes
-                #in postgresql, plus it is most likely that there will be
-                #only one or two search tags anyway
-                for tag in tags:
-                    try:
-                        tag_record = Tag.objects.get(name__iexact=tag)
-                        existing_tags.add(tag_record.name)
-                    except Tag.DoesNotExist:
-                        non_existing_tags.add(tag)
-
+                found_tags, non_existing_tags = resolve_tag_names(
+                                                    tags, case_sensitive=False
+                                                )
                 meta_data['non_existing_tags'] = list(non_existing_tags)
-                tags = existing_tags
+                if found_tags:
+                    tag_ids = [tag_id for tag_id, name in found_tags]
+                    qs = qs.filter_by_tag_ids(tag_ids)
             else:
+                found_tags, non_existing_tags = resolve_tag_names(tags)
                 meta_data['non_existing_tags'] = list()
-
-            #construct filter for the tag search
-            for tag in tags:
-                qs = qs.filter(tags__name=tag) # Tags or AND-ed here, not OR-ed (i.e. we fetch only threads with all tags)
+                if non_existing_tags:
+                    #no thread can have a tag that does not exist
+                    qs = qs.none()
+                else:
+                    tag_ids = [tag_id for tag_id, name in found_tags]
+                    qs = qs.filter_by_tag_ids(tag_ids)
         else:
             meta_data['non_existing_tags'] = list()
 
@@ -350,65 +463,39 @@ class ThreadManager(BaseQuerySetManager):
 
         #get users tag filters
         if request_user and request_user.is_authenticated():
-            #mark questions tagged with interesting tags
-            #a kind of fancy annotation, would be nice to avoid it
-            interesting_tags = Tag.objects.filter(
-                user_selections__user = request_user,
-                user_selections__reason = 'good'
-            )
-            ignored_tags = Tag.objects.filter(
-                user_selections__user = request_user,
-                user_selections__reason = 'bad'
-            )
-            subscribed_tags = Tag.objects.none()
+            #tag selections are read from the cached per-user record
+            preferences = request_user.get_tag_preferences()
             if askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED:
-                subscribed_tags = Tag.objects.filter(
-                    user_selections__user = request_user,
-                    user_selections__reason = 'subscribed'
-                )
-                meta_data['subscribed_tag_names'] = [tag.name for tag in subscribed_tags]
+                meta_data['subscribed_tag_names'] = list(
+                                    preferences.tag_names['subscribed']
+                                )
 
-            meta_data['interesting_tag_names'] = [tag.name for tag in interesting_tags]
-            meta_data['ignored_tag_names'] = [tag.name for tag in ignored_tags]
+            meta_data['interesting_tag_names'] = list(preferences.tag_names['good'])
+            meta_data['ignored_tag_names'] = list(preferences.tag_names['bad'])
 
-            if request_user.display_tag_filter_strategy == const.INCLUDE_INTERESTING and (interesting_tags or request_user.has_interesting_wildcard_tags()):
+            if request_user.display_tag_filter_strategy == const.INCLUDE_INTERESTING and (preferences.tag_ids['good'] or preferences.has_wildcards('good')):
                 #filter by interesting tags only
-                interesting_tag_filter = models.Q(tags__in=interesting_tags)
-                if request_user.has_interesting_wildcard_tags():
-                    interesting_wildcards = request_user.interesting_tags.split()
-                    extra_interesting_tags = Tag.objects.get_by_wildcards(interesting_wildcards)
-                    interesting_tag_filter |= models.Q(tags__in=extra_interesting_tags)
-                qs = qs.filter(interesting_tag_filter)
+                interesting_tag_ids = preferences.get_tag_ids('good')
+                if interesting_tag_ids:
+                    qs = qs.filter(tags__id__in=interesting_tag_ids)
+                else:
+                    qs = qs.none()
 
             # get the list of interesting and ignored tags (interesting_tag_names, ignored_tag_names) = (None, None)
-            if request_user.display_tag_filter_strategy == const.EXCLUDE_IGNORED and (ignored_tags or request_user.has_ignored_wildcard_tags()):
+            if request_user.display_tag_filter_strategy == const.EXCLUDE_IGNORED and (preferences.tag_ids['bad'] or preferences.has_wildcards('bad')):
                 #exclude ignored tags if the user wants to
-                qs = qs.exclude(tags__in=ignored_tags)
-                if request_user.has_ignored_wildcard_tags():
-                    ignored_wildcards = request_user.ignored_tags.split()
-                    extra_ignored_tags = Tag.objects.get_by_wildcards(ignored_wildcards)
-                    qs = qs.exclude(tags__in = extra_ignored_tags)
+                ignored_tag_ids = preferences.get_tag_ids('bad')
+                if ignored_tag_ids:
+                    qs = qs.exclude(tags__id__in=ignored_tag_ids)
 
             if request_user.display_tag_filter_strategy == const.INCLUDE_SUBSCRIBED \
-                and subscribed_tags:
-                qs = qs.filter(tags__in = subscribed_tags)
+                and askbot_settings.SUBSCRIBED_TAG_SELECTOR_ENABLED \
+                and preferences.tag_ids['subscribed']:
+                qs = qs.filter(tags__id__in=preferences.tag_ids['subscribed'])
 
             if askbot_settings.USE_WILDCARD_TAGS:
-                meta_data['interesting_tag_names'].extend(request_user.interesting_tags.split())
-                meta_data['ignored_tag_names'].extend(request_user.ignored_tags.split())
-
-        QUESTION_ORDER_BY_MAP = {
-            'age-desc': '-added_at',
-            'age-asc': 'added_at',
-            'activity-desc': '-last_activity_at',
-            'activity-asc': 'last_activity_at',
-            'answers-desc': '-answer_count',
-            'answers-asc': 'answer_count',
-            'votes-desc': '-points',
-            'votes-asc': 'points',
-
-            'relevance-desc': '-relevance', # special Postgresql-specific ordering, 'relevance' quaso-column is added by get_for_query()
-        }
+                meta_data['interesting_tag_names'].extend(preferences.wildcards['good'])
+                meta_data['ignored_tag_names'].extend(preferences.wildcards['bad'])
 
         orderby = QUESTION_ORDER_BY_MAP[search_state.sort]
 
@@ -417,7 +504,10 @@ class ThreadManager(BaseQuerySetManager):
             and orderby=='-relevance'
         ):
             #FIXME: this does not produces the very same results as postgres.
-            qs = qs.extra(order_by=[orderby])
+            #thread id breaks the ties, so that the order is stable
+            #and the keyset pagination (askbot.search.keyset) works
+            id_orderby = orderby.startswith('-') and '-id' or 'id'
+            qs = qs.extra(order_by=[orderby, id_orderby])
 
 
         # HACK: We add 'ordering_key' column as an alias and order by it, because when distict() is used,
@@ -427,7 +517,7 @@ class ThreadManager(BaseQuerySetManager):
         # qs = qs.extra(select={'ordering_key': orderby.lstrip('-')}, order_by=['-ordering_key' if orderby.startswith('-') else 'ordering_key'])
         # qs = qs.distinct()
 
-        qs = qs.only('id', 'title', 'view_count', 'answer_count', 'last_activity_at', 'last_activity_by', 'closed', 'tagnames', 'accepted_answer')
+        qs = qs.only('id', 'title', 'view_count', 'answer_count', 'last_activity_at', 'last_activity_by', 'closed', 'tagnames', 'accepted_answer', 'added_at', 'points')
 
         #print qs.query
 
@@ -463,6 +553,63 @@ class ThreadManager(BaseQuerySetManager):
             thread._last_activity_by_cache = user_map[thread.last_activity_by_id]
 
 
+    def get_summary_cache_keys(self, threads, visitor=None):
+        """returns dictionary of summary snippet
+        cache keys keyed by the thread id"""
+        if askbot_settings.GROUPS_ENABLED == False:
+            return dict([
+                (thread.id, thread.get_summary_cache_key()) for thread in threads
+            ])
+
+        info_keys = [Thread.VISIBILITY_CACHE_KEY_TPL % thread.id for thread in threads]
+        infos = cache.cache.get_many(info_keys)
+        user_group_ids = get_user_group_ids(visitor)
+        keys = dict()
+        for thread in threads:
+            info = infos.get(Thread.VISIBILITY_CACHE_KEY_TPL % thread.id)
+            if info is None:
+                info = thread.get_visibility_info()
+            keys[thread.id] = thread.get_summary_cache_key(
+                                            visitor,
+                                            info=info,
+                                            user_group_ids=user_group_ids
+                                        )
+        return keys
+
+    def prefetch_summary_html(self, threads, visitor=None):
+        """loads summary snippets of the threads on the listing page
+        with one cache request. Missing snippets are rendered
+        in a batch sharing the fetch of question posts and users
+        and are stored with one more cache request.
+
+        The snippets are remembered on the thread objects,
+        to be picked up by :meth:`Thread.get_summary_html`
+        """
+        threads = list(threads)
+        if len(threads) == 0:
+            return
+        keys = self.get_summary_cache_keys(threads, visitor)
+        cached = cache.cache.get_many(keys.values())
+
+        missing = list()
+        for thread in threads:
+            html = cached.get(keys[thread.id])
+            if html:
+                thread._summary_html_cache = html
+            else:
+                missing.append(thread)
+
+        if len(missing) == 0:
+            return
+
+        self.precache_view_data_hack(missing)
+        rendered = dict()
+        for thread in missing:
+            html = thread.render_summary_html(visitor, save=False)
+            thread._summary_html_cache = html
+            rendered[keys[thread.id]] = html
+        cache.cache.set_many(rendered, const.LONG_TIME)
+
     #todo: this function is similar to get_response_receivers - profile this function against the other one
     def get_thread_contributors(self, thread_list):
         """Returns query set of Thread contributors"""
@@ -521,6 +668,7 @@ class ThreadToGroup(models.Model):
 class Thread(models.Model):
     SUMMARY_CACHE_KEY_TPL = 'thread-question-summary-%d'
     ANSWER_LIST_KEY_TPL = 'thread-answer-list-%d'
+    VISIBILITY_CACHE_KEY_TPL = 'thread-visibility-%d'
 
     title = models.CharField(max_length=300)
 
@@ -676,14 +824,30 @@ class Thread(models.Model):
     def update_answer_count(self):
         self.answer_count = self.get_answers().count()
         self.save()
+        self.update_listing_index()
 
     def increase_view_count(self, increment=1):
+        """counts the views, with ``VIEW_COUNT_FLUSH_INTERVAL`` > 0
+        they are saved to the database later, in batches,
+        summary html is regenerated only if the displayed count changes
+        """
+        interval = askbot_settings.VIEW_COUNT_FLUSH_INTERVAL
+        if interval > 0 and view_counter.can_buffer():
+            saved_count = self.view_count - getattr(self, '_pending_view_count', 0)
+            self._pending_view_count = view_counter.add_views(self.id, increment)
+            #other pieces of code rely on the up to date view count
+            self.view_count = saved_count + self._pending_view_count
+            if view_counter.is_flush_due(interval):
+                Thread.objects.flush_view_counts()
+            return
+
+        old_view_count = self.view_count
         qset = Thread.objects.filter(id=self.id)
         qset.update(view_count=models.F('view_count') + increment)
         self.view_count = qset.values('view_count')[0]['view_count'] # get the new view_count back because other pieces of code relies on such behaviour
-        ####################################################################
-        self.update_summary_html() # regenerate question/thread summary html
-        ####################################################################
+        if view_counter.get_view_count_display(old_view_count) \
+            != view_counter.get_view_count_display(self.view_count):
+            self.update_summary_html() # regenerate question/thread summary html
 
     def set_closed_status(self, closed, closed_by, closed_at, close_reason):
         self.closed = closed
@@ -699,11 +863,13 @@ class Thread(models.Model):
         self.accepted_answer = answer
         self.answer_accepted_at = timestamp
         self.save()
+        self.update_listing_index()
 
     def set_last_activity(self, last_activity_at, last_activity_by):
         self.last_activity_at = last_activity_at
         self.last_activity_by = last_activity_by
         self.save()
+        self.update_listing_index()
         ####################################################################
         self.update_summary_html() # regenerate question/thread summary html
         ####################################################################
@@ -814,16 +980,91 @@ class Thread(models.Model):
             #                | models.Q(deleted_by=user)
             #            )
 
+    def get_visibility_info(self):
+        """returns cached dictionary with keys:
+        * group_ids - set of ids of all groups that
+          can see the thread or any of its posts
+        * moderated - value of :meth:`is_moderated`
+        * author_id - id of the question author
+        * version - random key, changed each time the
+          record is rebuilt, used in the group-aware cache keys
+        """
+        key = self.VISIBILITY_CACHE_KEY_TPL % self.id
+        info = cache.cache.get(key)
+        if info is None:
+            group_ids = set(
+                PostToGroup.objects.filter(
+                    post__thread=self
+                ).values_list('group__id', flat=True)
+            )
+            group_ids.update(
+                ThreadToGroup.objects.filter(
+                    thread=self
+                ).values_list('group__id', flat=True)
+            )
+            info = {
+                'group_ids': group_ids,
+                'moderated': self.is_moderated(),
+                'author_id': self._question_post().author_id,
+                'version': generate_random_key()
+            }
+            cache.cache.set(key, info, const.LONG_TIME)
+        return info
+
+    def invalidate_visibility_info(self):
+        """resets the group-aware cached content of the thread"""
+        cache.cache.delete(self.VISIBILITY_CACHE_KEY_TPL % self.id)
+
+    def get_visibility_signature(self, user=None, info=None, user_group_ids=None):
+        """returns string that is the same for all users
+        seeing the same posts of the thread, the string
+        is empty when groups are disabled
+
+        ``info`` and ``user_group_ids`` may be passed in when
+        signatures are calculated for many threads at once
+        """
+        if askbot_settings.GROUPS_ENABLED == False:
+            return ''
+        if info is None:
+            info = self.get_visibility_info()
+        if user_group_ids is None:
+            user_group_ids = get_user_group_ids(user)
+        group_ids = sorted(info['group_ids'] & set(user_group_ids))
+        signature = ','.join([str(group_id) for group_id in group_ids])
+        if info['moderated'] and getattr(user, 'id', None) == info['author_id']:
+            #published answers are ordered differently for the enquirer
+            signature += '-author'
+        signature = md5_constructor(signature).hexdigest()
+        return '%s-%s' % (info['version'], signature)
+
+    def get_summary_cache_key(self, visitor=None, **kwargs):
+        """``kwargs`` are passed to :meth:`get_visibility_signature`"""
+        key = self.SUMMARY_CACHE_KEY_TPL % self.id
+        signature = self.get_visibility_signature(visitor, **kwargs)
+        if signature:
+            key += '-' + signature
+        return key
+
     def invalidate_cached_thread_content_fragment(self):
         cache.cache.delete(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        if askbot_settings.GROUPS_ENABLED:
+            self.invalidate_visibility_info()
 
-    def get_post_data_cache_key(self, sort_method = None):
-        return 'thread-data-%s-%s' % (self.id, sort_method)
+    def get_post_data_cache_key(self, sort_method = None, user = None):
+        key = 'thread-data-%s-%s' % (self.id, sort_method)
+        signature = self.get_visibility_signature(user)
+        if signature:
+            key += '-' + signature
+        return key
 
     def invalidate_cached_post_data(self):
         """needs to be called when anything notable
         changes in the post data - on votes, adding,
         deleting, editing content"""
+        if askbot_settings.GROUPS_ENABLED:
+            #group-aware keys contain version of the visibility record
+            self.invalidate_visibility_info()
+            return
         #we can call delete_many() here if using Django > 1.2
         for sort_method in const.ANSWER_SORT_METHODS:
             cache.cache.delete(self.get_post_data_cache_key(sort_method))
@@ -832,17 +1073,22 @@ class Thread(models.Model):
         self.invalidate_cached_post_data()
         #self.invalidate_cached_thread_content_fragment()
         self.update_summary_html()
+        self.update_listing_index()
+
+    def update_listing_index(self, removed_tag_names=None):
+        """moves the thread within the precomputed listings
+        of the main page, see ``askbot.search.listing_index``"""
+        #import here to avoid the circular import
+        from askbot.search import listing_index
+        listing_index.update_thread(self, removed_tag_names)
 
     def get_cached_post_data(self, user = None, sort_method = 'votes'):
         """returns cached post data, as calculated by
         the method get_post_data()"""
-        if askbot_settings.GROUPS_ENABLED:
-            #temporary plug: bypass cache where groups are enabled
-            return self.get_post_data(sort_method=sort_method, user=user)
-        key = self.get_post_data_cache_key(sort_method)
+        key = self.get_post_data_cache_key(sort_method, user)
         post_data = cache.cache.get(key)
         if not post_data:
-            post_data = self.get_post_data(sort_method)
+            post_data = self.get_post_data(sort_method=sort_method, user=user)
             cache.cache.set(key, post_data, const.LONG_TIME)
         return post_data
 
@@ -937,10 +1183,11 @@ class Thread(models.Model):
                                         }[sort_method]
                                     ).values_list('id', flat=True)
 
-            published_answer_ids = reversed(published_answer_ids)
+            #a list, because post data is cached
+            published_answer_ids = list(published_answer_ids)
             #now put those answers first
             answer_map = dict([(answer.id, answer) for answer in answers])
-            for answer_id in published_answer_ids:
+            for answer_id in reversed(published_answer_ids):
                 #note that answer map may not contain answers publised
                 #to the question enquirer, because current user may
                 #not have access to that answer, so we use the .get() method
@@ -1100,6 +1347,9 @@ class Thread(models.Model):
             #comments are taken care of automatically
             self.add_child_posts_to_groups(groups)
 
+        self.invalidate_visibility_info()
+        self.update_listing_index()
+
     def remove_from_groups(self, groups, recursive=False):
         thread_groups =  ThreadToGroup.objects.filter(
                                         thread=self, group__in=groups
@@ -1108,12 +1358,16 @@ class Thread(models.Model):
         if recursive == True:
             self.remove_child_posts_from_groups(groups)
 
+        self.invalidate_visibility_info()
+        self.update_listing_index()
+
     def make_public(self, recursive=False):
         """adds the global group to the thread"""
         groups = (Group.objects.get_global_group(), )
         self.add_to_groups(groups, recursive=recursive)
         if recursive == False:
             self._question_post().make_public()
+        self.invalidate_visibility_info()
 
     def make_private(self, user, group_id = None):
         """adds thread to all user's groups, excluding
@@ -1134,6 +1388,7 @@ class Thread(models.Model):
             self.remove_from_groups((Group.objects.get_global_group(),))
 
         self._question_post().make_private(user, group_id)
+        self.invalidate_visibility_info()
 
         if len(groups) == 0:
             message = 'Sharing did not work, because group is unknown'
@@ -1248,6 +1503,7 @@ class Thread(models.Model):
         ####################################################################
         self.update_summary_html() # regenerate question/thread summary html
         ####################################################################
+        self.update_listing_index(removed_tag_names=removed_tagnames)
         #if there are any modified tags, update their use counts
         modified_tags = set(modified_tags)
         if modified_tags:
@@ -1334,53 +1590,46 @@ class Thread(models.Model):
         return last_updated_at, last_updated_by
 
     def get_summary_html(self, search_state=None, visitor = None):
-        html = self.get_cached_summary_html(visitor)
+        #snippet may be already loaded by ThreadManager.prefetch_summary_html()
+        html = getattr(self, '_summary_html_cache', None)
         if not html:
-            html = self.update_summary_html(visitor)
+            html = self.get_cached_summary_html(visitor)
+        if not html:
+            html = self.render_summary_html(visitor)
 
         # todo: this work may be pushed onto javascript we post-process tag names
         # in the snippet so that tag urls match the search state
         # use `<<<` and `>>>` because they cannot be confused with user input
         # - if user accidentialy types <<<tag-name>>> into question title or body,
         # then in html it'll become escaped like this: &lt;&lt;&lt;tag-name&gt;&gt;&gt;
-        regex = re.compile(
-            r'<<<(%s)>>>' % const.TAG_REGEX_BARE,
-            re.UNICODE
-        )
-
         if search_state is None:
             search_state = DummySearchState()
-
-        while True:
-            match = regex.search(html)
-            if not match:
-                break
-            seq = match.group(0)  # e.g "<<<my-tag>>>"
-            tag = match.group(1)  # e.g "my-tag"
-            full_url = search_state.add_tag(tag).full_url()
-            html = html.replace(seq, full_url)
-
-        return html
+        return fill_tag_urls(html, search_state)
 
     def get_cached_summary_html(self, visitor = None):
-        #todo: remove this plug by adding cached foreign user group
-        #parameter to the key. Now with groups on caching is turned off
-        #parameter visitor is there to get summary out by the user groups
-        if askbot_settings.GROUPS_ENABLED:
-            return None
-        return cache.cache.get(self.SUMMARY_CACHE_KEY_TPL % self.id)
+        #when groups are enabled, the key contains the signature
+        #of the groups through which the visitor sees the thread
+        return cache.cache.get(self.get_summary_cache_key(visitor))
 
     def update_summary_html(self, visitor = None):
-        #todo: it is quite wrong that visitor is an argument here
-        #because we do not include any visitor-related info in the cache key
-        #ideally cache should be shareable between users, so straight up
-        #using the user id for cache is wrong, we could use group
-        #memberships, but in that case we'd need to be more careful with
-        #cache invalidation
+        """regenerates the summary snippet after the thread
+        content has changed"""
+        if askbot_settings.GROUPS_ENABLED:
+            #snippets cached for all the group signatures are reset
+            self.invalidate_visibility_info()
+        if hasattr(self, '_summary_html_cache'):
+            delattr(self, '_summary_html_cache')
+        return self.render_summary_html(visitor)
+
+    def render_summary_html(self, visitor = None, save = True):
+        """renders the summary snippet and caches it
+        for the users who see the thread like the visitor,
+        with ``save=False`` - uses the precached question post
+        and does not store the snippet"""
         context = {
             'thread': self,
             #fetch new question post to make sure we're up-to-date
-            'question': self._question_post(refresh=True),
+            'question': self._question_post(refresh=save),
             'search_state': DummySearchState(),
             'visitor': visitor
         }
@@ -1390,15 +1639,16 @@ class Thread(models.Model):
         # * We probably don't need to pollute the cache with threads older than 30 days
         # * Additionally, Memcached treats timeouts > 30day as dates (https://code.djangoproject.com/browser/django/tags/releases/1.3/django/core/cache/backends/memcached.py#L36),
         #   which probably doesn't break anything but if we can stick to 30 days then let's stick to it
-        cache.cache.set(
-            self.SUMMARY_CACHE_KEY_TPL % self.id,
-            html,
-            timeout=const.LONG_TIME
-        )
+        if save:
+            cache.cache.set(
+                self.get_summary_cache_key(visitor),
+                html,
+                timeout=const.LONG_TIME
+            )
         return html
 
-    def summary_html_cached(self):
-        return cache.cache.has_key(self.SUMMARY_CACHE_KEY_TPL % self.id)
+    def summary_html_cached(self, visitor = None):
+        return cache.cache.has_key(self.get_summary_cache_key(visitor))
 
 class QuestionView(models.Model):
     question = models.ForeignKey(Post, related_name='viewed')
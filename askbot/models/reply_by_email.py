@@ -8,6 +8,7 @@ from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_lazy
 from askbot.models.post import Post
 from askbot.models.base import BaseQuerySetManager
+from askbot.models.base import bulk_create
 from askbot.conf import settings as askbot_settings
 from askbot import mail
 
@@ -21,18 +22,53 @@ class ReplyAddressManager(BaseQuerySetManager):
             used_at__isnull = True
         )
     
+    def make_address(self):
+        """returns random code for the reply address"""
+        return ''.join(random.choice(string.letters +
+            string.digits) for i in xrange(random.randint(12, 25))).lower()
+
     def create_new(self, **kwargs):
         """creates a new reply address"""
         kwargs['allowed_from_email'] = kwargs['user'].email
         reply_address = ReplyAddress(**kwargs)
         while True:
-            reply_address.address = ''.join(random.choice(string.letters +
-                string.digits) for i in xrange(random.randint(12, 25))).lower()
+            reply_address.address = self.make_address()
             if self.filter(address = reply_address.address).count() == 0:
                 break
         reply_address.save()
         return reply_address
-			
+
+    def create_many(self, records):
+        """creates reply addresses with one insert,
+        ``records`` is a list of dictionaries of the
+        arguments of :meth:`create_new`,
+        returns list of the reply addresses"""
+        reply_addresses = list()
+        for kwargs in records:
+            kwargs = dict(kwargs)
+            kwargs['allowed_from_email'] = kwargs['user'].email
+            reply_addresses.append(ReplyAddress(**kwargs))
+
+        #make addresses unique among the new ones and the saved ones
+        chosen = set()
+        pending = reply_addresses
+        while pending:
+            for reply_address in pending:
+                address = self.make_address()
+                while address in chosen:
+                    address = self.make_address()
+                chosen.add(address)
+                reply_address.address = address
+            taken = set(
+                self.filter(
+                    address__in = [item.address for item in pending]
+                ).values_list('address', flat = True)
+            )
+            pending = [item for item in pending if item.address in taken]
+
+        bulk_create(ReplyAddress, reply_addresses)
+        return reply_addresses
+
 
 REPLY_ACTION_CHOICES = (
     ('post_answer', ugettext_lazy('Post an answer')),
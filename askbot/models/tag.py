@@ -1,13 +1,16 @@
 import re
 from django.db import models
 from django.contrib.auth.models import User
+from django.core import cache
 from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_lazy
 from django.conf import settings
 from askbot.models.base import BaseQuerySetManager
+from askbot.models.base import bulk_create
 from askbot import const
 from askbot.conf import settings as askbot_settings
 from askbot.utils import category_tree
+from askbot.utils.functions import generate_random_key
 
 def delete_tags(tags):
     """deletes tags in the list"""
@@ -75,13 +78,273 @@ def tags_match_some_wildcard(tag_names, wildcard_tags):
     """Same as
     :meth:`~askbot.models.tag.TagQuerySet.tags_match_some_wildcard`
     except it works on tag name strings
+
+    Each prefix of the tag names is looked up
+    in the set of the wildcard prefixes
     """
+    prefixes = set([wildcard_tag[:-1] for wildcard_tag in wildcard_tags])
+    if len(prefixes) == 0:
+        return False
     for tag_name in tag_names:
-        for wildcard_tag in sorted(wildcard_tags):
-            if tag_name.startswith(wildcard_tag[:-1]):
+        for length in range(len(tag_name) + 1):
+            if tag_name[:length] in prefixes:
                 return True
     return False
 
+class TagNameMap(object):
+    """In-process map of the case-folded tag names
+    to lists of tuples (tag id, tag name).
+
+    Names are loaded on demand, all unknown names at once
+    in a single query. Processes share the version
+    of the map through the cache, it is changed by
+    :meth:`invalidate` when tags are created, renamed or deleted.
+    """
+    VERSION_CACHE_KEY = 'tag-name-map-version'
+    MAX_SIZE = 10000
+
+    def __init__(self):
+        self.version = None
+        self.tags = dict()
+
+    def check_version(self):
+        version = cache.cache.get(self.VERSION_CACHE_KEY)
+        if version is None:
+            version = generate_random_key()
+            cache.cache.set(self.VERSION_CACHE_KEY, version, const.LONG_TIME)
+        if version != self.version or len(self.tags) > self.MAX_SIZE:
+            self.tags = dict()
+            self.version = version
+
+    def invalidate(self):
+        self.version = generate_random_key()
+        self.tags = dict()
+        cache.cache.set(self.VERSION_CACHE_KEY, self.version, const.LONG_TIME)
+
+    def load(self, tag_names):
+        """loads unknown tag names with one query"""
+        self.check_version()
+        missing = set([name.lower() for name in tag_names]) - set(self.tags)
+        if not missing:
+            return
+        missing = list(missing)
+        tag_filter = models.Q(name__iexact=missing[0])
+        for name in missing[1:]:
+            tag_filter |= models.Q(name__iexact=name)
+
+        found = dict([(name, list()) for name in missing])
+        for tag_id, name in Tag.objects.filter(tag_filter).values_list('id', 'name'):
+            found.setdefault(name.lower(), list()).append((tag_id, name))
+        self.tags.update(found)
+
+    def resolve(self, tag_names, case_sensitive=True):
+        """returns a tuple: list of tuples (tag id, tag name)
+        of the found tags and a set of names that were not found
+        """
+        self.load(tag_names)
+        found = list()
+        not_found = set()
+        for name in tag_names:
+            candidates = self.tags.get(name.lower(), ())
+            match = None
+            for candidate in candidates:
+                if candidate[1] == name:
+                    match = candidate
+                    break
+            if match is None and case_sensitive == False and candidates:
+                match = candidates[0]
+            if match:
+                found.append(match)
+            else:
+                not_found.add(name)
+        return found, not_found
+
+tag_name_map = TagNameMap()
+
+def resolve_tag_names(tag_names, case_sensitive=True):
+    """returns a tuple: list of tuples (tag id, tag name)
+    and set of tag names that do not exist.
+    Does not hit the database for the tag names seen before.
+    """
+    return tag_name_map.resolve(tag_names, case_sensitive=case_sensitive)
+
+TAG_MARK_REASONS = ('good', 'bad', 'subscribed')
+WILDCARD_TAG_ATTRIBUTES = {
+    'good': 'interesting_tags',
+    'bad': 'ignored_tags',
+    'subscribed': 'subscribed_tags'
+}
+
+def get_wildcard_selector_ids(tag_names, reason):
+    """returns set of ids of the users whose wildcards
+    with the given reason match any of the tag names.
+
+    Each prefix of the tag names is looked up in the
+    :class:`WildcardTagSelection` table with one query, so the cost
+    does not depend on the number of users who have the wildcards.
+    """
+    prefixes = set()
+    for tag_name in tag_names:
+        for length in range(len(tag_name) + 1):
+            prefixes.add(tag_name[:length])
+    if len(prefixes) == 0:
+        return set()
+    selections = WildcardTagSelection.objects.filter(
+                                        reason = reason,
+                                        prefix__in = prefixes
+                                    )
+    return set(selections.values_list('user', flat = True))
+
+def update_wildcard_selection_index(user):
+    """replaces records of the user in the :class:`WildcardTagSelection`
+    table with the wildcards currently selected by the user"""
+    WildcardTagSelection.objects.filter(user = user).delete()
+    selections = list()
+    for reason in TAG_MARK_REASONS:
+        wildcards = set(getattr(user, WILDCARD_TAG_ATTRIBUTES[reason]).split())
+        for wildcard in wildcards:
+            selections.append(
+                WildcardTagSelection(
+                    user = user, reason = reason, prefix = wildcard[:-1]
+                )
+            )
+    if selections:
+        bulk_create(WildcardTagSelection, selections)
+
+def get_tag_ids_by_wildcards(wildcards):
+    """returns set of ids of the tags whose names
+    start with any of the wildcards (without the asterisks)"""
+    tags = Tag.objects.get_by_wildcards(wildcards)
+    return set(tags.values_list('id', flat = True))
+
+def update_wildcard_tag_ids(records):
+    """finds tags matching the wildcards of the
+    :class:`UserTagPreferences` records, all records
+    are matched against the result of one query"""
+    wildcards = set()
+    for record in records:
+        for reason in TAG_MARK_REASONS:
+            wildcards.update(record.wildcards[reason])
+    tags = list()
+    if wildcards:
+        tags = list(Tag.objects.get_by_wildcards(wildcards).values_list('id', 'name'))
+
+    for record in records:
+        record.version = tag_name_map.version
+        for reason in TAG_MARK_REASONS:
+            prefixes = tuple([wildcard[:-1] for wildcard in record.wildcards[reason]])
+            if prefixes:
+                record.wildcard_tag_ids[reason] = set([
+                    tag_id for tag_id, name in tags if name.startswith(prefixes)
+                ])
+            else:
+                record.wildcard_tag_ids[reason] = set()
+
+
+class UserTagPreferences(object):
+    """Tag selections of one user: ids and names of the marked tags
+    and the wildcards with ids of the tags they match,
+    each by the mark reason - "good", "bad" or "subscribed".
+
+    The record is cached, see :func:`get_user_tag_preferences`.
+    When the tag name map changes only the ids of the tags matching
+    the wildcards are recomputed, see :func:`update_wildcard_tag_ids`.
+    Records of the users who marked a renamed or deleted tag
+    are removed from the cache.
+    """
+
+    def __init__(self, user):
+        self.user_id = user.id
+        self.version = tag_name_map.version
+        self.tag_ids = dict()
+        self.tag_names = dict()
+        self.wildcards = dict()
+        self.wildcard_tag_ids = dict()
+        for reason in TAG_MARK_REASONS:
+            self.tag_ids[reason] = set()
+            self.tag_names[reason] = list()
+            self.wildcards[reason] = getattr(
+                            user, WILDCARD_TAG_ATTRIBUTES[reason]
+                        ).split()
+            self.wildcard_tag_ids[reason] = set()
+
+        marks = MarkedTag.objects.filter(user=user)
+        for tag_id, name, reason in marks.values_list(
+                                        'tag__id', 'tag__name', 'reason'
+                                    ):
+            self.tag_ids[reason].add(tag_id)
+            self.tag_names[reason].append(name)
+
+        update_wildcard_tag_ids([self])
+
+    def is_stale(self, user):
+        """True if the wildcards do not match those of the user"""
+        for reason in TAG_MARK_REASONS:
+            wildcards = getattr(user, WILDCARD_TAG_ATTRIBUTES[reason]).split()
+            if wildcards != self.wildcards[reason]:
+                return True
+        return False
+
+    def has_wildcards(self, reason):
+        """True if wildcard tags are on and the user
+        has some wildcards with the given reason"""
+        return askbot_settings.USE_WILDCARD_TAGS \
+            and len(self.wildcards[reason]) > 0
+
+    def get_tag_ids(self, reason):
+        """returns set of ids of the tags selected directly
+        or, if wildcard tags are on, via the wildcards"""
+        tag_ids = set(self.tag_ids[reason])
+        if askbot_settings.USE_WILDCARD_TAGS:
+            tag_ids.update(self.wildcard_tag_ids[reason])
+        return tag_ids
+
+
+def get_user_tag_preferences_cache_key(user_id):
+    return 'user-tag-preferences-%d' % user_id
+
+def get_user_tag_preferences(users):
+    """returns dictionary of :class:`UserTagPreferences`
+    keyed by the user id, the records missing
+    in the cache are built and cached"""
+    tag_name_map.check_version()
+    keys = dict()
+    for user in users:
+        keys[get_user_tag_preferences_cache_key(user.id)] = user
+    cached = cache.cache.get_many(keys.keys())
+
+    preferences = dict()
+    changed = dict()
+    outdated = dict()
+    for key, user in keys.items():
+        record = cached.get(key)
+        if record is None or record.is_stale(user):
+            record = UserTagPreferences(user)
+            changed[key] = record
+        elif record.version != tag_name_map.version:
+            outdated[key] = record
+        preferences[user.id] = record
+
+    if outdated:
+        update_wildcard_tag_ids(outdated.values())
+        changed.update(outdated)
+
+    if changed:
+        cache.cache.set_many(changed, const.LONG_TIME)
+    return preferences
+
+def invalidate_user_tag_preferences(user):
+    """to be called when user changes selection of tags"""
+    cache.cache.delete(get_user_tag_preferences_cache_key(user.id))
+
+def invalidate_tag_selections(tag):
+    """removes cached preferences of the users who marked the tag,
+    those contain the tag name"""
+    user_ids = MarkedTag.objects.filter(tag=tag).values_list('user__id', flat=True)
+    cache.cache.delete_many(
+        [get_user_tag_preferences_cache_key(user_id) for user_id in user_ids]
+    )
+
 def get_mandatory_tags():
     """returns list of mandatory tags,
     or an empty list, if there aren't any"""
@@ -134,14 +397,9 @@ class TagQuerySet(models.query.QuerySet):
         matches a wildcard
 
         :arg:`wildcard_tags` is an iterable of wildcard tag strings
-
-        todo: refactor to use :func:`tags_match_some_wildcard`
         """
-        for tag in self.all():
-            for wildcard_tag in sorted(wildcard_tags):
-                if tag.name.startswith(wildcard_tag[:-1]):
-                    return True
-        return False
+        tag_names = self.values_list('name', flat = True)
+        return tags_match_some_wildcard(tag_names, wildcard_tags)
 
     def get_by_wildcards(self, wildcards = None):
         """returns query set of tags that match the wildcard tags
@@ -151,6 +409,7 @@ class TagQuerySet(models.query.QuerySet):
         """
         if wildcards is None or len(wildcards) == 0:
             return self.none()
+        wildcards = list(wildcards)
         first_tag = wildcards.pop()
         tag_filter = models.Q(name__startswith = first_tag[:-1])
         for next_tag in wildcards:
@@ -303,6 +562,11 @@ class Tag(models.Model):
         db_table = u'tag'
         ordering = ('-used_count', 'name')
 
+    def __init__(self, *args, **kwargs):
+        super(Tag, self).__init__(*args, **kwargs)
+        #remembered to detect renames, see update_tag_name_map()
+        self._original_name = self.__dict__.get('name')
+
     def __unicode__(self):
         return self.name
 
@@ -318,3 +582,35 @@ class MarkedTag(models.Model):
 
     class Meta:
         app_label = 'askbot'
+
+class WildcardTagSelection(models.Model):
+    """Reverse index of the wildcard tags selected by the users:
+    the wildcard prefix (the wildcard without the asterisk),
+    the user and the reason, as in :class:`MarkedTag`.
+    The records follow the wildcard fields of the user,
+    see :func:`update_wildcard_selection_index`.
+    """
+    prefix = models.CharField(max_length=255)
+    user = models.ForeignKey(User, related_name='wildcard_tag_selections')
+    reason = models.CharField(max_length=16, choices=MarkedTag.TAG_MARK_REASONS)
+
+    class Meta:
+        app_label = 'askbot'
+        unique_together = ('prefix', 'reason', 'user')
+
+def update_tag_name_map(sender, instance=None, created=False, **kwargs):
+    """invalidates the tag name map when a tag
+    is created, renamed or deleted"""
+    if kwargs.get('signal') == models.signals.post_delete:
+        tag_name_map.invalidate()
+    elif created:
+        tag_name_map.invalidate()
+    elif instance._original_name != instance.name:
+        tag_name_map.invalidate()
+        invalidate_tag_selections(instance)
+    instance._original_name = instance.name
+
+def forget_tag_selections(sender, instance=None, **kwargs):
+    """before the tag is deleted, together with the selections,
+    removes cached preferences of the users who marked it"""
+    invalidate_tag_selections(instance)
@@ -15,6 +15,7 @@ from django.utils.html import strip_tags
 from askbot import const
 from askbot.conf import settings as askbot_settings
 from askbot.utils import functions
+from askbot.utils import markup
 from askbot.models.base import BaseQuerySetManager
 from askbot.models.tag import Tag
 from askbot.models.tag import clean_group_name#todo - delete this
@@ -661,3 +662,48 @@ class BulkTagSubscription(models.Model):
     class Meta:
         app_label = 'askbot'
         ordering = ['-date_added']
+
+
+#number of the possible usernames looked up with one query
+MENTION_CANDIDATES_PER_QUERY = 100
+
+def find_mentions(text, preferred_user_ids = None):
+    """returns list of tuples (position of the @ character,
+    end of the mention, user) of the @mentions in the text.
+    The users named as the phrases after the '@' characters
+    are loaded with one query for up to ``MENTION_CANDIDATES_PER_QUERY``
+    phrases. When several usernames match, the users are chosen
+    from ``preferred_user_ids``, if given - a callable returning
+    a set of ids, it is only called for such ambiguous mentions,
+    otherwise the longest username is chosen
+    """
+    max_length = User._meta.get_field('username').max_length
+    candidates = list(markup.get_mention_candidates(text, max_length))
+    users = list()
+    for start in range(0, len(candidates), MENTION_CANDIDATES_PER_QUERY):
+        query = models.Q()
+        for name in candidates[start:start + MENTION_CANDIDATES_PER_QUERY]:
+            query |= models.Q(username__iexact = name)
+        users.extend(User.objects.filter(query))
+    if len(users) == 0:
+        return list()
+
+    users.sort(key = lambda user: user.username.lower())
+    names = [user.username.lower() for user in users]
+    found = list()
+    last_end = 0
+    preferred = None
+    for pos, matches in markup.find_mentions(text, names):
+        if pos < last_end:
+            continue#within the previous mention
+        end, index = matches[0]
+        if len(matches) > 1 and preferred_user_ids:
+            if preferred is None:
+                preferred = preferred_user_ids()
+            for match in matches:
+                if users[match[1]].id in preferred:
+                    end, index = match
+                    break
+        found.append((pos, end, users[index]))
+        last_end = end
+    return found
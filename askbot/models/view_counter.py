@@ -0,0 +1,38 @@
+"""Write-behind counter of the question views.
+
+Instead of updating the thread row on each page view
+the views are counted in the cache (see :mod:`askbot.utils.write_behind`)
+and saved to the database in batches
+by :meth:`askbot.models.Thread.objects.flush_view_counts`
+- at most once in ``VIEW_COUNT_FLUSH_INTERVAL`` seconds
+and by the management command ``flush_view_counts``.
+"""
+import operator
+
+from django.utils.translation import ungettext
+
+from askbot.utils import functions
+from askbot.utils.write_behind import WriteBehindBuffer, can_buffer
+
+views_buffer = WriteBehindBuffer('thread-views')
+
+def add_views(thread_id, increment=1):
+    """counts views of the thread,
+    returns number of views not yet saved to the database"""
+    return views_buffer.incr(thread_id, increment)
+
+def is_flush_due(interval):
+    return views_buffer.is_flush_due(interval)
+
+def take_pending_views():
+    """returns dictionary of thread id -> number of views
+    not yet saved to the database"""
+    views = views_buffer.take(merge=operator.add)
+    return dict(
+        [(thread_id, count) for thread_id, count in views.items() if count > 0]
+    )
+
+def get_view_count_display(count):
+    """returns parts of the question summary
+    that depend on the view count"""
+    return functions.humanize_counter(count), ungettext('view', 'views', count)
@@ -0,0 +1,205 @@
+"""Keyset (a.k.a. "seek") pagination for the question listings.
+
+Offset pagination needs the database to skip over all the
+preceding rows, so the cost of a page grows with its number.
+Here the "next" and "previous" links carry an opaque cursor
+with the sort column value and the id of the boundary thread,
+so any page reached through those links costs the same
+as the first one.
+
+Pages requested by the number only (without the cursor) are still
+fetched with the offset, which is cheap for the first few pages
+and keeps the numbered paginator links working.
+
+The total number of matching questions is only needed to render
+the paginator and the question counter, it is cached
+for ``QUESTION_COUNT_CACHE_TIMEOUT`` seconds.
+"""
+import base64
+import datetime
+
+from django.core import cache
+from django.db import models
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+
+from askbot.conf import settings as askbot_settings
+from askbot.models.question import QUESTION_ORDER_BY_MAP
+from askbot.models.question import Thread
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def get_sort_field(sort_method):
+    """returns tuple (field name, is descending)
+    or ``None`` if keyset pagination is not possible
+    with the given sort method"""
+    order_by = QUESTION_ORDER_BY_MAP.get(sort_method)
+    if order_by is None or sort_method.startswith('relevance'):
+        #relevance is calculated by the full text search
+        #and can't be used to seek through the results
+        return None
+    return order_by.lstrip('-'), order_by.startswith('-')
+
+def supports_sort(sort_method):
+    return get_sort_field(sort_method) is not None
+
+def is_valid_sort_value(value, field):
+    """True if ``value`` has the type of the
+    ``Thread`` field by which the threads are sorted"""
+    if isinstance(Thread._meta.get_field(field), models.DateTimeField):
+        return isinstance(value, datetime.datetime)
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def encode_cursor(sort_method, direction, value, thread_id):
+    """returns url-safe cursor string,
+    ``direction`` is either 'next' or 'prev'"""
+    if isinstance(value, datetime.datetime):
+        value = {'dt': value.strftime(DATETIME_FORMAT)}
+    data = [sort_method, direction, value, thread_id]
+    return base64.urlsafe_b64encode(simplejson.dumps(data)).rstrip('=')
+
+def decode_cursor(cursor, sort_method):
+    """returns tuple (direction, value, thread_id)
+    or ``None`` if cursor is invalid or was made
+    for a different sort method"""
+    if not cursor:
+        return None
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        data = simplejson.loads(base64.urlsafe_b64decode(str(cursor) + padding))
+        cursor_sort, direction, value, thread_id = data
+        if isinstance(value, dict):
+            value = datetime.datetime.strptime(value['dt'], DATETIME_FORMAT)
+        thread_id = int(thread_id)
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        return None
+    if cursor_sort != sort_method or direction not in ('next', 'prev'):
+        return None
+    sort_field = get_sort_field(sort_method)
+    if sort_field is None or not is_valid_sort_value(value, sort_field[0]):
+        return None
+    return direction, value, thread_id
+
+def get_cached_count(threads):
+    """returns count of the threads in the query set,
+    the count is cached under the key made of
+    the sql query so that it can be shared between
+    visitors seeing the same listing"""
+    if isinstance(threads, models.query.EmptyQuerySet):
+        #the sql of the empty query set is not the query that runs
+        return 0
+    timeout = askbot_settings.QUESTION_COUNT_CACHE_TIMEOUT
+    if timeout <= 0:
+        return threads.count()
+    key = 'thread-count-' + md5_constructor(
+                                    unicode(threads.query).encode('utf-8')
+                                ).hexdigest()
+    count = cache.cache.get(key)
+    if count is None:
+        count = threads.count()
+        cache.cache.set(key, count, timeout)
+    return count
+
+
+class KeysetPage(object):
+    """Page of threads, replaces :class:`django.core.paginator.Page`
+    on the main page. Does not require the total count.
+
+    Subclasses may fetch the rows from elsewhere by overriding
+    methods ``_seek``, ``_slice``, ``_get_position`` and ``_load``.
+    """
+
+    def __init__(self, threads, search_state, page_size):
+        self.number = search_state.page
+        self.page_size = page_size
+        self.sort_method = search_state.sort
+        self.next_cursor = None
+        self.previous_cursor = None
+
+        sort_field = get_sort_field(self.sort_method)
+        position = None
+        if sort_field:
+            position = decode_cursor(search_state.cursor, self.sort_method)
+
+        if position:
+            field, descending = sort_field
+            direction, value, thread_id = position
+            backwards = (direction == 'prev')
+            rows = self._seek(threads, field, descending, value, thread_id, backwards)
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            if backwards:
+                rows.reverse()
+                self._has_previous = has_more
+                self._has_next = True
+            else:
+                self._has_previous = True
+                self._has_next = has_more
+        else:
+            offset = (self.number - 1) * page_size
+            rows = self._slice(threads, offset, page_size + 1)
+            self._has_previous = self.number > 1
+            self._has_next = len(rows) > page_size
+            rows = rows[:page_size]
+
+        #seeking back to the very beginning may land on a page
+        #with a number > 1 if threads were added in the meantime
+        if self._has_previous == False:
+            self.number = 1
+
+        if sort_field and rows:
+            field = sort_field[0]
+            if self._has_next:
+                value, thread_id = self._get_position(rows[-1], field)
+                self.next_cursor = encode_cursor(
+                    self.sort_method, 'next', value, thread_id
+                )
+            if self._has_previous:
+                value, thread_id = self._get_position(rows[0], field)
+                self.previous_cursor = encode_cursor(
+                    self.sort_method, 'prev', value, thread_id
+                )
+
+        self.object_list = self._load(rows)
+
+    def _seek(self, threads, field, descending, value, thread_id, backwards):
+        """returns list of up to page_size + 1 threads
+        following the position in the given direction"""
+        if descending != backwards:
+            op, sign = 'lt', '-'
+        else:
+            op, sign = 'gt', ''
+        seek_filter = models.Q(**{field + '__' + op: value}) \
+            | models.Q(**{field: value, 'id__' + op: thread_id})
+        threads = threads.filter(seek_filter)
+        threads = threads.extra(order_by=[sign + field, sign + 'id'])
+        return list(threads[:self.page_size + 1])
+
+    def _slice(self, threads, offset, limit):
+        return list(threads[offset:offset + limit])
+
+    def _get_position(self, row, field):
+        """returns tuple (sort value, thread id) for the row"""
+        return getattr(row, field), row.id
+
+    def _load(self, rows):
+        """turns rows into the list of threads"""
+        return rows
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
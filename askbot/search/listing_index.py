@@ -0,0 +1,317 @@
+"""Precomputed thread listings for the anonymous visitors.
+
+For each combination of scope, sort method, language and
+(optionally) one tag the cache holds an ordered list of
+``(sort value, thread id)`` pairs - up to ``INDEX_SIZE``
+of the first threads in the listing.
+
+The lists are built on the first request and then kept
+current by :meth:`askbot.models.Thread.update_listing_index`,
+which is called whenever the thread data that affects listings
+changes (activity, answer count, votes, tags, deletion, sharing
+with groups etc.).
+
+The listings are changed by one process at a time, under a lock
+taken with the cache ``add``. A process that cannot take the lock
+resets all listings - by changing the version that is part of
+their cache keys - rather than let its change be overwritten.
+A listing built from the database while some thread was updated
+is not stored, because it may miss that update.
+
+With the list at hand the page of threads is loaded by primary key,
+without running the multi-join listing query.
+Pages past the end of an incomplete list are served by the regular
+query in :mod:`askbot.search.keyset`.
+"""
+import bisect
+
+from django.conf import settings as django_settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import cache
+from django.utils import translation
+from django.utils.hashcompat import md5_constructor
+
+from askbot.conf import settings as askbot_settings
+from askbot.models import Thread
+from askbot.models.tag import resolve_tag_names
+from askbot.models.question import QUESTION_ORDER_BY_MAP
+from askbot.search import keyset
+from askbot.utils.functions import generate_random_key
+from askbot.utils.write_behind import incr
+
+LISTING_SCOPES = ('all', 'unanswered')
+INDEX_SIZE = 1000
+INDEX_TIMEOUT = 60*60
+VERSION_CACHE_KEY = 'thread-listing-version'
+UPDATE_COUNT_CACHE_KEY = 'thread-listing-updates'
+LOCK_CACHE_KEY = 'thread-listing-lock'
+LOCK_TIMEOUT = 10
+
+THREAD_FIELDS = (
+    'id', 'title', 'view_count', 'answer_count', 'last_activity_at',
+    'last_activity_by', 'closed', 'tagnames', 'accepted_answer',
+    'added_at', 'points'
+)
+
+
+class IndexMiss(Exception):
+    """raised when the page cannot be served
+    from the precomputed listing"""
+
+
+def get_language_code(thread=None):
+    """returns language code used in the listing key"""
+    if getattr(django_settings, 'ASKBOT_MULTILINGUAL', False):
+        if thread:
+            return thread.language_code
+        return translation.get_language()
+    return ''
+
+def get_version():
+    """returns version of all the listings,
+    a part of their cache keys"""
+    version = cache.cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        version = generate_random_key()
+        cache.cache.add(VERSION_CACHE_KEY, version, INDEX_TIMEOUT)
+        version = cache.cache.get(VERSION_CACHE_KEY) or version
+    return version
+
+def invalidate_listings():
+    """resets all listings, they are rebuilt on the next request"""
+    cache.cache.set(VERSION_CACHE_KEY, generate_random_key(), INDEX_TIMEOUT)
+
+def get_cache_key(scope, sort_method, language_code, tag_name=None, version=None):
+    if tag_name:
+        tag_key = md5_constructor(tag_name.encode('utf-8')).hexdigest()
+    else:
+        tag_key = ''
+    if version is None:
+        version = get_version()
+    return 'thread-listing-%s-%s-%s-%s-%s' % (
+                                version, scope, sort_method, language_code, tag_key
+                            )
+
+def get_listing_queryset(scope, sort_method, language_code, tag_name=None):
+    """returns the query set of threads exactly
+    as it is shown to the anonymous visitor"""
+    #import here to avoid the circular import
+    from askbot.search.state_manager import SearchState
+    search_state = SearchState(
+        scope=scope, sort=sort_method, query=None, tags=tag_name,
+        author=None, page=None, user_logged_in=False
+    )
+    previous_language = translation.get_language()
+    if language_code:
+        translation.activate(language_code)
+    try:
+        threads, meta_data = Thread.objects.run_advanced_search(
+                                    request_user=AnonymousUser(),
+                                    search_state=search_state
+                                )
+    finally:
+        translation.activate(previous_language)
+    return threads
+
+def build_listing(scope, sort_method, language_code, tag_name=None):
+    """returns tuple (is complete, list of [sort value, thread id])"""
+    field = keyset.get_sort_field(sort_method)[0]
+    threads = get_listing_queryset(scope, sort_method, language_code, tag_name)
+    items = [list(row) for row in threads.values_list(field, 'id')[:INDEX_SIZE + 1]]
+    is_complete = len(items) <= INDEX_SIZE
+    return is_complete, items[:INDEX_SIZE]
+
+def get_listing(scope, sort_method, language_code, tag_name=None):
+    key = get_cache_key(scope, sort_method, language_code, tag_name)
+    listing = cache.cache.get(key)
+    if listing is None:
+        update_count = cache.cache.get(UPDATE_COUNT_CACHE_KEY)
+        listing = build_listing(scope, sort_method, language_code, tag_name)
+        if cache.cache.get(UPDATE_COUNT_CACHE_KEY) == update_count:
+            cache.cache.set(key, listing, INDEX_TIMEOUT)
+    return listing
+
+def can_serve(user, search_state):
+    """True if the listing for this user and search state
+    may be served from the index"""
+    return user.is_anonymous() \
+        and search_state.scope in LISTING_SCOPES \
+        and keyset.supports_sort(search_state.sort) \
+        and not search_state.query \
+        and not search_state.author \
+        and len(search_state.tags) <= 1
+
+def is_unanswered(values):
+    """same condition as the one used in the search
+    by the "unanswered" scope, over the thread field values"""
+    if values['closed']:
+        return False
+    if askbot_settings.UNANSWERED_QUESTION_MEANING == 'NO_ANSWERS':
+        return values['answer_count'] == 0
+    elif askbot_settings.UNANSWERED_QUESTION_MEANING == 'NO_ACCEPTED_ANSWERS':
+        return values['accepted_answer'] is None
+    elif askbot_settings.UNANSWERED_QUESTION_MEANING == 'NO_UPVOTED_ANSWERS':
+        raise NotImplementedError()
+    else:
+        raise Exception('UNANSWERED_QUESTION_MEANING setting is wrong')
+
+def update_thread(thread, removed_tag_names=None):
+    """updates position of the thread in all cached listings
+    where it belongs or used to belong,
+    ``removed_tag_names`` - tags just removed from the thread"""
+    incr(UPDATE_COUNT_CACHE_KEY)
+    if not cache.cache.add(LOCK_CACHE_KEY, True, LOCK_TIMEOUT):
+        #the listings are being changed by another process,
+        #which would overwrite this change
+        invalidate_listings()
+        return
+    try:
+        update_thread_locked(thread, removed_tag_names)
+    finally:
+        cache.cache.delete(LOCK_CACHE_KEY)
+
+def update_thread_locked(thread, removed_tag_names):
+    language_code = get_language_code(thread)
+    tag_names = [None] + thread.get_tag_names()
+    if removed_tag_names:
+        tag_names.extend(set(removed_tag_names) - set(tag_names))
+
+    version = get_version()
+    keys = dict()
+    for scope in LISTING_SCOPES:
+        for sort_method in QUESTION_ORDER_BY_MAP:
+            if not keyset.supports_sort(sort_method):
+                continue
+            for tag_name in tag_names:
+                key = get_cache_key(
+                            scope, sort_method, language_code, tag_name, version
+                        )
+                keys[key] = (scope, sort_method, tag_name)
+
+    listings = cache.cache.get_many(keys.keys())
+    if not listings:
+        return
+
+    #visibility of the thread is checked with the same query
+    #that builds the listings, which also loads the sort values
+    threads = get_listing_queryset('all', 'activity-desc', language_code)
+    values = list(
+                threads.filter(id=thread.id).values(
+                    'added_at', 'last_activity_at', 'answer_count', 'points',
+                    'accepted_answer', 'closed'
+                )
+            )
+    values = values and values[0] or None
+    in_scope = {
+        'all': values is not None,
+        'unanswered': values is not None and is_unanswered(values)
+    }
+
+    current_tag_names = set(thread.get_tag_names())
+    updated = dict()
+    for key, listing in listings.items():
+        scope, sort_method, tag_name = keys[key]
+        belongs = in_scope[scope] \
+                    and (tag_name is None or tag_name in current_tag_names)
+        field, descending = keyset.get_sort_field(sort_method)
+        item = belongs and [values[field], thread.id] or None
+        updated[key] = update_listing(listing, thread.id, item, descending)
+
+    cache.cache.set_many(updated, INDEX_TIMEOUT)
+
+def update_listing(listing, thread_id, item, descending):
+    """returns listing with the thread moved into
+    the position given by the item, or removed if item is ``None``"""
+    is_complete, items = listing
+    items = [entry for entry in items if entry[1] != thread_id]
+    if item:
+        #items are sorted ascending or descending by (value, id)
+        keys = [tuple(entry) for entry in items]
+        if descending:
+            keys.reverse()
+            position = len(keys) - bisect.bisect_left(keys, tuple(item))
+        else:
+            position = bisect.bisect_left(keys, tuple(item))
+        #past the end of incomplete listing there may be
+        #threads that are not in the index
+        if is_complete or position < len(items):
+            items.insert(position, item)
+    if len(items) > INDEX_SIZE:
+        items = items[:INDEX_SIZE]
+        is_complete = False
+    return is_complete, items
+
+def get_page(search_state, page_size):
+    """returns :class:`IndexedPage` or ``None``
+    if the page has to be fetched with the regular query"""
+    tag_name = None
+    if search_state.tags:
+        tag_name = search_state.tags[0]
+        #tag search may be case-insensitive, but listings
+        #are maintained for the exact tag names
+        found_tags, non_existing_tags = resolve_tag_names([tag_name])
+        if non_existing_tags:
+            return None
+
+    listing = get_listing(
+                    search_state.scope,
+                    search_state.sort,
+                    get_language_code(),
+                    tag_name
+                )
+    try:
+        return IndexedPage(listing, search_state, page_size)
+    except IndexMiss:
+        return None
+
+
+class IndexedPage(keyset.KeysetPage):
+    """Page of threads served from the precomputed listing,
+    ``threads`` is the listing tuple (is complete, items)
+    """
+
+    def __init__(self, listing, search_state, page_size):
+        self.is_complete, items = listing
+        self.count = self.is_complete and len(items) or None
+        super(IndexedPage, self).__init__(items, search_state, page_size)
+
+    def _check_range(self, items, end):
+        if end > len(items) and not self.is_complete:
+            raise IndexMiss()
+
+    def _seek(self, items, field, descending, value, thread_id, backwards):
+        keys = [tuple(entry) for entry in items]
+        position = (value, thread_id)
+        if descending:
+            #index of the first item that goes after the position
+            start = len(keys) - bisect.bisect_left(keys[::-1], position)
+        else:
+            start = bisect.bisect_right(keys, position)
+        if backwards:
+            #items before the position, closest first
+            if start == len(keys) and (not keys or keys[-1] != position):
+                #the position itself is past the indexed items
+                self._check_range(items, len(items) + 1)
+            end = start
+            if end > 0 and keys[end - 1] == position:
+                end -= 1
+            begin = max(0, end - self.page_size - 1)
+            result = items[begin:end]
+            result.reverse()
+            return result
+        end = start + self.page_size + 1
+        self._check_range(items, end)
+        return items[start:end]
+
+    def _slice(self, items, offset, limit):
+        self._check_range(items, offset + limit)
+        return items[offset:offset + limit]
+
+    def _get_position(self, row, field):
+        return row[0], row[1]
+
+    def _load(self, rows):
+        thread_ids = [row[1] for row in rows]
+        threads = Thread.objects.filter(id__in=thread_ids).only(*THREAD_FIELDS)
+        thread_map = dict([(thread.id, thread) for thread in threads])
+        return [thread_map[tid] for tid in thread_ids if tid in thread_map]
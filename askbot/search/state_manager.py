@@ -81,13 +81,16 @@ def parse_query(query):
         'query_users': query_users
     }
 
+#marks position of the tags in the query string, see SearchState.get_tag_url()
+TAG_SLOT = object()
+
 class SearchState(object):
 
     @classmethod
     def get_empty(cls):
         return cls(scope=None, sort=None, query=None, tags=None, author=None, page=None, user_logged_in=None)
 
-    def __init__(self, scope, sort, query, tags, author, page, user_logged_in):
+    def __init__(self, scope, sort, query, tags, author, page, user_logged_in, cursor=None):
         # INFO: zip(*[('a', 1), ('b', 2)])[0] == ('a', 'b')
 
         if (scope not in zip(*const.POST_SCOPE_LIST)[0]) or (scope == 'favorite' and not user_logged_in):
@@ -133,7 +136,12 @@ class SearchState(object):
         if self.page == 0:  # in case someone likes jokes :)
             self.page = 1
 
+        #opaque position in the listing used by the keyset
+        #pagination, see askbot.search.keyset
+        self.cursor = cursor or None
+
         self._questions_url = urlresolvers.reverse('questions')
+        self._tag_url_parts = None #see get_tag_url()
 
     def __str__(self):
         return self.query_string()
@@ -174,7 +182,11 @@ class SearchState(object):
         responsible to display the full text search results,
         taking into account sort method, selected scope
         and search tags"""
+        return '/'.join(self._get_query_string_items()) + '/'
 
+    def _get_query_string_items(self, tags_item=None):
+        """returns list of the query string items,
+        ``tags_item`` if given replaces the item with tags"""
         lst = [
             'scope:' + self.scope,
             'sort:' + self.sort
@@ -182,17 +194,46 @@ class SearchState(object):
 
         if self.query:
             lst.append('query:' + urllib.quote(smart_str(self.query), safe=self.SAFE_CHARS))
-        if self.tags:
+        if tags_item is not None:
+            lst.append(tags_item)
+        elif self.tags:
             lst.append('tags:' + urllib.quote(smart_str(const.TAG_SEP.join(self.tags)), safe=self.SAFE_CHARS))
         if self.author:
             lst.append('author:' + str(self.author))
         if self.page:
             lst.append('page:' + str(self.page))
-        return '/'.join(lst) + '/'
+        if self.cursor:
+            lst.append('cursor:' + self.cursor)
+        return lst
+
+    def get_tag_url(self, tag):
+        """returns the same url as ``self.add_tag(tag).full_url()``,
+        but without copying the search state - the url parts
+        around the added tag are calculated once per search state"""
+        if tag in self.tags:
+            return self.full_url()
+        if self._tag_url_parts is None:
+            ss = self.deepcopy()
+            ss.page = 1
+            ss.cursor = None
+            items = ss._get_query_string_items(tags_item=TAG_SLOT)
+            position = items.index(TAG_SLOT)
+            tags_item = 'tags:'
+            if self.tags:
+                tags_item += urllib.quote(
+                            smart_str(const.TAG_SEP.join(self.tags) + const.TAG_SEP),
+                            safe=self.SAFE_CHARS
+                        )
+            prefix = self._questions_url + '/'.join(items[:position] + [tags_item])
+            suffix = ''.join(['/' + item for item in items[position + 1:]]) + '/'
+            self._tag_url_parts = (prefix, suffix)
+        prefix, suffix = self._tag_url_parts
+        return prefix + urllib.quote(smart_str(tag), safe=self.SAFE_CHARS) + suffix
 
     def deepcopy(self): # TODO: test me
         "Used to contruct a new SearchState for manipulation, e.g. for adding/removing tags"
         ss = copy.copy(self) #SearchState.get_empty()
+        ss._tag_url_parts = None
 
         #ss.scope = self.scope
         #ss.sort = self.sort
@@ -218,12 +259,14 @@ class SearchState(object):
         if tag not in ss.tags:
             ss.tags.append(tag)
             ss.page = 1 # state change causes page reset
+            ss.cursor = None
         return ss
 
     def remove_author(self):
         ss = self.deepcopy()
         ss.author = None
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def remove_tags(self, tags = None):
@@ -235,23 +278,29 @@ class SearchState(object):
         else:
             ss.tags = []
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_scope(self, new_scope):
         ss = self.deepcopy()
         ss.scope = new_scope
         ss.page = 1
+        ss.cursor = None
         return ss
 
     def change_sort(self, new_sort):
         ss = self.deepcopy()
         ss.sort = new_sort
         ss.page = 1
+        ss.cursor = None
         return ss
 
-    def change_page(self, new_page):
+    def change_page(self, new_page, cursor=None):
+        """``cursor`` is the keyset pagination position,
+        without it the page will be fetched by the offset"""
         ss = self.deepcopy()
         ss.page = new_page
+        ss.cursor = cursor
         return ss
 
 
@@ -266,3 +315,6 @@ class DummySearchState(object): # Used for caching question/thread summaries
 
     def full_url(self):
         return '<<<%s>>>' % self.tag
+
+    def get_tag_url(self, tag):
+        return '<<<%s>>>' % tag
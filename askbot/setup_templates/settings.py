@@ -138,6 +138,7 @@ DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
 #TEMPLATE_DIRS = (,) #template have no effect in askbot, use the variable below
 #ASKBOT_EXTRA_SKINS_DIR = #path to your private skin collection
 #take a look here http://askbot.org/en/question/207/
+#ASKBOT_SHARED_RENDER_CACHE = True #share html rendered from markdown via the cache
 
 TEMPLATE_CONTEXT_PROCESSORS = (
     'django.core.context_processors.request',
@@ -32,8 +32,11 @@ from askbot import const
 from askbot import mail
 from askbot.models import Post, Thread, User, ReplyAddress
 from askbot.models.badges import award_badges_signal
-from askbot.models import get_reply_to_addresses, format_instant_notification_email
-from askbot import exceptions as askbot_exceptions
+from askbot.models.badges import evaluate_queued_badges
+from askbot.models import get_reply_to_addresses_for_users
+from askbot.models import InstantNotificationRenderer
+from askbot.models import save_question_visit
+from askbot.models import flush_question_visits
 
 # TODO: Make exceptions raised inside record_post_update_celery_task() ...
 #       ... propagate upwards to test runner, if only CELERY_ALWAYS_EAGER = True
@@ -161,7 +164,7 @@ def record_question_visit(
     #user = User.objects.get(id = user_id)
     if user.is_authenticated():
         #get response notifications
-        user.visit_question(question_post)
+        save_question_visit(user, question_post)
 
     #3) send award badges signal for any badges
     #that are awarded for question views
@@ -171,6 +174,18 @@ def record_question_visit(
                     context_object = question_post,
                 )
 
+@task(ignore_result = True)
+def evaluate_queued_badges_celery_task():
+    """considers awards of the badges queued
+    by :func:`askbot.models.badges.award_badges`"""
+    evaluate_queued_badges()
+
+@task(ignore_result = True)
+def flush_question_visits_celery_task():
+    """saves the question visits buffered
+    by :func:`askbot.models.save_question_visit`"""
+    flush_question_visits()
+
 @task()
 def send_instant_notifications_about_activity_in_post(
                                                 update_activity = None,
@@ -209,36 +224,42 @@ def send_instant_notifications_about_activity_in_post(
         log_id = None
 
 
-    for user in recipients:
-        if user.is_blocked():
-            continue
-
-        reply_address, alt_reply_address = get_reply_to_addresses(user, post)
+    recipients = [user for user in recipients if not user.is_blocked()]
+    if len(recipients) == 0:
+        return
 
-        subject_line, body_text = format_instant_notification_email(
-                            to_user = user,
+    reply_addresses = get_reply_to_addresses_for_users(recipients, post)
+    renderer = InstantNotificationRenderer(
                             from_user = update_activity.user,
                             post = post,
-                            reply_address = reply_address,
-                            alt_reply_address = alt_reply_address,
                             update_type = update_type,
                             template = get_template('email/instant_notification.html')
                         )
+    messages = list()
+    for user in recipients:
+        reply_address, alt_reply_address = reply_addresses[user.id]
 
-        headers['Reply-To'] = reply_address
-        try:
-            mail.send_mail(
+        subject_line, body_html, body_text = renderer.render(
+                            to_user = user,
+                            reply_address = reply_address,
+                            alt_reply_address = alt_reply_address
+                        )
+
+        message_headers = dict(headers)
+        message_headers['Reply-To'] = reply_address
+        messages.append(
+            mail.make_message(
                 subject_line=subject_line,
-                body_text=body_text,
+                body_text=body_html,
+                plain_text=body_text,
                 recipient_list=[user.email],
-                related_object=origin_post,
-                activity_type=const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT,
-                headers=headers,
-                raise_on_failure=True
-            )
-        except askbot_exceptions.EmailNotSent, error:
-            logger.debug(
-                '%s, error=%s, logId=%s' % (user.email, error, log_id)
+                headers=message_headers
             )
-        else:
+        )
+
+    results = mail.send_mass_mail(messages)
+    for user, sent in zip(recipients, results):
+        if sent:
             logger.debug('success %s, logId=%s' % (user.email, log_id))
+        else:
+            logger.debug('%s, email not sent, logId=%s' % (user.email, log_id))
@@ -287,20 +287,7 @@ def can_see_offensive_flags(user, post):
 # which is needed by some tests
 register.filter('can_see_offensive_flags', can_see_offensive_flags)
 
-@register.filter
-def humanize_counter(number):
-    if number == 0:
-        return _('no')
-    elif number >= 1000:
-        number = number/1000
-        s = '%.1f' % number
-        if s.endswith('.0'):
-            return s[:-2] + 'k'
-        else:
-            return s + 'k'
-    else:
-        return str(number)
-
+humanize_counter = register.filter(functions.humanize_counter)
 
 @register.filter
 def absolute_value(number):
@@ -1,11 +1,18 @@
 import datetime
-from django.conf import settings as django_settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core import management
 from django.core.urlresolvers import reverse
 from django.test.client import Client
 from askbot.tests.utils import AskbotTestCase
 from askbot.conf import settings
+from askbot import const
 from askbot import models
+from askbot.models import badges
 from askbot.models.badges import award_badges_signal
+from askbot.tests.utils import with_settings
+from askbot.tests.utils import call_with_celery_workers
 
 class BadgeTests(AskbotTestCase):
 
@@ -253,8 +260,8 @@ class BadgeTests(AskbotTestCase):
             expected_count = 2
         )
 
+    @with_settings(CIVIC_DUTY_BADGE_MIN_VOTES = 2)
     def test_civic_duty_badge(self):
-        settings.update('CIVIC_DUTY_BADGE_MIN_VOTES', 2)
         question = self.post_question(user = self.u1)
         answer = self.post_answer(user = self.u2, question = question)
         answer2 = self.post_answer(user = self.u1, question = question)
@@ -506,3 +513,201 @@ class BadgeTests(AskbotTestCase):
         self.client.get(reverse('questions'))
         self.assert_have_badge('enthusiast', self.u1, 1)
 
+
+
+class BadgeQueueTests(AskbotTestCase):
+    """badges are queued only when tasks are run by the celery workers,
+    so the events are sent with ``CELERY_ALWAYS_EAGER = False``"""
+
+    def setUp(self):
+        #the queue must not be evicted by the entries of the other tests
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('badge-queue', {})
+        badges.badge_queue.take()
+        #pretend that evaluation is scheduled, so that badges stay in the queue
+        cache.cache.set(badges.badge_queue.flush_lock_key, True, 300)
+        self.u1 = self.create_user(username = 'user1')
+        self.u2 = self.create_user(username = 'user2')
+
+    def tearDown(self):
+        cache.cache = self.old_cache
+
+    def assert_have_badge(self, badge_key, recipient, expected_count):
+        filters = {'badge__slug': badge_key, 'user': recipient}
+        count = models.Award.objects.filter(**filters).count()
+        self.assertEquals(count, expected_count)
+
+    def send_event(self, event, actor, context_object):
+        call_with_celery_workers(award_badges_signal.send, None,
+            event = event,
+            actor = actor,
+            context_object = context_object
+        )
+
+    @with_settings(BADGE_EVALUATION_DELAY = 60)
+    def test_badges_are_evaluated_later(self):
+        question = self.post_question(user = self.u1)
+        self.send_event('upvote_question', self.u2, question)
+        self.assert_have_badge('supporter', self.u2, 0)
+        count = badges.evaluate_queued_badges()
+        self.assertEqual(count, len(badges.EVENTS_TO_BADGES['upvote_question']))
+        self.assert_have_badge('supporter', self.u2, 1)
+        self.assertEqual(badges.evaluate_queued_badges(), 0)
+
+    @with_settings(BADGE_EVALUATION_DELAY = 60)
+    def test_queued_badges_are_deduplicated(self):
+        question = self.post_question(user = self.u1)
+        self.send_event('update_user_profile', self.u1, self.u1)
+        self.send_event('update_user_profile', self.u1, self.u1)
+        #civic duty is considered for both events
+        self.send_event('upvote_question', self.u2, question)
+        self.send_event('downvote', self.u2, question)
+        expected_count = 1 + len(
+            set(badges.EVENTS_TO_BADGES['upvote_question']) \
+            | set(badges.EVENTS_TO_BADGES['downvote'])
+        )
+        self.assertEqual(badges.evaluate_queued_badges(), expected_count)
+
+    @with_settings(BADGE_EVALUATION_DELAY = 60)
+    def test_enthusiast_badge_is_evaluated_later(self):
+        self.u1.last_seen = datetime.datetime.now() - datetime.timedelta(1)
+        self.u1.consecutive_days_visit_count = \
+            settings.ENTHUSIAST_BADGE_MIN_DAYS - 1
+        self.u1.save()
+        client = Client()
+        client.login(method = 'force', user_id = self.u1.id)
+        call_with_celery_workers(client.get, reverse('questions'))
+        self.assert_have_badge('enthusiast', self.u1, 0)
+        badges.evaluate_queued_badges()
+        self.assert_have_badge('enthusiast', self.u1, 1)
+
+    @with_settings(BADGE_EVALUATION_DELAY = 60)
+    def test_badges_queued_while_taking_the_queue_are_evaluated(self):
+        question = self.post_question(user = self.u1)
+        queue = badges.badge_queue
+        generation = queue.get_generation()
+        queue.take()
+        #the event reaches the generation that was just taken
+        queue.get_generation = lambda: generation
+        try:
+            self.send_event('upvote_question', self.u2, question)
+        finally:
+            del queue.get_generation
+        badges.evaluate_queued_badges()
+        self.assert_have_badge('supporter', self.u2, 1)
+
+    @with_settings(BADGE_EVALUATION_DELAY = 60)
+    def test_evaluation_is_rescheduled_for_badges_queued_meanwhile(self):
+        question = self.post_question(user = self.u1)
+        queue = badges.badge_queue
+        take = queue.take
+        def take_and_send_event(**kwargs):
+            del queue.take
+            items = take(**kwargs)
+            self.send_event('upvote_question', self.u2, question)
+            return items
+        queue.take = take_and_send_event
+        #the rescheduled task runs right away, as celery tasks in the tests
+        badges.evaluate_queued_badges()
+        self.assert_have_badge('supporter', self.u2, 1)
+
+
+class BadgeRecomputationTests(AskbotTestCase):
+
+    def setUp(self):
+        self.u1 = self.create_user(username = 'user1')
+        self.u2 = self.create_user(username = 'user2')
+        self.question = self.post_question(user = self.u1)
+        self.answer = self.post_answer(user = self.u2, question = self.question)
+
+    def set_points(self, post, points):
+        """changes points without sending the badge signals"""
+        models.Post.objects.filter(id = post.id).update(points = points)
+
+    def test_all_badges_can_be_recomputed(self):
+        for key in badges.BADGES:
+            badges.get_badge(key).recompute(dry_run = True)
+        management.call_command('recompute_badges', 'nice-answer', dry_run = True)
+
+    def test_multiple_badge_is_awarded_with_activity(self):
+        self.set_points(self.answer, settings.NICE_ANSWER_BADGE_MIN_UPVOTES)
+        bronze_count = self.u2.bronze
+        badge = badges.get_badge('nice-answer')
+        self.assertEqual(badge.recompute(dry_run = True), 1)
+        self.assertEqual(models.Award.objects.count(), 0)
+
+        self.assertEqual(badge.recompute(), 1)
+        award = models.Award.objects.get(badge__slug = 'nice-answer')
+        self.assertEqual(award.user, self.u2)
+        self.assertEqual(award.content_object, self.answer)
+        activity = models.Activity.objects.get(
+                        activity_type = const.TYPE_ACTIVITY_PRIZE
+                    )
+        self.assertEqual(activity.content_object, award)
+        self.assertEqual(list(activity.recipients.all()), [self.u2])
+        self.assertEqual(self.reload_object(self.u2).bronze, bronze_count + 1)
+        self.assertEqual(badge.get_stored_data().awarded_count, 1)
+
+        self.assertEqual(badge.recompute(), 0)
+        question = self.post_question(user = self.u1)
+        answer = self.post_answer(user = self.u2, question = question)
+        self.set_points(answer, settings.NICE_ANSWER_BADGE_MIN_UPVOTES)
+        self.assertEqual(badge.recompute(), 1)
+
+    def test_award_saved_meanwhile_has_one_activity(self):
+        badge = badges.get_badge('nice-answer')
+        badge_data = badge.get_stored_data()
+        timestamp = datetime.datetime.now().replace(microsecond = 0)
+        other_answer = self.post_answer(
+                                user = self.u2,
+                                question = self.post_question(user = self.u1)
+                            )
+        bulk_create = badges.bulk_create
+        def bulk_create_and_award(model_class, objects):
+            bulk_create(model_class, objects)
+            if model_class is models.Award:
+                #awarded after an event in the same second
+                models.Award(
+                    user = self.u2,
+                    badge = badge_data,
+                    content_object = other_answer,
+                    awarded_at = timestamp
+                ).save()
+        badges.bulk_create = bulk_create_and_award
+        try:
+            badges.award_in_bulk(
+                badge_data,
+                badge.level,
+                ContentType.objects.get_for_model(models.Post),
+                [(self.u2.id, self.answer.id)],
+                timestamp
+            )
+        finally:
+            badges.bulk_create = bulk_create
+
+        for award in models.Award.objects.all():
+            activities = models.Activity.objects.filter(
+                                activity_type = const.TYPE_ACTIVITY_PRIZE,
+                                object_id = award.id
+                            )
+            self.assertEqual(activities.count(), 1)
+
+    def test_single_badge_is_awarded_once(self):
+        models.Vote.objects.create(
+            user = self.u2, voted_post = self.question, vote = 1
+        )
+        answer = self.post_answer(user = self.u1, question = self.question)
+        models.Vote.objects.create(user = self.u2, voted_post = answer, vote = 1)
+        self.assertEqual(badges.get_badge('supporter').recompute(), 1)
+        award = models.Award.objects.get(badge__slug = 'supporter')
+        self.assertEqual(award.content_object, self.question)
+        self.assertEqual(badges.get_badge('critic').recompute(), 0)
+
+    def test_self_learner_badge(self):
+        answer = self.post_answer(user = self.u1, question = self.question)
+        min_votes = settings.SELF_LEARNER_BADGE_MIN_UPVOTES
+        self.set_points(answer, min_votes)
+        self.set_points(self.answer, min_votes)
+        self.assertEqual(badges.get_badge('self-learner').recompute(), 1)
+        award = models.Award.objects.get(badge__slug = 'self-learner')
+        self.assertEqual(award.content_object, answer)
@@ -3,16 +3,25 @@ functions that happen on behalf of users
 
 e.g. ``some_user.do_something(...)``
 """
+from __future__ import with_statement
+from django.core import cache
 from django.core import exceptions
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.urlresolvers import reverse
 from django.test.client import Client
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
 from django import forms
 from askbot import exceptions as askbot_exceptions
 from askbot.tests.utils import AskbotTestCase
 from askbot.tests.utils import with_settings
+from askbot.tests.utils import call_with_celery_workers
 from askbot import models
+from askbot.models.base import insert_many
+from askbot.models.tag import get_wildcard_selector_ids
+from askbot.models.tag import get_tag_ids_by_wildcards
+from askbot.models.tag import tags_match_some_wildcard
 from askbot import const
 from askbot.conf import settings as askbot_settings
 import datetime
@@ -298,7 +307,7 @@ class UserLikeTagTests(AskbotTestCase):
         self.assert_affinity_is('dislike', False)
 
 class GlobalTagSubscriberGetterTests(AskbotTestCase):
-    """tests for the :meth:`~askbot.models.Question.get_global_tag_based_subscribers`
+    """tests for the :meth:`~askbot.models.Post.get_tag_based_subscriber_ids`
     """
     def setUp(self):
         """create two users"""
@@ -329,10 +338,13 @@ class GlobalTagSubscriberGetterTests(AskbotTestCase):
                                                     feed_type = 'q_all',
                                                     frequency = 'i'
                                                 )
-        actual_subscribers = self.question.get_global_tag_based_subscribers(
-            tag_mark_reason = reason,
-            subscription_records = subscriptions
-        )
+        candidates = set([feed.subscriber for feed in subscriptions])
+        subscriber_ids = self.question.get_tag_based_subscriber_ids(
+                                                    candidates, reason
+                                                )
+        actual_subscribers = set([
+            user for user in candidates if user.id in subscriber_ids
+        ])
         self.assertEquals(actual_subscribers, expected_subscribers)
 
     def test_nobody_likes_any_tags(self):
@@ -408,6 +420,248 @@ class GlobalTagSubscriberGetterTests(AskbotTestCase):
             reason = 'bad'
         )
 
+class UserTagPreferencesTests(AskbotTestCase):
+    """tests for the cached tag selections of the user"""
+    def setUp(self):
+        self.create_user()
+        self.question = self.post_question(tags = 'one two three')
+        askbot_settings.update('USE_WILDCARD_TAGS', True)
+
+    def get_tag_id(self, name):
+        return models.Tag.objects.get(name = name).id
+
+    def test_marked_tags(self):
+        self.user.mark_tags(tagnames = ('one',), reason = 'good', action = 'add')
+        preferences = self.user.get_tag_preferences()
+        self.assertEqual(preferences.tag_ids['good'], set([self.get_tag_id('one')]))
+        self.assertEqual(preferences.tag_names['good'], ['one'])
+
+        #marking tags resets the cached record
+        self.user.mark_tags(tagnames = ('one',), reason = 'bad', action = 'add')
+        preferences = self.user.get_tag_preferences()
+        self.assertEqual(preferences.tag_ids['good'], set())
+        self.assertEqual(preferences.tag_ids['bad'], set([self.get_tag_id('one')]))
+
+    def test_wildcards(self):
+        self.user.mark_tags(wildcards = ('t*',), reason = 'good', action = 'add')
+        preferences = self.user.get_tag_preferences()
+        expected = set([self.get_tag_id('two'), self.get_tag_id('three')])
+        self.assertEqual(preferences.get_tag_ids('good'), expected)
+
+        #new tag matching the wildcard is picked up
+        self.post_question(tags = 'ten')
+        preferences = self.user.get_tag_preferences()
+        expected.add(self.get_tag_id('ten'))
+        self.assertEqual(preferences.get_tag_ids('good'), expected)
+
+        askbot_settings.update('USE_WILDCARD_TAGS', False)
+        self.assertEqual(preferences.get_tag_ids('good'), set())
+
+    def test_new_tag_does_not_reload_marked_tags(self):
+        self.user.mark_tags(
+            tagnames = ('one',), wildcards = ('t*',), reason = 'good', action = 'add'
+        )
+        self.user.get_tag_preferences()
+        self.post_question(tags = 'ten')
+        #only the tags matching the wildcards are loaded
+        with self.assertNumQueries(1):
+            preferences = self.user.get_tag_preferences()
+        self.assertTrue(self.get_tag_id('ten') in preferences.get_tag_ids('good'))
+        self.assertEqual(preferences.tag_names['good'], ['one'])
+
+    def test_renamed_and_deleted_marked_tags(self):
+        self.user.mark_tags(tagnames = ('one', 'two'), reason = 'good', action = 'add')
+        self.user.get_tag_preferences()
+        tag = models.Tag.objects.get(name = 'one')
+        tag.name = 'uno'
+        tag.save()
+        preferences = self.user.get_tag_preferences()
+        self.assertEqual(sorted(preferences.tag_names['good']), ['two', 'uno'])
+
+        models.Tag.objects.get(name = 'two').delete()
+        preferences = self.user.get_tag_preferences()
+        self.assertEqual(preferences.tag_names['good'], ['uno'])
+
+class WildcardIndexTests(AskbotTestCase):
+    """tests for the index of wildcard selections and the tag lookups"""
+    def setUp(self):
+        self.create_user()
+        self.question = self.post_question(tags = 'one two three')
+
+    def test_index_follows_wildcard_selections(self):
+        self.user.mark_tags(wildcards = ('on*',), reason = 'good', action = 'add')
+        #lookups read the index, not the wildcard fields of the users
+        models.User.objects.filter(id = self.user.id).update(interesting_tags = '')
+        self.assertEqual(get_wildcard_selector_ids(['one'], 'good'), set([self.user.id]))
+        self.assertEqual(get_wildcard_selector_ids(['two'], 'good'), set())
+
+        #moving the wildcard to ignored removes it from the interesting
+        self.user.mark_tags(wildcards = ('on*',), reason = 'bad', action = 'add')
+        self.assertEqual(get_wildcard_selector_ids(['one'], 'good'), set())
+        self.assertEqual(get_wildcard_selector_ids(['one'], 'bad'), set([self.user.id]))
+
+        self.user.mark_tags(wildcards = ('on*',), reason = 'bad', action = 'remove')
+        self.assertEqual(get_wildcard_selector_ids(['one'], 'bad'), set())
+
+    def test_lookup_does_not_depend_on_number_of_selectors(self):
+        for number in range(5):
+            user = self.create_user('wildcard%d' % number)
+            user.mark_tags(wildcards = ('t*', 'on*'), reason = 'good', action = 'add')
+        with self.assertNumQueries(1):
+            user_ids = get_wildcard_selector_ids(['one', 'three'], 'good')
+        self.assertEqual(len(user_ids), 5)
+
+    def test_tag_ids_by_wildcards(self):
+        self.assertEqual(
+            get_tag_ids_by_wildcards(['t*']),
+            set(models.Tag.objects.filter(
+                name__in = ('two', 'three')
+            ).values_list('id', flat = True))
+        )
+
+    def test_get_by_wildcards(self):
+        tags = models.Tag.objects.get_by_wildcards(['t*', 'on*'])
+        self.assertEqual(
+            set(tags.values_list('name', flat = True)),
+            set(['one', 'two', 'three'])
+        )
+        self.post_question(tags = 'ten')
+        tags = models.Tag.objects.get_by_wildcards(['te*'])
+        self.assertEqual(list(tags.values_list('name', flat = True)), ['ten'])
+
+    def test_tags_match_some_wildcard(self):
+        self.assertTrue(tags_match_some_wildcard(['three'], ['th*']))
+        self.assertFalse(tags_match_some_wildcard(['three'], ['thx*', 'o*']))
+        tags = models.Tag.objects.filter(name = 'two')
+        self.assertTrue(tags.tags_match_some_wildcard(['t*']))
+        self.assertFalse(tags.tags_match_some_wildcard(['th*']))
+
+
+class UserVisitTests(AskbotTestCase):
+    """tests for the buffered saving of the last_seen"""
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('user-visits', {})
+        self.u1 = self.create_user('user1')
+        self.u2 = self.create_user('user2')
+        #pretend that the visits were just saved
+        models.last_seen_buffer.is_flush_due(300)
+
+    def tearDown(self):
+        cache.cache.clear()
+        cache.cache = self.old_cache
+
+    def visit(self, user, timestamp):
+        user = models.User.objects.get(id=user.id)
+        models.signals.site_visited.send(None, user=user, timestamp=timestamp)
+        return user
+
+    def get_last_seen(self, user):
+        return models.User.objects.get(id=user.id).last_seen
+
+    @with_settings(LAST_SEEN_UPDATE_INTERVAL=300)
+    def test_visits_are_saved_in_batch(self):
+        last_seen = self.get_last_seen(self.u1)
+        timestamp1 = datetime.datetime.now() + datetime.timedelta(0, 10)
+        timestamp2 = timestamp1 + datetime.timedelta(0, 10)
+        self.visit(self.u1, timestamp1)
+        self.visit(self.u2, timestamp2)
+        self.assertEqual(self.get_last_seen(self.u1), last_seen)
+
+        self.assertEqual(models.flush_last_seen(), 2)
+        self.assertEqual(self.get_last_seen(self.u1), timestamp1)
+        self.assertEqual(self.get_last_seen(self.u2), timestamp2)
+        self.assertEqual(models.flush_last_seen(), 0)
+
+    @with_settings(LAST_SEEN_UPDATE_INTERVAL=300)
+    def test_next_day_visit_uses_unsaved_visit(self):
+        now = datetime.datetime.now()
+        self.u1.last_seen = now - datetime.timedelta(2)
+        self.u1.save()
+        #not yet saved visit 36 hours ago
+        self.visit(self.u1, now - datetime.timedelta(0, 36*60*60))
+        self.assertEqual(self.get_last_seen(self.u1), self.u1.last_seen)
+        #next day visit is counted and saved right away
+        user = self.visit(self.u1, now)
+        self.assertEqual(user.consecutive_days_visit_count, 1)
+        self.assertEqual(self.get_last_seen(self.u1), now)
+
+
+class QuestionVisitTests(AskbotTestCase):
+    """tests for the buffered saving of the question visits"""
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('question-visits', {})
+        self.u1 = self.create_user('user1')
+        self.u2 = self.create_user('user2')
+        self.question = self.post_question(user=self.u1)
+        #u1 is notified about the answer
+        self.post_answer(user=self.u2, question=self.question)
+        #pretend that the visits were just saved
+        models.question_visits_buffer.is_flush_due(300)
+
+    def tearDown(self):
+        cache.cache.clear()
+        cache.cache = self.old_cache
+
+    def get_response_counts(self, user):
+        user = self.reload_object(user)
+        return user.new_response_count, user.seen_response_count
+
+    def test_visit_creates_and_updates_question_view(self):
+        timestamp = datetime.datetime.now()
+        self.u2.visit_question(self.question, timestamp)
+        self.u2.visit_question(self.question, timestamp + datetime.timedelta(1))
+        view = models.QuestionView.objects.get(who=self.u2)
+        self.assertEqual(view.when, timestamp + datetime.timedelta(1))
+
+    def test_visit_clears_responses(self):
+        self.assertEqual(self.get_response_counts(self.u1), (1, 0))
+        self.u1.visit_question(self.question)
+        self.assertEqual(self.u1.new_response_count, 0)
+        self.assertEqual(self.u1.seen_response_count, 1)
+        self.assertEqual(self.get_response_counts(self.u1), (0, 1))
+
+    def save_visit(self, user):
+        call_with_celery_workers(models.save_question_visit, user, self.question)
+
+    @with_settings(QUESTION_VISIT_FLUSH_INTERVAL=300)
+    def test_visits_are_saved_in_batch(self):
+        self.save_visit(self.u1)
+        self.save_visit(self.u2)
+        self.save_visit(self.u2)
+        self.assertEqual(models.QuestionView.objects.count(), 0)
+        self.assertEqual(self.get_response_counts(self.u1), (1, 0))
+
+        #select and insert the views, select and update
+        #the notifications, update the response counts
+        self.assertNumQueries(5, models.flush_question_visits)
+        self.assertEqual(models.QuestionView.objects.count(), 2)
+        self.assertEqual(self.get_response_counts(self.u1), (0, 1))
+        self.assertEqual(models.flush_question_visits(), 0)
+
+    @with_settings(QUESTION_VISIT_FLUSH_INTERVAL=300)
+    def test_flush_is_rescheduled_for_visits_buffered_meanwhile(self):
+        self.save_visit(self.u1)
+        visits = models.question_visits_buffer
+        take = visits.take
+        def take_and_save_visit(**kwargs):
+            del visits.take
+            items = take(**kwargs)
+            self.save_visit(self.u2)
+            return items
+        visits.take = take_and_save_visit
+        #the rescheduled task runs right away, as celery tasks in the tests
+        self.assertEqual(models.flush_question_visits(), 1)
+        self.assertEqual(models.QuestionView.objects.count(), 2)
+        self.assertTrue(visits.is_empty())
+
+    def test_visit_is_saved_right_away_without_celery_workers(self):
+        models.save_question_visit(self.u1, self.question)
+        self.assertEqual(models.QuestionView.objects.count(), 1)
+        self.assertEqual(self.get_response_counts(self.u1), (0, 1))
+
+
 class CommentTests(AskbotTestCase):
     """unfortunately, not very useful tests,
     as assertions of type "user can" are not inside
@@ -432,6 +686,24 @@ class CommentTests(AskbotTestCase):
         self.assertEquals(comments[0].upvoted_by_user, True)
         self.assertEquals(comments[0].is_upvoted_by(self.other_user), True)
 
+    def test_comments_are_precached_with_one_query(self):
+        self.other_user.upvote(self.comment)
+        self.user.post_comment(parent_post = self.question, body_text = 'second comment')
+        with self.assertNumQueries(1):
+            models.Post.objects.precache_comments(
+                                for_posts = [self.question],
+                                visitor = self.other_user
+                            )
+            comments = self.question._cached_comments
+            self.assertEqual(
+                [comment.author.username for comment in comments],
+                [self.user.username, self.user.username]
+            )
+        self.assertEqual(
+            [bool(comment.upvoted_by_user) for comment in comments],
+            [True, False]
+        )
+
     def test_other_user_can_cancel_upvote(self):
         self.test_other_user_can_upvote_comment()
         comment = models.Post.objects.get_comments().get(id = self.comment.id)
@@ -440,6 +712,45 @@ class CommentTests(AskbotTestCase):
         comment = models.Post.objects.get_comments().get(id = self.comment.id)
         self.assertEquals(comment.points, 0)
 
+class VoteTests(AskbotTestCase):
+    def setUp(self):
+        self.u1 = self.create_user('u1')
+        self.u2 = self.create_user('u2')
+        self.question = self.post_question(user = self.u1)
+        cache.cache.clear()
+
+    def test_unused_votes_are_counted_in_cache(self):
+        max_votes = askbot_settings.MAX_VOTES_PER_USER_PER_DAY
+        self.assertEqual(self.u2.get_unused_votes_today(), max_votes)
+        self.u2.upvote(self.question)
+        self.assertEqual(self.u2.get_unused_votes_today(), max_votes - 1)
+
+        #the count is not taken from the database again
+        yesterday = datetime.datetime.now() - datetime.timedelta(1)
+        models.Vote.objects.filter(user = self.u2).update(voted_at = yesterday)
+        self.assertEqual(self.u2.get_unused_votes_today(), max_votes - 1)
+
+        #deleted vote from yesterday does not change today's count
+        self.u2.upvote(self.question, cancel = True)
+        self.assertEqual(self.u2.get_unused_votes_today(), max_votes - 1)
+
+        #without the cached count votes are counted in the database
+        cache.cache.clear()
+        self.assertEqual(self.u2.get_unused_votes_today(), max_votes)
+
+    def test_post_loaded_for_voting_has_old_vote(self):
+        posts = models.Post.objects.get_for_voting(self.u2)
+        post = posts.get(id = self.question.id)
+        self.assertNumQueries(0, self.u2.get_old_vote_for_post, post)
+        self.assertEqual(self.u2.get_old_vote_for_post(post), None)
+
+        vote = self.u2.upvote(self.question)
+        post = posts.get(id = self.question.id)
+        self.assertEqual(self.u2.get_old_vote_for_post(post), vote)
+
+        #the vote preloaded for one user is not used for the other
+        self.assertEqual(self.u1.get_old_vote_for_post(post), None)
+
 class GroupTests(AskbotTestCase):
     def setUp(self):
         self.u1 = self.create_user('u1')
@@ -513,9 +824,11 @@ class GroupTests(AskbotTestCase):
         self.assertEqual(qa.groups.filter(name='private').exists(), True)
 
     def test_global_group_name_setting_changes_group_name(self):
+        backup = askbot_settings.GLOBAL_GROUP_NAME
         askbot_settings.update('GLOBAL_GROUP_NAME', 'all-people')
         group = models.Group.objects.get_global_group()
         self.assertEqual(group.name, 'all-people')
+        askbot_settings.update('GLOBAL_GROUP_NAME', backup)
 
     def test_ask_global_group_by_id_works(self):
         group = models.Group.objects.get_global_group()
@@ -667,3 +980,36 @@ class GroupTests(AskbotTestCase):
         self.assertEqual(acts[0].recipients.count(), 1)
         recipient = acts[0].recipients.all()[0]
         self.assertEqual(recipient, mod)
+
+
+class BulkCreateTests(AskbotTestCase):
+    """tests for the insertion of many objects with one query"""
+
+    def test_insert_many(self):
+        """the fallback for django 1.3 saves the objects
+        like ``QuerySet.bulk_create``"""
+        question = self.post_question(user = self.create_user())
+        now = datetime.datetime.now()
+        activities = list()
+        for user in (self.user, self.create_user('other')):
+            activities.append(
+                models.Activity(
+                    user = user,
+                    content_type = ContentType.objects.get_for_model(question),
+                    object_id = question.id,
+                    activity_type = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT,
+                    active_at = now
+                )
+            )
+        with self.assertNumQueries(1):
+            insert_many(models.Activity, activities)
+
+        saved = models.Activity.objects.filter(
+                                object_id = question.id,
+                                activity_type = const.TYPE_ACTIVITY_EMAIL_UPDATE_SENT
+                            )
+        self.assertEqual(
+            set(saved.values_list('user__username', flat = True)),
+            set([self.user.username, 'other'])
+        )
+        self.assertEqual(saved[0].active_at, now)
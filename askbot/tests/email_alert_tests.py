@@ -2,21 +2,31 @@ import bs4
 import copy
 import datetime
 import functools
+import os
+import shutil
+import smtplib
+import tempfile
 import time
 from django.conf import settings as django_settings
+from django.core import cache
 from django.core import management
+from django.core.cache.backends.locmem import LocMemCache
 from django.core import serializers
 import django.core.mail
+from django.core.mail.backends import locmem
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
+from django.utils import simplejson
 from askbot.tests import utils
 from askbot.tests.utils import with_settings
+from askbot.utils.page_benchmark import record_queries
 from askbot import models
 from askbot import mail
 from askbot.conf import settings as askbot_settings
 from askbot import const
 from askbot.models.question import Thread
+from askbot.management.commands import send_email_alerts
 
 TO_JSON = functools.partial(serializers.serialize, 'json')
 
@@ -783,6 +793,46 @@ class TagFollowedInstantWholeForumEmailAlertTests(utils.AskbotTestCase):
             self.user1.email in outbox[0].recipients()
         )
 
+    def count_subscriber_queries(self, post):
+        subscribers, queries = record_queries(
+                                post.get_instant_notification_subscribers,
+                                mentioned_users = [], exclude_list = []
+                            )
+        return subscribers, len(queries)
+
+    @with_settings(USE_WILDCARD_TAGS=True, SUBSCRIBED_TAG_SELECTOR_ENABLED=False)
+    def test_subscriber_queries_do_not_depend_on_wildcard_users(self):
+        #own cache, so that the cached indices are not culled
+        old_cache = cache.cache
+        cache.cache = LocMemCache('wildcard-subscribers', {})
+        try:
+            self.check_subscriber_queries_with_wildcard_users()
+        finally:
+            cache.cache = old_cache
+
+    def check_subscriber_queries_with_wildcard_users(self):
+        question = self.post_question(user = self.user2, tags = 'something')
+        self.user1.email_tag_filter_strategy = const.INCLUDE_INTERESTING
+        self.user1.save()
+        self.user1.mark_tags(wildcards = ('some*',), reason = 'good', action = 'add')
+        #the first call may fill the cached indices
+        self.count_subscriber_queries(question)
+        subscribers, query_count = self.count_subscriber_queries(question)
+        self.assertEqual(subscribers, set([self.user1]))
+
+        for number in range(5):
+            user = self.create_user(
+                            username = 'wildcard%d' % number,
+                            notification_schedule = {'q_all': 'i'}
+                        )
+            user.email_tag_filter_strategy = const.INCLUDE_INTERESTING
+            user.save()
+            user.mark_tags(wildcards = ('other*',), reason = 'good', action = 'add')
+
+        subscribers, new_query_count = self.count_subscriber_queries(question)
+        self.assertEqual(subscribers, set([self.user1]))
+        self.assertEqual(new_query_count, query_count)
+
     @with_settings(SUBSCRIBED_TAG_SELECTOR_ENABLED=False)
     def test_tag_based_subscription_on_new_question_works1(self):
         """someone subscribes for an pre-existing tag
@@ -1020,6 +1070,132 @@ class EmailAlertTestsWithGroupsEnabled(utils.AskbotTestCase):
         self.assertEqual(outbox[0].recipients(), [recipient.email])
 
 
+class ShardedEmailAlertTests(utils.AskbotTestCase):
+    """tests of the options ``--shards``, ``--shard-index``
+    and ``--resume`` of the command ``send_email_alerts``"""
+
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.author = self.create_user('author')
+        self.readers = list()
+        for username in ('reader1', 'reader2', 'reader3'):
+            self.readers.append(
+                self.create_user(
+                    username,
+                    notification_schedule={'q_all': 'd'},
+                    date_joined=datetime.datetime.now() - datetime.timedelta(2)
+                )
+            )
+        self.post_question(user=self.author)
+        django.core.mail.outbox = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_dir)
+
+    def send_email_alerts(self, **options):
+        management.call_command(
+            'send_email_alerts',
+            checkpoint_dir=self.checkpoint_dir,
+            verbosity=0,
+            **options
+        )
+
+    def get_recipients(self):
+        recipients = list()
+        for message in django.core.mail.outbox:
+            recipients.extend(message.recipients())
+        return sorted(recipients)
+
+    def test_shards_cover_all_users_once(self):
+        self.send_email_alerts(shards=2, shard_index=0)
+        first_shard_recipients = self.get_recipients()
+        self.send_email_alerts(shards=2, shard_index=1)
+        self.assertTrue(0 < len(first_shard_recipients) < 3)
+        expected = sorted([reader.email for reader in self.readers])
+        self.assertEqual(self.get_recipients(), expected)
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_resume_skips_users_saved_in_checkpoint(self):
+        checkpoint = {
+            'id_from': None,
+            'id_to': None,
+            'last_user_id': self.readers[0].id,
+            'stats': {
+                'users_scanned': 2,
+                'emails_built': 1,
+                'emails_sent': 1,
+                'subscriptions_time': 0,
+                'build_time': 0,
+                'send_time': 0
+            }
+        }
+        path = os.path.join(self.checkpoint_dir, 'askbot-email-alerts-0-of-1.json')
+        checkpoint_file = open(path, 'w')
+        simplejson.dump(checkpoint, checkpoint_file)
+        checkpoint_file.close()
+
+        self.send_email_alerts(resume=True)
+        expected = sorted([reader.email for reader in self.readers[1:]])
+        self.assertEqual(self.get_recipients(), expected)
+        self.assertFalse(os.path.exists(path))
+
+
+class DigestBuilderTests(utils.AskbotTestCase):
+    """tests of the selection of the threads
+    loaded for the digests of the periodic feeds"""
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        self.author = self.create_user('author')
+        self.reader = self.create_user(
+                            'reader',
+                            notification_schedule={'q_all': 'd', 'm_and_c': 'd'},
+                            date_joined=now - datetime.timedelta(30)
+                        )
+        self.old_question = self.post_question(
+                                    user=self.author,
+                                    title='old question',
+                                    timestamp=now - datetime.timedelta(10)
+                                )
+        self.new_question = self.post_question(
+                                    user=self.author,
+                                    title='new question',
+                                    timestamp=now - datetime.timedelta(1)
+                                )
+
+    def set_reported_at(self, reported_at):
+        models.EmailFeedSetting.objects.filter(
+                                    subscriber=self.reader
+                                ).update(reported_at=reported_at)
+
+    def test_threads_older_than_previous_report_are_not_loaded(self):
+        self.set_reported_at(datetime.datetime.now() - datetime.timedelta(2))
+        builder = send_email_alerts.DigestBuilder()
+        self.assertTrue(self.new_question.id in builder.questions)
+        self.assertFalse(self.old_question.id in builder.questions)
+
+    def test_threads_since_join_are_loaded_before_first_report(self):
+        builder = send_email_alerts.DigestBuilder()
+        self.assertTrue(self.new_question.id in builder.questions)
+        self.assertTrue(self.old_question.id in builder.questions)
+
+    def test_mention_in_old_thread_is_reported(self):
+        self.set_reported_at(datetime.datetime.now() - datetime.timedelta(2))
+        self.post_answer(
+                user=self.author,
+                question=self.old_question,
+                body_text='@reader have a look',
+                timestamp=datetime.datetime.now() - datetime.timedelta(10)
+            )
+        builder = send_email_alerts.DigestBuilder()
+        self.assertFalse(self.old_question.id in builder.questions)
+        digests = builder.build([self.reader])
+        self.assertEqual(
+            set([post.id for post in digests[self.reader.id].keys()]),
+            set([self.new_question.id, self.old_question.id])
+        )
+
+
 class PostApprovalTests(utils.AskbotTestCase):
     """test notifications sent to authors when their posts
     are approved or published"""
@@ -1113,6 +1289,72 @@ class AbsolutizeUrlsInEmailsTests(utils.AskbotTestCase):
         self.assertEqual(url_bits.keys()[0], 'http')
 
 
+FAILING_EMAIL_ADDRESS = 'failing@example.com'
+
+class CountingEmailBackend(locmem.EmailBackend):
+    """counts opened connections, fails to send
+    messages to the ``FAILING_EMAIL_ADDRESS``"""
+    opened_connections = 0
+
+    def open(self):
+        CountingEmailBackend.opened_connections += 1
+        return True
+
+    def send_messages(self, messages):
+        for message in messages:
+            if FAILING_EMAIL_ADDRESS in message.recipients():
+                raise smtplib.SMTPRecipientsRefused({FAILING_EMAIL_ADDRESS: (550, '')})
+        return super(CountingEmailBackend, self).send_messages(messages)
+
+
+class SendMassMailTests(utils.AskbotTestCase):
+
+    def setUp(self):
+        self.old_email_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'askbot.tests.email_alert_tests.CountingEmailBackend'
+        CountingEmailBackend.opened_connections = 0
+        django.core.mail.outbox = list()
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_email_backend
+
+    def make_messages(self, addresses):
+        return [
+            mail.make_message(
+                subject_line='hello',
+                body_text='<p>hello</p>',
+                recipient_list=[address]
+            ) for address in addresses
+        ]
+
+    def test_one_connection_per_batch(self):
+        addresses = ['user%d@example.com' % n for n in range(5)]
+        results = mail.send_mass_mail(self.make_messages(addresses), batch_size=2)
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(CountingEmailBackend.opened_connections, 3)
+        self.assertEqual(len(django.core.mail.outbox), 5)
+
+    def test_failed_message_does_not_stop_others(self):
+        addresses = ['user1@example.com', FAILING_EMAIL_ADDRESS, 'user2@example.com']
+        results = mail.send_mass_mail(self.make_messages(addresses))
+        self.assertEqual(results, [True, False, True])
+        recipients = [message.to[0] for message in django.core.mail.outbox]
+        self.assertEqual(recipients, ['user1@example.com', 'user2@example.com'])
+
+    @with_settings(MIN_REP_TO_TRIGGER_EMAIL=1)
+    def test_instant_notifications_use_one_connection(self):
+        author = self.create_user('author')
+        for username in ('reader1', 'reader2', 'reader3'):
+            self.create_user(
+                username,
+                notification_schedule=models.EmailFeedSetting.MAX_EMAIL_SCHEDULE
+            )
+        self.post_question(user=author)
+        self.assertEqual(len(django.core.mail.outbox), 3)
+        self.assertEqual(CountingEmailBackend.opened_connections, 1)
+
+
 class MailMessagesTests(utils.AskbotTestCase):
     def test_ask_for_signature(self):
         from askbot.mail import messages
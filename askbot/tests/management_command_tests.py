@@ -51,3 +51,30 @@ class ManagementCommandTests(AskbotTestCase):
         user_two = models.User.objects.get(pk=2)
         self.assertEqual(user_two.gold, number_of_gold) 
         self.assertEqual(user_two.reputation, reputation)
+
+    def test_rerender_posts(self):
+        user = self.create_user()
+        question = self.post_question(user=user, body_text='*old text*')
+        answer = self.post_answer(user=user, question=question, body_text='answer')
+        expected_html = question.html
+        models.Post.objects.filter(id=question.id).update(
+                                                html='stale', summary='stale'
+                                            )
+        models.Post.objects.filter(id=answer.id).update(html='stale')
+
+        management.call_command(
+                        'rerender_posts',
+                        post_types='question',
+                        workers=1
+                    )
+        question = self.reload_object(question)
+        self.assertEqual(question.html, expected_html)
+        self.assertEqual(question.summary, question.get_snippet())
+        self.assertEqual(self.reload_object(answer).html, 'stale')
+
+        management.call_command(
+                        'rerender_posts',
+                        resume_from_id=answer.id,
+                        workers=1
+                    )
+        self.assertEqual(self.reload_object(answer).html, '<p>answer</p>\n')
@@ -1,5 +1,8 @@
+from __future__ import with_statement
 from django.conf import settings as django_settings
 from askbot.tests.utils import AskbotTestCase
+from askbot.tests.utils import with_settings
+from askbot.conf import settings as askbot_settings
 from askbot.utils import markup
 
 class MarkupTest(AskbotTestCase):
@@ -22,3 +25,129 @@ class MarkupTest(AskbotTestCase):
         text = "oh hai @user1 how are you?"
         output = markup.extract_mentioned_name_seeds(text)
         self.assertEquals(output, set(['user1']))
+
+    def test_parser_is_reused(self):
+        parser = markup.get_parser()
+        self.assertTrue(markup.get_parser() is parser)
+        self.assertEqual(
+            parser.convert('*one*').strip(), '<p><em>one</em></p>'
+        )
+        self.assertEqual(
+            parser.convert('two').strip(), '<p>two</p>'
+        )
+
+    @with_settings(
+        ENABLE_AUTO_LINKING=True,
+        AUTO_LINK_PATTERNS='bug(\\d+)',
+        AUTO_LINK_URLS='http://example.com/bug/\\1'
+    )
+    def test_parser_is_made_again_when_settings_change(self):
+        parser = markup.get_parser()
+        expected = '<p>see <a href="http://example.com/bug/1">bug1</a></p>'
+        self.assertEqual(parser.convert('see bug1').strip(), expected)
+
+        askbot_settings.update('AUTO_LINK_URLS', 'http://example.com/issue/\\1')
+        new_parser = markup.get_parser()
+        self.assertFalse(new_parser is parser)
+        expected = '<p>see <a href="http://example.com/issue/1">bug1</a></p>'
+        self.assertEqual(new_parser.convert('see bug1').strip(), expected)
+
+    def test_markdown_to_html_is_cached(self):
+        markup.render_cache.clear()
+        self.assertEqual(
+            markup.markdown_to_html('*cached*').strip(), '<p><em>cached</em></p>'
+        )
+        key = markup.get_render_cache_key(
+                                '*cached*', markup.get_parser_settings_key()
+                            )
+        markup.render_cache.set(key, 'from cache')
+        self.assertEqual(markup.markdown_to_html('*cached*'), 'from cache')
+
+    @with_settings(MARKUP_CODE_FRIENDLY=False, ENABLE_MATHJAX=False)
+    def test_render_cache_key_depends_on_settings(self):
+        self.assertEqual(
+            markup.markdown_to_html('a_b_c').strip(), '<p>a<em>b</em>c</p>'
+        )
+        askbot_settings.update('MARKUP_CODE_FRIENDLY', True)
+        self.assertEqual(markup.markdown_to_html('a_b_c').strip(), '<p>a_b_c</p>')
+
+    def test_render_cache_evicts_least_recently_used(self):
+        render_cache = markup.RenderCache(2)
+        render_cache.set('one', '1')
+        render_cache.set('two', '2')
+        render_cache.get('one')
+        render_cache.set('three', '3')
+        self.assertEqual(render_cache.get('one'), '1')
+        self.assertEqual(render_cache.get('two'), None)
+        self.assertEqual(render_cache.get('three'), '3')
+
+    def test_render_cache_keeps_order_of_use_after_compaction(self):
+        render_cache = markup.RenderCache(2)
+        render_cache.set('one', '1')
+        render_cache.set('two', '2')
+        for count in range(10):
+            render_cache.get('two')
+            render_cache.get('one')
+        self.assertTrue(len(render_cache.usage) <= 8)
+        render_cache.set('three', '3')
+        self.assertEqual(render_cache.get('two'), None)
+        self.assertEqual(render_cache.get('one'), '1')
+
+    def test_get_mention_candidates(self):
+        text = '@John Smith, @johnny mail@mary @ @'
+        self.assertEqual(
+            markup.get_mention_candidates(text, 10),
+            set(['john', 'john smith', 'johnny'])
+        )
+
+    def test_find_mentions(self):
+        names = sorted(['john', 'john smith', 'johnny', 'mary'])
+        text = '@John Smith, @johnny and @john. mail@mary @nobody @'
+        self.assertEqual(
+            markup.find_mentions(text, names),
+            [
+                (0, [(11, names.index('john smith')), (5, names.index('john'))]),
+                (13, [(20, names.index('johnny'))]),
+                (25, [(30, names.index('john'))]),
+            ]
+        )
+
+
+class MentionTests(AskbotTestCase):
+    """tests of the @mentions of the users"""
+
+    def setUp(self):
+        self.asker = self.create_user('asker')
+        self.question = self.post_question(user=self.asker)
+
+    def test_longest_name_or_participant_is_mentioned(self):
+        john = self.create_user('john')
+        john_smith = self.create_user('john smith')
+        mentioned, html = self.question.mentionize_html('hi @john smith')
+        self.assertEqual(mentioned, [john_smith])
+
+        self.post_answer(user=john, question=self.question)
+        mentioned, html = self.question.mentionize_html('hi @john smith, @Asker')
+        self.assertEqual(mentioned, [john, self.asker])
+        expected = 'hi <a href="%s">@john</a> smith, <a href="%s">@asker</a>' % (
+                            john.get_profile_url(), self.asker.get_profile_url()
+                        )
+        self.assertEqual(html, expected)
+
+    def test_renamed_user_is_mentioned(self):
+        user = self.create_user('oldname')
+        user.username = 'newname'
+        user.save()
+        mentioned, html = self.question.mentionize_html('@oldname @newname')
+        self.assertEqual(mentioned, [user])
+        self.assertTrue(html.startswith('@oldname <a href='))
+
+    def test_mention_queries_do_not_depend_on_mention_count(self):
+        users = [self.create_user('user%d' % number) for number in range(5)]
+        for user in users:
+            answer = self.post_answer(user=user, question=self.question)
+            self.post_comment(user=user, parent_post=answer)
+        text = ' '.join(['@user%d' % number for number in range(5)])
+        with self.assertNumQueries(1):
+            mentioned, html = self.question.mentionize_html(text)
+        self.assertEqual(mentioned, users)
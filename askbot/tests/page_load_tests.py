@@ -4,6 +4,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core import management
 from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core import cache
 from django.utils import simplejson
 from django.utils.translation import activate as activate_language
@@ -16,9 +17,11 @@ from askbot import models
 from askbot.utils.slug import slugify
 from askbot.deployment import package_utils
 from askbot.tests.utils import AskbotTestCase
+from askbot.utils.page_benchmark import record_queries
 from askbot.conf import settings as askbot_settings
 from askbot.tests.utils import skipIf
 from askbot.tests.utils import with_settings
+from askbot.utils import page_benchmark
 
 
 def patch_jinja2():
@@ -563,6 +566,48 @@ class PageLoadTestCase(AskbotTestCase):
     def test_user_page_with_groups_disabled(self):
         self.try_url('users', status_code=200)
 
+class PageQueryCountTests(AskbotTestCase):
+    """fails if the question list and the question page
+    use more queries than allowed in the page_load_thresholds.json,
+    all pages are checked by the command benchmark_page_loads"""
+
+    @classmethod
+    def setUpClass(cls):
+        management.call_command('flush', verbosity=0, interactive=False)
+        activate_language(settings.LANGUAGE_CODE)
+        management.call_command('askbot_add_test_content', verbosity=0, interactive=False)
+
+    @classmethod
+    def tearDownClass(self):
+        management.call_command('flush', verbosity=0, interactive=False)
+
+    def _fixture_setup(self):
+        pass
+
+    def _fixture_teardown(self):
+        pass
+
+    def setUp(self):
+        self.old_cache = cache.cache
+        cache.cache = LocMemCache('page-query-counts', {})
+
+    def tearDown(self):
+        cache.cache.clear()
+        cache.cache = self.old_cache
+
+    def test_query_counts(self):
+        report = page_benchmark.run_benchmark(
+                            page_names=('questions', 'question'),
+                            groups_modes=(False,)
+                        )
+        thresholds = page_benchmark.load_json(
+                            page_benchmark.DEFAULT_THRESHOLDS_PATH
+                        )
+        errors = page_benchmark.check_thresholds(report, thresholds)
+        if errors:
+            self.fail('\n'.join(errors))
+
+
 class AvatarTests(AskbotTestCase):
 
     def test_avatar_for_two_word_user_works(self):
@@ -722,6 +767,81 @@ class CommandViewTests(AskbotTestCase):
         group = self.reload_object(group)
         self.assertEqual(group.description.text, 'edited description')
 
+    def vote_for_answer(self, answer):
+        """upvotes answer via the ajax view,
+        returns the number of queries"""
+        response, queries = record_queries(
+            self.client.post,
+            reverse('vote', kwargs={'id': answer.thread._question_post().id}),
+            data={'type': '5', 'postId': answer.id},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        data = simplejson.loads(response.content)
+        self.assertEqual(data['success'], 1)
+        return len(queries)
+
+    def test_answer_vote_uses_constant_number_of_queries(self):
+        voter = self.create_user('voter')
+        voter.reputation = 1000
+        voter.save()
+        answers = list()
+        for number in range(3):
+            author = self.create_user('author%d' % number)
+            question = self.post_question(user=author)
+            answers.append(self.post_answer(user=author, question=question))
+
+        self.client.login(user_id=voter.id, method='force')
+        #buffers flushed by the first vote are not due again during the test
+        old_cache = cache.cache
+        cache.cache = LocMemCache('answer-votes', {})
+        try:
+            self.vote_for_answer(answers[0])
+            query_count = self.vote_for_answer(answers[1])
+            self.assertEqual(self.vote_for_answer(answers[2]), query_count)
+        finally:
+            cache.cache = old_cache
+        self.assertEqual(models.Vote.objects.filter(user=voter).count(), 3)
+
+    def get_post_comments(self, post, etag = None):
+        headers = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+        if etag:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        return self.client.get(
+                        reverse('post_comments'),
+                        data={'post_id': post.id, 'post_type': 'question'},
+                        **headers
+                    )
+
+    def test_post_comments_supports_etag(self):
+        author = self.create_user('author')
+        visitor = self.create_user('visitor')
+        visitor.reputation = 1000
+        visitor.save()
+        question = self.post_question(user=author)
+        comment = self.post_comment(user=author, parent_post=question)
+        visitor.upvote(comment)
+
+        self.client.login(user_id=visitor.id, method='force')
+        response = self.get_post_comments(question)
+        self.assertEqual(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['upvoted_by_user'], True)
+        self.assertEqual(data[0]['is_deletable'], True)
+        self.assertEqual(data[0]['is_editable'], False)
+        etag = response['ETag']
+
+        response = self.get_post_comments(question, etag=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        visitor.upvote(comment, cancel=True)
+        response = self.get_post_comments(question, etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        data = simplejson.loads(response.content)
+        self.assertEqual(data[0]['upvoted_by_user'], False)
+
     def test_load_object_description_fails(self):
         response = self.client.get(reverse('load_object_description'))
         self.assertEqual(response.status_code, 404)#bad request
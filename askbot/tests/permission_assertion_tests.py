@@ -1297,6 +1297,48 @@ class CommentPermissionAssertionTests(PermissionAssertionTestCase):
                                 )
         self.user.assert_can_edit_comment(comment)
 
+    @with_settings(USE_TIME_LIMIT_TO_EDIT_COMMENT = True, MINUTES_TO_EDIT_COMMENT = 10)
+    def test_comment_permissions_match_assertions(self):
+        self.other_user.reputation = self.min_rep
+        self.other_user.save()
+        now = datetime.datetime.now()
+        old_timestamp = now - datetime.timedelta(1)
+        question = self.post_question(timestamp = old_timestamp)
+        comments = list()
+        for author, timestamp in (
+            (self.user, old_timestamp),
+            (self.other_user, old_timestamp),
+            (self.user, old_timestamp + datetime.timedelta(0, 1)),
+            (self.user, now - datetime.timedelta(0, 60)),
+            (self.other_user, now)
+        ):
+            comments.append(
+                author.post_comment(
+                    parent_post = question,
+                    body_text = 'test comment',
+                    timestamp = timestamp
+                )
+            )
+
+        for status, reputation in (
+            ('a', 1),
+            ('a', askbot_settings.MIN_REP_TO_DELETE_OTHERS_COMMENTS),
+            ('s', 1),
+            ('b', 1),
+            ('m', 1),
+            ('d', 1)
+        ):
+            self.user.set_status(status)
+            self.user.reputation = reputation
+            self.user.save()
+            permissions = self.user.get_comment_permissions(comments)
+            for comment in comments:
+                expected = (
+                    template_filters.can_delete_comment(self.user, comment),
+                    template_filters.can_edit_comment(self.user, comment)
+                )
+                self.assertEqual(permissions[comment.id], expected)
+
 #def user_assert_can_post_comment(self, parent_post):
 #def user_assert_can_delete_comment(self, comment = None):
 
@@ -235,6 +235,39 @@ class ThreadTagModelsTests(AskbotTestCase):
         qs, meta_data = Thread.objects.run_advanced_search(request_user=self.user, search_state=ss)
         self.assertEqual(1, qs.count())
 
+    def test_run_adv_search_case_insensitive_tags(self):
+        ss = SearchState.get_empty().add_tag('TAG1').add_tag('nosuchtag')
+        backup = askbot_settings.TAG_SEARCH_INPUT_ENABLED
+        askbot_settings.update('TAG_SEARCH_INPUT_ENABLED', True)
+        qs, meta_data = Thread.objects.run_advanced_search(request_user=self.user, search_state=ss)
+        self.assertEqual(2, qs.count())
+        self.assertEqual(['nosuchtag'], meta_data['non_existing_tags'])
+
+        askbot_settings.update('TAG_SEARCH_INPUT_ENABLED', False)
+        qs, meta_data = Thread.objects.run_advanced_search(request_user=self.user, search_state=ss)
+        self.assertEqual(0, qs.count())
+        askbot_settings.update('TAG_SEARCH_INPUT_ENABLED', backup)
+
+    def test_resolve_tag_names(self):
+        from askbot.models.tag import resolve_tag_names
+        found, missing = resolve_tag_names(['tag1', 'Tag2', 'newtag'])
+        self.assertEqual(['tag1'], [name for tag_id, name in found])
+        self.assertEqual(set(['Tag2', 'newtag']), missing)
+
+        found, missing = resolve_tag_names(['Tag2'], case_sensitive=False)
+        self.assertEqual(['tag2'], [name for tag_id, name in found])
+
+        #creating and renaming tags updates the name map
+        Tag.objects.create(name='newtag', created_by=self.user)
+        tag = Tag.objects.get(name='tag1')
+        tag.name = 'renamed'
+        tag.save()
+        found, missing = resolve_tag_names(['tag1', 'renamed', 'newtag'])
+        self.assertEqual(
+            ['renamed', 'newtag'], [name for tag_id, name in found]
+        )
+        self.assertEqual(set(['tag1']), missing)
+
     def test_run_adv_search_query_author(self):
         ss = SearchState(scope=None, sort=None, query="@user", tags=None, author=None, page=None, user_logged_in=None)
         qs, meta_data = Thread.objects.run_advanced_search(request_user=self.user, search_state=ss)
@@ -412,7 +445,7 @@ class ThreadRenderLowLevelCachingTests(AskbotTestCase):
 
         ###
         cache.cache.delete(key)
-        thread.update_summary_html = lambda dummy: "Monkey-patched <<<tag2>>>"
+        thread.render_summary_html = lambda dummy: "Monkey-patched <<<tag2>>>"
 
         self.assertFalse(thread.summary_html_cached())
         self.assertIsNone(thread.get_cached_summary_html())
@@ -422,6 +455,30 @@ class ThreadRenderLowLevelCachingTests(AskbotTestCase):
         )
 
 
+    def test_prefetch_summary_html(self):
+        cache.cache = LocMemCache('', {})  # Enable local caching
+        q2 = self.post_question(tags='tag4')
+        threads = [self.q.thread, q2.thread]
+        for thread in threads:
+            cache.cache.delete(thread.get_summary_cache_key())
+        cache.cache.set(self.q.thread.get_summary_cache_key(), 'Cached <<<tag1>>>')
+
+        threads = list(Thread.objects.filter(id__in=[t.id for t in threads]).order_by('id'))
+        Thread.objects.prefetch_summary_html(threads)
+        #missing snippet is rendered and stored
+        self.assertTrue(threads[1].summary_html_cached())
+        self.assertEqual(
+            threads[1].get_cached_summary_html(),
+            threads[1].render_summary_html(save=False)
+        )
+        #the snippets are picked from the thread objects
+        cache.cache.clear()
+        self.assertEqual(
+            'Cached %s' % SearchState.get_empty().add_tag('tag1').full_url(),
+            threads[0].get_summary_html(search_state=SearchState.get_empty())
+        )
+        self.assertTrue('tag4' in threads[1].get_summary_html(search_state=SearchState.get_empty()))
+
 
 class ThreadRenderCacheUpdateTests(AskbotTestCase):
     def setUp(self):
@@ -613,6 +670,7 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
             HTTP_ACCEPT_LANGUAGE='en',
             HTTP_USER_AGENT='Mozilla Gecko'
         )
+        Thread.objects.flush_view_counts()
         thread = Thread.objects.all()[0]
         self.assertEqual(1, thread.view_count)
 
@@ -620,6 +678,37 @@ class ThreadRenderCacheUpdateTests(AskbotTestCase):
         html = self._html_for_question(thread._question_post())
         self.assertEqual(html, thread.get_cached_summary_html())
 
+    def test_buffered_view_count(self):
+        question = self.post_question()
+        thread = question.thread
+        backup = askbot_settings.VIEW_COUNT_FLUSH_INTERVAL
+        askbot_settings.update('VIEW_COUNT_FLUSH_INTERVAL', 60)
+        #the counters must not be culled from the full cache
+        cache.cache.clear()
+        #pretend that the views were just flushed
+        cache.cache.set('thread-views-flushed', True)
+
+        thread.increase_view_count()
+        thread.increase_view_count()
+        self.assertEqual(2, thread.view_count)
+        self.assertEqual(0, Thread.objects.get(id=thread.id).view_count)
+
+        thread.invalidate_cached_thread_content_fragment()
+        self.assertEqual(1, Thread.objects.flush_view_counts())
+        thread = Thread.objects.get(id=thread.id)
+        self.assertEqual(2, thread.view_count)
+        self.assertTrue(thread.summary_html_cached())
+        self.assertEqual(0, Thread.objects.flush_view_counts())
+
+        #"2 views" -> "3 views" is re-rendered, 1002 -> 1003 views is not
+        thread.invalidate_cached_thread_content_fragment()
+        Thread.objects.filter(id=thread.id).update(view_count=1002)
+        thread.increase_view_count()
+        Thread.objects.flush_view_counts()
+        self.assertEqual(1003, Thread.objects.get(id=thread.id).view_count)
+        self.assertFalse(thread.summary_html_cached())
+        askbot_settings.update('VIEW_COUNT_FLUSH_INTERVAL', backup)
+
     def test_question_upvote_downvote(self):
         question = self.post_question()
         question.points = 5
@@ -1,11 +1,13 @@
 from django.utils.translation import ugettext_lazy as _
 from askbot.models import ReplyAddress
+from askbot.models import get_reply_to_addresses_for_users
 from askbot.mail.lamson_handlers import PROCESS, VALIDATE_EMAIL, get_parts
 from askbot.mail import extract_user_signature
 from askbot import const
 
 
 from askbot.tests.utils import AskbotTestCase
+from askbot.tests.utils import with_settings
 from askbot.models import Post, PostRevision
 
 TEST_CONTENT = 'Test content'
@@ -142,6 +144,37 @@ class ReplyAddressModelTests(AskbotTestCase):
         self.assertEquals(post.post_type, "answer")
         self.assertEquals(post.text, TEST_LONG_CONTENT)
 
+    def test_create_many(self):
+        records = [
+            {'post': self.question, 'user': self.u2, 'reply_action': 'post_answer'},
+            {'post': self.question, 'user': self.u3, 'reply_action': 'post_comment'}
+        ]
+        result = ReplyAddress.objects.create_many(records)
+        self.assertEquals(len(set([item.address for item in result])), 2)
+        saved = ReplyAddress.objects.get(address = result[1].address)
+        self.assertEquals(saved.user, self.u3)
+        self.assertEquals(saved.reply_action, 'post_comment')
+        self.assertEquals(saved.allowed_from_email, self.u3.email)
+
+    @with_settings(REPLY_BY_EMAIL = True, MIN_REP_TO_POST_BY_EMAIL = 10)
+    def test_reply_to_addresses_for_users(self):
+        addresses = get_reply_to_addresses_for_users(
+                                        [self.u2, self.u3], self.question
+                                    )
+        self.assertEquals(ReplyAddress.objects.count(), 4)
+        for user in (self.u2, self.u3):
+            answer_address, comment_address = addresses[user.id]
+            answer_reply = ReplyAddress.objects.get(
+                                        address = answer_address[6:].split('@')[0]
+                                    )
+            self.assertEquals(answer_reply.user, user)
+            self.assertEquals(answer_reply.reply_action, 'post_answer')
+            comment_reply = ReplyAddress.objects.get(
+                                        address = comment_address[6:].split('@')[0]
+                                    )
+            self.assertEquals(comment_reply.reply_action, 'post_comment')
+
+
 class EmailSignatureDetectionTests(AskbotTestCase):
 
     def setUp(self):
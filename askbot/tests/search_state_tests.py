@@ -1,5 +1,14 @@
+import base64
+import datetime
+from django.utils import simplejson
 from askbot.tests.utils import AskbotTestCase
+from askbot.tests.utils import with_settings
 from askbot.search.state_manager import SearchState
+from askbot.search.state_manager import DummySearchState
+from askbot.search import keyset
+from askbot.search import listing_index
+from django.core import cache
+from askbot import models
 import askbot.conf
 from django.core import urlresolvers
 
@@ -290,4 +299,267 @@ class SearchStateTests(AskbotTestCase):
             ss.query_string()
         )
 
+    def test_cursor(self):
+        ss = self._ss().change_page(3, cursor='abc-_1')
+        self.assertEqual(
+            'scope:all/sort:activity-desc/page:3/cursor:abc-_1/',
+            ss.query_string()
+        )
+        #any state change drops the cursor
+        self.assertEqual(ss.add_tag('foo').cursor, None)
+        self.assertEqual(ss.change_sort('age-desc').cursor, None)
+        self.assertEqual(ss.change_page(1).cursor, None)
+
+    def test_get_tag_url(self):
+        states = (
+            self._ss(),
+            SearchState(
+                scope='unanswered', sort='age-asc', query='#tag1 some text',
+                tags='tag2,tag+3', author=5, page=4, user_logged_in=False
+            ),
+            self._ss(tags=u'\u043c\u0438\u0440').change_page(2, cursor='abc'),
+        )
+        for ss in states:
+            for tag in ('tag1', 'tag2', u'\u0442\u0435\u0433', 'c++'):
+                self.assertEqual(ss.get_tag_url(tag), ss.add_tag(tag).full_url())
+        self.assertEqual(DummySearchState().get_tag_url('tag'), '<<<tag>>>')
+
+
+class KeysetPaginationTests(AskbotTestCase):
+
+    def setUp(self):
+        self.create_user()
+        timestamp = datetime.datetime(2012, 1, 1)
+        for number in range(5):
+            #two questions per timestamp to test the tie-breaking
+            self.post_question(
+                title='question number %d' % number,
+                timestamp=timestamp + datetime.timedelta(days=number/2)
+            )
+
+    def _get_page(self, sort='age-desc', page=None, cursor=None):
+        ss = SearchState(
+            scope=None, sort=sort, query=None, tags=None,
+            author=None, page=page, user_logged_in=False, cursor=cursor
+        )
+        threads, meta_data = models.Thread.objects.run_advanced_search(
+                                        request_user=self.user,
+                                        search_state=ss
+                                    )
+        return keyset.KeysetPage(threads, ss, 2), threads
+
+    def test_cursor_roundtrip(self):
+        timestamp = datetime.datetime(2012, 1, 2, 3, 4, 5, 6)
+        cursor = keyset.encode_cursor('age-desc', 'next', timestamp, 7)
+        self.assertEqual(
+            keyset.decode_cursor(cursor, 'age-desc'),
+            ('next', timestamp, 7)
+        )
+        self.assertEqual(keyset.decode_cursor(cursor, 'age-asc'), None)
+        self.assertEqual(keyset.decode_cursor('junk', 'age-desc'), None)
+
+    def test_forged_cursor_is_ignored(self):
+        def forge(*data):
+            return base64.urlsafe_b64encode(simplejson.dumps(data))
+        timestamp = {'dt': '2012-01-02T03:04:05.000006'}
+        forged = (
+            forge('age-desc', 'next', [1, 2], 7),
+            forge('age-desc', 'next', {'x': 1}, 7),
+            forge('age-desc', 'next', '2012-01-02', 7),
+            forge('age-desc', 'next', 5, 7),
+            forge('age-desc', 'next', timestamp, [7]),
+            forge('votes-desc', 'next', 'many', 7),
+            forge('votes-desc', 'next', timestamp, 7),
+            forge('votes-desc', 'next', True, 7),
+            forge('age-desc', 'next', timestamp),
+        )
+        for cursor in forged:
+            sort = simplejson.loads(base64.urlsafe_b64decode(cursor))[0]
+            self.assertEqual(keyset.decode_cursor(cursor, sort), None)
+            page, threads = self._get_page(sort=sort, page=2, cursor=cursor)
+            self.assertEqual(page.number, 2)
+            self.assertEqual(
+                [thread.id for thread in page],
+                [thread.id for thread in threads[2:4]]
+            )
+        self.assertEqual(
+            keyset.decode_cursor(forge('votes-desc', 'next', 3, 7), 'votes-desc'),
+            ('next', 3, 7)
+        )
 
+    def test_walk_forward_and_back(self):
+        for sort in ('age-desc', 'age-asc', 'votes-desc'):
+            page, threads = self._get_page(sort=sort)
+            expected = [thread.id for thread in threads]
+            self.assertEqual(len(expected), 5)
+
+            seen = list()
+            pages = list()
+            while True:
+                pages.append(page)
+                seen.extend([thread.id for thread in page])
+                if not page.has_next():
+                    break
+                page, junk = self._get_page(
+                                    sort=sort,
+                                    page=page.next_page_number(),
+                                    cursor=page.next_cursor
+                                )
+            self.assertEqual(seen, expected)
+            self.assertEqual(len(pages), 3)
+
+            #walk back from the last page
+            page = pages[-1]
+            while page.has_previous():
+                number = page.previous_page_number()
+                page, junk = self._get_page(
+                                    sort=sort,
+                                    page=number,
+                                    cursor=page.previous_cursor
+                                )
+                self.assertEqual(
+                    [thread.id for thread in page],
+                    [thread.id for thread in pages[number - 1]]
+                )
+            self.assertEqual(page.number, 1)
+
+    def test_offset_page(self):
+        page, threads = self._get_page(page=2)
+        expected = [thread.id for thread in threads][2:4]
+        self.assertEqual([thread.id for thread in page], expected)
+        self.assertTrue(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_main_page_loads_with_cursor(self):
+        page, threads = self._get_page()
+        url = SearchState.get_empty().change_page(
+                                            2, cursor=page.next_cursor
+                                        ).full_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+
+class ListingIndexTests(AskbotTestCase):
+
+    def setUp(self):
+        cache.cache.clear()
+        self.create_user()
+        self.create_user('other')
+        self.question = self.post_question(tags='one two')
+
+    def _get_thread_ids(self, scope='all', sort='activity-desc', tag=None):
+        is_complete, items = listing_index.get_listing(scope, sort, '', tag)
+        self.assertTrue(is_complete)
+        return [item[1] for item in items]
+
+    def test_new_question_goes_on_top(self):
+        self.assertEqual(self._get_thread_ids(), [self.question.thread.id])
+        self.assertEqual(self._get_thread_ids(tag='one'), [self.question.thread.id])
+        question2 = self.post_question(tags='one')
+        #listing was updated in place, not rebuilt
+        self.assertEqual(
+            self._get_thread_ids(),
+            [question2.thread.id, self.question.thread.id]
+        )
+        self.assertEqual(
+            self._get_thread_ids(tag='one'),
+            [question2.thread.id, self.question.thread.id]
+        )
+
+    def test_answer_moves_question_out_of_unanswered(self):
+        self.assertEqual(
+            self._get_thread_ids(scope='unanswered', sort='answers-desc'),
+            [self.question.thread.id]
+        )
+        answer = self.post_answer(user=self.other, question=self.question)
+        self.user.accept_best_answer(answer)
+        self.assertEqual(
+            self._get_thread_ids(scope='unanswered', sort='answers-desc'),
+            []
+        )
+
+    def test_closed_question_leaves_unanswered_listing(self):
+        self.assertEqual(
+            self._get_thread_ids(scope='unanswered'),
+            [self.question.thread.id]
+        )
+        self.user.set_admin_status()
+        self.user.save()
+        self.user.close_question(question=self.question, reason=1)
+        self.assertEqual(self._get_thread_ids(scope='unanswered'), [])
+        self.assertEqual(self._get_thread_ids(), [self.question.thread.id])
+        self.user.reopen_question(question=self.question)
+        self.assertEqual(
+            self._get_thread_ids(scope='unanswered'),
+            [self.question.thread.id]
+        )
+
+    def test_deleted_question_leaves_listing(self):
+        self.assertEqual(self._get_thread_ids(), [self.question.thread.id])
+        self.user.delete_question(self.question)
+        self.assertEqual(self._get_thread_ids(), [])
+
+    def test_retag_moves_question_between_tag_listings(self):
+        self.assertEqual(self._get_thread_ids(tag='two'), [self.question.thread.id])
+        self.assertEqual(self._get_thread_ids(tag='three'), [])
+        self.user.retag_question(question=self.question, tags='one three')
+        self.assertEqual(self._get_thread_ids(tag='two'), [])
+        self.assertEqual(self._get_thread_ids(tag='three'), [self.question.thread.id])
+
+    def test_update_during_another_update_resets_listings(self):
+        self.assertEqual(self._get_thread_ids(), [self.question.thread.id])
+        version = listing_index.get_version()
+        #another process holds the lock
+        cache.cache.add(listing_index.LOCK_CACHE_KEY, True)
+        try:
+            question2 = self.post_question()
+        finally:
+            cache.cache.delete(listing_index.LOCK_CACHE_KEY)
+        self.assertNotEqual(listing_index.get_version(), version)
+        self.assertEqual(
+            self._get_thread_ids(),
+            [question2.thread.id, self.question.thread.id]
+        )
+
+    def test_listing_built_during_update_is_not_cached(self):
+        update_count = cache.cache.get(listing_index.UPDATE_COUNT_CACHE_KEY)
+        build_listing = listing_index.build_listing
+        def build_listing_with_update(*args, **kwargs):
+            listing = build_listing(*args, **kwargs)
+            self.question.thread.update_listing_index()
+            return listing
+        listing_index.build_listing = build_listing_with_update
+        try:
+            self._get_thread_ids()
+        finally:
+            listing_index.build_listing = build_listing
+        key = listing_index.get_cache_key('all', 'activity-desc', '')
+        self.assertEqual(cache.cache.get(key), None)
+
+    @with_settings(GROUPS_ENABLED=True)
+    def test_sharing_moves_question_in_and_out_of_listing(self):
+        thread = self.question.thread
+        self.assertEqual(self._get_thread_ids(), [thread.id])
+        group = self.create_group(group_name='private')
+        self.user.join_group(group)
+        thread.make_private(self.user, group_id=group.id)
+        self.assertEqual(self._get_thread_ids(), [])
+        thread.make_public(recursive=True)
+        self.assertEqual(self._get_thread_ids(), [thread.id])
+
+    def test_update_listing_keeps_order(self):
+        listing = (True, [[5, 1], [3, 2], [1, 3]])
+        is_complete, items = listing_index.update_listing(listing, 1, [2, 1], True)
+        self.assertEqual(items, [[3, 2], [2, 1], [1, 3]])
+        #past the end of incomplete listing the thread is dropped
+        listing = (False, [[1, 3], [3, 2]])
+        is_complete, items = listing_index.update_listing(listing, 1, [4, 1], False)
+        self.assertEqual(items, [[1, 3], [3, 2]])
+
+    def test_anonymous_main_page(self):
+        response = self.client.get(SearchState.get_empty().full_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [thread.id for thread in response.context['threads']],
+            [self.question.thread.id]
+        )
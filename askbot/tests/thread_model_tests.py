@@ -59,6 +59,34 @@ class ThreadModelTestsWithGroupsEnabled(AskbotTestCase):
         user = self.reload_object(self.user)
         self.assertEqual(user.new_response_count, 1)
 
+    def test_group_aware_cached_post_data(self):
+        question = self.post_question(self.user)
+        answer = self.post_answer(
+            user = self.admin,
+            question = question,
+            is_private = True
+        )
+        thread = question.thread
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+
+        #users seeing the same posts share the cached data
+        self.assertEqual(
+            thread.get_visibility_signature(user1),
+            thread.get_visibility_signature(user2)
+        )
+        self.assertNotEqual(
+            thread.get_visibility_signature(user1),
+            thread.get_visibility_signature(self.admin)
+        )
+        self.assertEqual(len(thread.get_cached_post_data(user=self.user)[1]), 0)
+        self.assertEqual(len(thread.get_cached_post_data(user=self.admin)[1]), 1)
+
+        #publishing the answer resets the cached data
+        self.admin.edit_answer(answer, is_private = False)
+        thread = self.reload_object(thread)
+        self.assertEqual(len(thread.get_cached_post_data(user=self.user)[1]), 1)
+
     def test_answer_to_private_question_is_not_globally_visible(self):
         question = self.post_question(user=self.admin, is_private=True)
         answer = self.post_answer(question=question, user=self.admin, is_private=False)
@@ -1,5 +1,6 @@
 """utility functions used by Askbot test cases
 """
+from django.conf import settings as django_settings
 from django.test import TestCase
 from functools import wraps
 from askbot import models
@@ -33,7 +34,17 @@ def with_settings(**settings_dict):
         return wrapped
 
     return decorator
-                
+
+def call_with_celery_workers(func, *args, **kwargs):
+    """calls the function with ``CELERY_ALWAYS_EAGER = False``,
+    so that the work deferred to the celery tasks is not done
+    right away"""
+    old_value = django_settings.CELERY_ALWAYS_EAGER
+    django_settings.CELERY_ALWAYS_EAGER = False
+    try:
+        return func(*args, **kwargs)
+    finally:
+        django_settings.CELERY_ALWAYS_EAGER = old_value
 
 
 def create_user(
@@ -3,6 +3,7 @@ from askbot.tests.utils import with_settings
 from askbot.utils.url_utils import urls_equal
 from askbot.utils.html import absolutize_urls
 from askbot.utils.html import replace_links_with_text
+from askbot.utils.html import sanitize_html
 from askbot.conf import settings as askbot_settings
 
 class UrlUtilsTests(TestCase):
@@ -103,3 +104,26 @@ class HTMLUtilsTests(TestCase):
             absolutize_urls(text),
             '<a href="http://example.com/upfiles/13487909784287052.png"><img src="http://example.com/upfiles/13487909942351405.png" style="max-width:500px;" alt="" /></a><img src="http://i2.cdn.turner.com/cnn/dam/assets/120927033530-ryder-cup-captains-wall-4-tease.jpg" alt="" width="160" height="90" border="0" />and some text<br />aouaosutoaehut'
         )
+
+    def test_sanitize_html_removes_unsafe_markup(self):
+        self.assertEqual(
+            sanitize_html('<script>alert(1)</script><a href="javascript:x()" onclick="x()">link</a>'),
+            '&lt;script&gt;alert(1)&lt;/script&gt;<a>link</a>'
+        )
+
+    def test_sanitize_html_balances_tags(self):
+        self.assertEqual(
+            sanitize_html('</div><p>one<p>two <b>bold <i>both</b> text'),
+            '<p>one</p><p>two <b>bold <i>both</i></b> text</p>'
+        )
+        self.assertEqual(
+            sanitize_html('<ul><li>one<li>two<br></ul>'),
+            '<ul><li>one</li><li>two<br></li></ul>'
+        )
+
+    def test_sanitize_html_keeps_preformatted_text(self):
+        self.assertEqual(
+            sanitize_html('<pre><code>\n  if a &lt; b:\n    pass\n</code></pre>'),
+            '<pre><code>\n  if a &lt; b:\n    pass\n</code></pre>'
+        )
+        self.assertEqual(sanitize_html('<pre>\ntext</pre>'), '<pre>text</pre>')
@@ -114,6 +114,19 @@ def diff_date(date, use_on_prefix = False):
             minutes
         ) % {'min':minutes}
 
+def humanize_counter(number):
+    if number == 0:
+        return _('no')
+    elif number >= 1000:
+        number = number/1000
+        s = '%.1f' % number
+        if s.endswith('.0'):
+            return s[:-2] + 'k'
+        else:
+            return s + 'k'
+    else:
+        return str(number)
+
 #todo: this function may need to be removed to simplify the paginator functionality
 LEADING_PAGE_RANGE_DISPLAYED = TRAILING_PAGE_RANGE_DISPLAYED = 5
 LEADING_PAGE_RANGE = TRAILING_PAGE_RANGE = 4
@@ -159,6 +172,8 @@ def setup_paginator(context):
             "in_trailing_range" : in_trailing_range,
             "pages_outside_leading_range": pages_outside_leading_range,
             "pages_outside_trailing_range": pages_outside_trailing_range,
+            "previous_cursor": context.get("previous_cursor"),
+            "next_cursor": context.get("next_cursor"),
         }
 
 def get_admin():
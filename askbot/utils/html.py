@@ -1,7 +1,7 @@
 """Utilities for working with HTML."""
 from bs4 import BeautifulSoup
-import html5lib
-from html5lib import sanitizer, serializer, tokenizer, treebuilders, treewalkers
+from html5lib import sanitizer, serializer, tokenizer
+from html5lib.constants import tokenTypes, voidElements
 import re
 import htmlentitydefs
 from urlparse import urlparse
@@ -96,13 +96,73 @@ def replace_links_with_text(html):
     return unicode(soup.find('body').renderContents(), 'utf-8')
             
 
+TOKEN_TYPE_NAMES = dict([(value, name) for name, value in tokenTypes.items()])
+
+BLOCK_ELEMENTS = ('address', 'blockquote', 'center', 'dir', 'div', 'dl',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'ol', 'p', 'pre', 'table', 'ul')
+
+#open elements that are implicitly closed by the start of the other ones
+IMPLIED_END_TAGS = {
+    'p': BLOCK_ELEMENTS,
+    'li': ('li',),
+    'dd': ('dd', 'dt'),
+    'dt': ('dd', 'dt'),
+    'td': ('td', 'th', 'tr'),
+    'th': ('td', 'th', 'tr'),
+    'tr': ('tr',),
+}
+
+def balance_tags(tokens):
+    """turns the tokens of the tokenizer into the tokens
+    accepted by the serializer and makes the elements
+    properly nested: closes the open elements at the end
+    and drops the end tags of the elements that are not open,
+    the doctypes and the parse errors
+    """
+    open_elements = list()
+    after_pre = False
+    for token in tokens:
+        token_type = TOKEN_TYPE_NAMES[token['type']]
+        token['type'] = token_type
+        if token_type in ('Characters', 'SpaceCharacters'):
+            if after_pre and token['data'].startswith('\n'):
+                #same as the html parser, drop the newline after <pre>
+                token['data'] = token['data'][1:]
+            after_pre = False
+            if token['data']:
+                yield token
+            continue
+
+        after_pre = False
+        if token_type in ('StartTag', 'EmptyTag'):
+            name = token['name']
+            while open_elements and \
+                name in IMPLIED_END_TAGS.get(open_elements[-1], ()):
+                yield {'type': 'EndTag', 'name': open_elements.pop(), 'data': []}
+            if name in voidElements:
+                token['type'] = 'EmptyTag'
+            else:
+                token['type'] = 'StartTag'
+                open_elements.append(name)
+                after_pre = (name == 'pre')
+            yield token
+        elif token_type == 'EndTag':
+            name = token['name']
+            if name in open_elements:
+                while True:
+                    open_name = open_elements.pop()
+                    yield {'type': 'EndTag', 'name': open_name, 'data': []}
+                    if open_name == name:
+                        break
+
+    while open_elements:
+        yield {'type': 'EndTag', 'name': open_elements.pop(), 'data': []}
+
 def sanitize_html(html):
-    """Sanitizes an HTML fragment."""
-    p = html5lib.HTMLParser(tokenizer=HTMLSanitizer,
-                            tree=treebuilders.getTreeBuilder("dom"))
-    dom_tree = p.parseFragment(html)
-    walker = treewalkers.getTreeWalker("dom")
-    stream = walker(dom_tree)
+    """Sanitizes an HTML fragment.
+    The tokens of the sanitizer are serialized directly,
+    without building the document tree."""
+    stream = balance_tags(HTMLSanitizer(html))
     s = serializer.HTMLSerializer(omit_optional_tags=False,
                                   quote_attr_values=True)
     output_generator = s.serialize(stream)
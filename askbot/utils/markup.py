@@ -2,17 +2,96 @@
 handling of markdown and additional syntax rules - 
 such as optional link patterns, video embedding and 
 Twitter-style @mentions"""
+from __future__ import with_statement
 
 import re
+import bisect
+import hashlib
 import logging
+import threading
+from collections import deque
+from django.conf import settings as django_settings
+from django.core import cache
 from askbot import const
 from askbot.conf import settings as askbot_settings
+from askbot.deps.livesettings import signals
+from askbot.utils.html import sanitize_html
 from markdown2 import Markdown
 #url taken from http://regexlib.com/REDetails.aspx?regexp_id=501 by Brian Bothwell
 URL_RE = re.compile("((?<!(href|.src|data)=['\"])((http|https|ftp)\://([a-zA-Z0-9\.\-]+(\:[a-zA-Z0-9\.&amp;%\$\-]+)*@)*((25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[1-9])\.(25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[1-9]|0)\.(25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[1-9]|0)\.(25[0-5]|2[0-4][0-9]|[0-1]{1}[0-9]{2}|[1-9]{1}[0-9]{1}|[0-9])|localhost|([a-zA-Z0-9\-]+\.)*[a-zA-Z0-9\-]+\.(com|edu|gov|int|mil|net|org|biz|arpa|info|name|pro|aero|coop|museum|[a-zA-Z]{2}))(\:[0-9]+)*(/($|[a-zA-Z0-9\.\,\?\'\\\+&amp;%\$#\=~_\-]+))*))")
 
-def get_parser():
-    """returns an instance of configured ``markdown2`` parser
+#settings that change the configuration of the parser
+PARSER_SETTINGS = (
+    'ENABLE_MATHJAX',
+    'MARKUP_CODE_FRIENDLY',
+    'ENABLE_VIDEO_EMBEDDING',
+    'ENABLE_AUTO_LINKING',
+    'AUTO_LINK_PATTERNS',
+    'AUTO_LINK_URLS',
+)
+
+class ParserPool(threading.local):
+    """keeps configured parser of the current thread
+    together with the values of the ``PARSER_SETTINGS``
+    it was made with, parsers are not shared between
+    the threads, because they keep state during the conversion
+    """
+    #incremented when settings change, so that
+    #parsers of all threads are made again
+    version = 0
+
+    def __init__(self):
+        self.key = None
+        self.parser = None
+        self.parser_version = None
+
+    def get(self, key):
+        """returns parser made for the ``key``
+        or ``None`` if there is none"""
+        if self.key == key and self.parser_version == ParserPool.version:
+            return self.parser
+        return None
+
+    def set(self, key, parser):
+        self.key = key
+        self.parser = parser
+        self.parser_version = ParserPool.version
+
+parser_pool = ParserPool()
+
+def clear_parser_pool(**kwargs):
+    """drops the cached parsers, called
+    when any of the livesettings change"""
+    ParserPool.version += 1
+
+signals.configuration_value_changed.connect(clear_parser_pool)
+
+def get_parser_settings_key():
+    """returns tuple of the values of ``PARSER_SETTINGS``,
+    read with one cache lookup when possible"""
+    values = askbot_settings.as_dict() or dict()
+    key = list()
+    for name in PARSER_SETTINGS:
+        if name in values:
+            key.append(values[name])
+        else:
+            key.append(getattr(askbot_settings, name))
+    return tuple(key)
+
+def get_parser(settings_key = None):
+    """returns configured ``markdown2`` parser,
+    the parser is made once per thread and reused
+    until the parser settings change
+    """
+    key = settings_key or get_parser_settings_key()
+    parser = parser_pool.get(key)
+    if parser is None:
+        parser = make_parser()
+        parser_pool.set(key, parser)
+    return parser
+
+def make_parser():
+    """returns a new instance of configured ``markdown2`` parser
     """
     extras = ['link-patterns', 'video']  
 
@@ -62,6 +141,104 @@ def get_parser():
             )
 
 
+class RenderCache(object):
+    """in-process cache of the rendered html with
+    the least recently used items evicted first,
+    when ``ASKBOT_SHARED_RENDER_CACHE`` is set, the missing
+    items are also looked up in the django cache,
+    so that all processes share the rendered html
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = dict()
+        #keys in the order of use, a key is appended on every use,
+        #so the earlier entries of the same key are stale
+        self.usage = deque()
+        #number of the entries of each key in the ``usage``
+        self.usage_counts = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.items.get(key)
+            if html is not None:
+                self.use(key)
+                return html
+        if getattr(django_settings, 'ASKBOT_SHARED_RENDER_CACHE', False):
+            html = cache.cache.get(key)
+            if html is not None:
+                self.add(key, html)
+        return html
+
+    def set(self, key, html):
+        self.add(key, html)
+        if getattr(django_settings, 'ASKBOT_SHARED_RENDER_CACHE', False):
+            cache.cache.set(key, html, const.LONG_TIME)
+
+    def add(self, key, html):
+        """adds item to the in-process cache only"""
+        with self.lock:
+            self.items[key] = html
+            self.use(key)
+            while len(self.items) > self.max_size:
+                old_key = self.usage.popleft()
+                count = self.usage_counts[old_key] - 1
+                if count:
+                    self.usage_counts[old_key] = count
+                else:
+                    #the last use of the key was the least recent one
+                    del self.usage_counts[old_key]
+                    del self.items[old_key]
+
+    def use(self, key):
+        """marks the item as the most recently used,
+        must be called with the lock held"""
+        self.usage.append(key)
+        self.usage_counts[key] = self.usage_counts.get(key, 0) + 1
+        if len(self.usage) > 4 * self.max_size:
+            #drop the stale entries, keeping the last use of each key
+            usage = list()
+            seen = set()
+            for used_key in reversed(self.usage):
+                if used_key not in seen:
+                    seen.add(used_key)
+                    usage.append(used_key)
+            usage.reverse()
+            self.usage = deque(usage)
+            self.usage_counts = dict.fromkeys(usage, 1)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.usage.clear()
+            self.usage_counts.clear()
+
+#number of the rendered texts kept by each process
+RENDER_CACHE_SIZE = 500
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+def get_render_cache_key(text, settings_key):
+    """returns key of the html rendered from ``text``
+    with the parser settings given as ``settings_key``"""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    digest = hashlib.sha1(repr(settings_key) + '\0' + text).hexdigest()
+    return 'markdown-html-' + digest
+
+def markdown_to_html(text):
+    """returns sanitized html rendered from the markdown ``text``,
+    the html is cached by the hash of the text and the
+    values of the parser settings"""
+    settings_key = get_parser_settings_key()
+    key = get_render_cache_key(text, settings_key)
+    html = render_cache.get(key)
+    if html is None:
+        html = sanitize_html(get_parser(settings_key).convert(text))
+        render_cache.set(key, html)
+    return html
+
+
 def format_mention_in_html(mentioned_user):
     """formats mention as url to the user profile"""
     url = mentioned_user.get_profile_url()
@@ -125,6 +302,80 @@ def extract_mentioned_name_seeds(text):
 
     return extra_name_seeds
 
+def get_mention_candidates(text, max_length):
+    """returns set of the lowercased words and phrases
+    of at most ``max_length`` characters that follow
+    the '@' characters and may be the mentioned usernames
+    """
+    termination_chars = const.TWITTER_STYLE_MENTION_TERMINATION_CHARS
+    lowered = text.lower()
+    text_length = len(lowered)
+    candidates = set()
+    pos = lowered.find('@')
+    while pos != -1:
+        start = pos + 1
+        if (pos == 0 or lowered[pos - 1] in termination_chars) \
+            and start < text_length and lowered[start] not in termination_chars:
+            last_end = min(start + max_length, text_length)
+            for end in range(start + 1, last_end + 1):
+                if end == text_length or lowered[end] in termination_chars:
+                    candidates.add(lowered[start:end])
+        pos = lowered.find('@', start)
+    return candidates
+
+def find_mentions(text, sorted_names):
+    """finds the @mentions of the users in one pass over the text,
+    ``sorted_names`` - sorted list of the lowercased usernames,
+    returns list of tuples (position of the @ character,
+    list of tuples (end of the mention, index of the name)),
+    the names that match at the same position are given longest first
+    """
+    termination_chars = const.TWITTER_STYLE_MENTION_TERMINATION_CHARS
+    lowered = text.lower()
+    text_length = len(lowered)
+    mentions = list()
+    pos = lowered.find('@')
+    while pos != -1:
+        start = pos + 1
+        if pos == 0 or lowered[pos - 1] in termination_chars:
+            #usernames may contain the termination characters,
+            #so the first word only narrows down the range of the names
+            seed_end = start
+            while seed_end < text_length \
+                and lowered[seed_end] not in termination_chars:
+                seed_end += 1
+            seed = lowered[start:seed_end]
+            matches = list()
+            if seed:
+                index = bisect.bisect_left(sorted_names, seed)
+                while index < len(sorted_names) \
+                    and sorted_names[index].startswith(seed):
+                    name = sorted_names[index]
+                    end = start + len(name)
+                    if lowered.startswith(name, start) and (end == text_length \
+                        or lowered[end] in termination_chars):
+                        matches.append((end, index))
+                    index += 1
+            if matches:
+                matches.sort(reverse = True)
+                mentions.append((pos, matches))
+        pos = lowered.find('@', start)
+    return mentions
+
+def replace_mentions(text, mentions):
+    """replaces the mentions in the text with the links
+    to the user profiles, ``mentions`` - list of tuples
+    (position of the @ character, end of the mention, user)
+    ordered by position"""
+    output = list()
+    last_end = 0
+    for pos, end, user in mentions:
+        output.append(text[last_end:pos])
+        output.append(format_mention_in_html(user))
+        last_end = end
+    output.append(text[last_end:])
+    return ''.join(output)
+
 def mentionize_text(text, anticipated_authors):
     """Returns a tuple of two items:
     * modified text where @mentions are
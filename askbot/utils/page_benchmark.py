@@ -0,0 +1,188 @@
+"""Query count and latency benchmark of the main pages.
+
+Expects the database filled by the command ``askbot_add_test_content``.
+Each page is requested by the anonymous and by the logged in visitor,
+with the groups enabled and disabled - first with the empty ("cold")
+cache, then again with the cache filled by the first request ("warm").
+
+The report is a dictionary keyed by strings like
+``questions/anonymous/groups-off``, the values are
+``{'cold': measurement, 'warm': measurement}``, each measurement has
+the response status, the number of queries, the total sql time
+and the wall time in seconds.
+
+The thresholds have the same keys and give the maximum number of
+queries in each phase - ``{'cold': 25, 'warm': 10}``.
+
+Used by the management command ``benchmark_page_loads``
+and by the test case :class:`askbot.tests.page_load_tests.PageQueryCountTests`.
+"""
+import os
+import time
+
+from django.core import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db import reset_queries
+from django.test.client import Client
+from django.utils import simplejson
+
+from askbot import models
+from askbot.conf import settings as askbot_settings
+from askbot.utils.slug import slugify
+
+PROFILE_TABS = ('stats', 'recent', 'reputation', 'favorites')
+PHASES = ('cold', 'warm')
+
+DEFAULT_THRESHOLDS_PATH = os.path.join(
+                                os.path.dirname(os.path.dirname(__file__)),
+                                'tests',
+                                'page_load_thresholds.json'
+                            )
+
+def get_pages():
+    """returns list of (page name, url, query data)"""
+    #the question with most answers and comments
+    thread = models.Thread.objects.order_by('-answer_count', 'id')[0]
+    question = thread._question_post()
+    author = question.author
+    profile_url = reverse(
+                    'user_profile',
+                    kwargs={'id': author.id, 'slug': slugify(author.username)}
+                )
+    pages = [
+        ('questions', reverse('questions'), {}),
+        ('question', question.get_absolute_url(), {}),
+    ]
+    for tab in PROFILE_TABS:
+        pages.append(('user-' + tab, profile_url, {'sort': tab}))
+    pages.append(('tags', reverse('tags'), {}))
+    pages.append(('badges', reverse('badges'), {}))
+    return pages
+
+def record_queries(func, *args, **kwargs):
+    """calls the function with the logging of sql queries
+    turned on, returns tuple of the result of the function
+    and the list of executed queries, each is a dictionary
+    with keys 'sql' and 'time'
+    """
+    connection.use_debug_cursor = True
+    reset_queries()
+    try:
+        result = func(*args, **kwargs)
+        return result, list(connection.queries)
+    finally:
+        connection.use_debug_cursor = None
+        reset_queries()
+
+def measure(client, url, data):
+    """returns dictionary with the response status,
+    number of queries, sql time and wall time of the request"""
+    start = time.time()
+    response, queries = record_queries(client.get, url, data, follow=True)
+    wall_time = time.time() - start
+    return {
+        'status': response.status_code,
+        'queries': len(queries),
+        'sql_time': sum([float(query['time']) for query in queries]),
+        'wall_time': wall_time
+    }
+
+def run_benchmark(user=None, page_names=None, groups_modes=(False, True)):
+    """returns the report, ``user`` - the logged in visitor,
+    by default the first user who is not an administrator,
+    ``page_names`` - names of the measured pages, by default all,
+    ``groups_modes`` - values of the ``GROUPS_ENABLED`` setting
+    with which the pages are measured"""
+    if user is None:
+        user = models.User.objects.filter(is_superuser=False).order_by('id')[0]
+    pages = get_pages()
+    if page_names is not None:
+        pages = [page for page in pages if page[0] in page_names]
+    #headers of a browser, so that the question views are counted
+    client = Client(
+                HTTP_ACCEPT_LANGUAGE='en',
+                HTTP_USER_AGENT='Mozilla/5.0 (X11; Linux x86_64; rv:20.0) Gecko/20100101 Firefox/20.0'
+            )
+    report = dict()
+    groups_enabled_backup = askbot_settings.GROUPS_ENABLED
+    try:
+        for groups_enabled in groups_modes:
+            askbot_settings.update('GROUPS_ENABLED', groups_enabled)
+            groups_key = groups_enabled and 'groups-on' or 'groups-off'
+            for visitor in ('anonymous', 'logged-in'):
+                client.logout()
+                if visitor == 'logged-in':
+                    client.login(method='force', user_id=user.id)
+                for name, url, data in pages:
+                    cache.cache.clear()
+                    result = dict()
+                    for phase in PHASES:
+                        result[phase] = measure(client, url, data)
+                    report['%s/%s/%s' % (name, visitor, groups_key)] = result
+    finally:
+        askbot_settings.update('GROUPS_ENABLED', groups_enabled_backup)
+    return report
+
+def check_thresholds(report, thresholds):
+    """returns list of messages about the pages that
+    failed to load or use more queries than allowed,
+    pages not mentioned in the thresholds are not checked
+    for the number of queries"""
+    messages = list()
+    for key in sorted(report.keys()):
+        for phase in PHASES:
+            status = report[key][phase]['status']
+            if status != 200:
+                messages.append(
+                    '%s (%s cache): response status %d' % (key, phase, status)
+                )
+        if key not in thresholds:
+            continue
+        for phase in PHASES:
+            limit = thresholds[key].get(phase)
+            queries = report[key][phase]['queries']
+            if limit is not None and queries > limit:
+                messages.append(
+                    '%s (%s cache): %d queries, at most %d expected' \
+                    % (key, phase, queries, limit)
+                )
+    return messages
+
+def make_thresholds(report, margin=0):
+    """returns thresholds allowing ``margin``
+    more queries than in the report"""
+    thresholds = dict()
+    for key, result in report.items():
+        thresholds[key] = dict(
+            [(phase, result[phase]['queries'] + margin) for phase in PHASES]
+        )
+    return thresholds
+
+def load_json(path):
+    json_file = open(path)
+    try:
+        return simplejson.load(json_file)
+    finally:
+        json_file.close()
+
+def save_json(data, path):
+    json_file = open(path, 'w')
+    try:
+        simplejson.dump(data, json_file, indent=2, sort_keys=True)
+    finally:
+        json_file.close()
+
+def format_report(report):
+    """returns report as a text table"""
+    lines = [
+        '%-44s %8s %8s %9s %9s' % ('page', 'queries', 'warm', 'sql ms', 'wall ms')
+    ]
+    for key in sorted(report.keys()):
+        cold = report[key]['cold']
+        warm = report[key]['warm']
+        lines.append('%-44s %8d %8d %9.1f %9.1f' % (
+                        key, cold['queries'], warm['queries'],
+                        cold['sql_time'] * 1000, cold['wall_time'] * 1000
+                    ))
+    return '\n'.join(lines)
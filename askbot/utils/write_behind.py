@@ -0,0 +1,149 @@
+"""Write-behind buffer of per-object values kept in the cache.
+
+Frequent updates (question views, user visits) are accumulated
+in the cache and saved to the database in batches, at most once
+in a given interval.
+
+The values belong to a "generation". Taking the values for saving
+starts a new generation (atomically, with the cache ``incr``),
+so that new updates are kept separately and concurrent flushes
+can't save the same values twice. Ids of the objects updated within
+the generation are stored under the numbered slot keys, so the list
+of the updated objects is built without the read-modify-write
+of a shared cache entry.
+
+Updates that reach a generation at the same moment as it is closed
+are taken together with the next generation. The buffer is still
+approximate - updates evicted from the cache are lost.
+"""
+from django.core import cache
+from django.core.cache.backends.dummy import DummyCache
+
+from askbot import const
+
+def can_buffer():
+    """dummy cache does not keep the values"""
+    return not isinstance(cache.cache, DummyCache)
+
+def incr(key, delta=1):
+    """increments value in the cache, creates it if missing"""
+    cache.cache.add(key, 0, const.LONG_TIME)
+    try:
+        return cache.cache.incr(key, delta)
+    except ValueError:
+        #the key was evicted right after being added
+        cache.cache.set(key, delta, const.LONG_TIME)
+        return delta
+
+
+class WriteBehindBuffer(object):
+    """values keyed by the object id (a number or a string
+    valid in the cache key), all cache keys start with the ``prefix``"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.generation_key = prefix + '-generation'
+        self.flush_lock_key = prefix + '-flushed'
+
+    def get_value_key(self, generation, object_id):
+        return '%s-%d-%s' % (self.prefix, generation, object_id)
+
+    def get_slot_count_key(self, generation):
+        return '%s-slots-%d' % (self.prefix, generation)
+
+    def get_slot_key(self, generation, slot):
+        return '%s-slot-%d-%d' % (self.prefix, generation, slot)
+
+    def get_generation(self):
+        generation = cache.cache.get(self.generation_key)
+        if generation is None:
+            cache.cache.add(self.generation_key, 0, const.LONG_TIME)
+            generation = cache.cache.get(self.generation_key) or 0
+        return generation
+
+    def register(self, generation, object_id):
+        """adds object to the list of updated within the generation"""
+        slot = incr(self.get_slot_count_key(generation))
+        cache.cache.set(
+            self.get_slot_key(generation, slot), object_id, const.LONG_TIME
+        )
+
+    def incr(self, object_id, delta=1):
+        """adds ``delta`` to the value,
+        returns sum of the values not yet taken"""
+        generation = self.get_generation()
+        value = incr(self.get_value_key(generation, object_id), delta)
+        if value == delta:
+            self.register(generation, object_id)
+        return value
+
+    def set(self, object_id, value):
+        """replaces the value"""
+        generation = self.get_generation()
+        key = self.get_value_key(generation, object_id)
+        if cache.cache.add(key, value, const.LONG_TIME):
+            self.register(generation, object_id)
+        else:
+            cache.cache.set(key, value, const.LONG_TIME)
+
+    def add(self, object_id, value):
+        """sets the value unless it is already set,
+        returns True if the value was added"""
+        generation = self.get_generation()
+        key = self.get_value_key(generation, object_id)
+        if cache.cache.add(key, value, const.LONG_TIME):
+            self.register(generation, object_id)
+            return True
+        return False
+
+    def is_flush_due(self, interval):
+        """True at most once in ``interval`` seconds"""
+        return cache.cache.add(self.flush_lock_key, True, interval)
+
+    def reset_flush_due(self):
+        """makes the next :meth:`is_flush_due` return True"""
+        cache.cache.delete(self.flush_lock_key)
+
+    def is_empty(self):
+        """True if nothing was added to the current generation"""
+        slot_count_key = self.get_slot_count_key(self.get_generation())
+        return not cache.cache.get(slot_count_key)
+
+    def take(self, merge=None):
+        """closes the current generation and returns
+        dictionary of object id -> value set within it,
+        together with the values that reached the previous
+        generation after it was taken. Values of the same object
+        from both generations are combined with ``merge(old, new)``,
+        by default the newer value is kept"""
+        generation = incr(self.generation_key) - 1
+        values = dict()
+        if generation > 0:
+            values = self.take_generation(generation - 1)
+        for object_id, value in self.take_generation(generation).items():
+            if merge and object_id in values:
+                value = merge(values[object_id], value)
+            values[object_id] = value
+        return values
+
+    def take_generation(self, generation):
+        """returns and removes values of the generation"""
+        slot_count_key = self.get_slot_count_key(generation)
+        slot_count = cache.cache.get(slot_count_key) or 0
+        if slot_count == 0:
+            return {}
+
+        slot_keys = [
+            self.get_slot_key(generation, slot)
+            for slot in range(1, slot_count + 1)
+        ]
+        object_ids = set(cache.cache.get_many(slot_keys).values())
+        value_keys = dict(
+            [(self.get_value_key(generation, object_id), object_id)
+                for object_id in object_ids]
+        )
+        values = cache.cache.get_many(value_keys.keys())
+        cache.cache.delete_many(slot_keys + value_keys.keys() + [slot_count_key])
+        return dict(
+            [(value_keys[key], value) for key, value in values.items()]
+        )
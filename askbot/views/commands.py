@@ -170,8 +170,8 @@ def process_vote(user = None, vote_direction = None, post = None):
     response_data = {}
     if vote != None:
         user.assert_can_revoke_old_vote(vote)
-        score_delta = vote.cancel()
-        response_data['count'] = post.points+ score_delta
+        vote.cancel()
+        response_data['count'] = vote.voted_post.points
         response_data['status'] = 1 #this means "cancel"
 
     else:
@@ -291,13 +291,15 @@ def vote(request, id):
             if vote_type in ('2','6'):
                 vote_direction = 'down'
 
+            #post, its author and the old vote are loaded with one query
+            posts = models.Post.objects.get_for_voting(request.user)
             if vote_type in ('5', '6'):
                 #todo: fix this weirdness - why postId here
                 #and not with question?
                 id = request.POST.get('postId')
-                post = get_object_or_404(models.Post, post_type='answer', id=id)
+                post = get_object_or_404(posts, post_type='answer', id=id)
             else:
-                post = get_object_or_404(models.Post, post_type='question', id=id)
+                post = get_object_or_404(posts, post_type='question', id=id)
             #
             ######################
 
@@ -308,7 +310,9 @@ def vote(request, id):
                                     )
 
             ####################################################################
-            if vote_type in ('1', '2'): # up/down-vote question
+            #new votes on questions regenerate the summary html in
+            #User.upvote/downvote, here - only the vote cancelations
+            if vote_type in ('1', '2') and response_data['status'] == 1:
                 post.thread.update_summary_html() # regenerate question/thread summary html
             ####################################################################
 
@@ -413,10 +417,11 @@ def vote(request, id):
             response_data['success'] = 0
             response_data['message'] = u'Request mode is not supported. Please try again.'
 
-        if vote_type not in (1, 2, 4, 5, 6, 11, 12):
-            #favorite or subscribe/unsubscribe
-            #upvote or downvote question or answer - those
-            #are handled within user.upvote and user.downvote
+        if vote_type in ('1', '2', '5', '6'):
+            #upvote or downvote question or answer -
+            #the post is loaded already
+            post.thread.invalidate_cached_data()
+        else:
             post = models.Post.objects.get(id = id)
             post.thread.invalidate_cached_data()
 
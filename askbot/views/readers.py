@@ -8,6 +8,7 @@ allow adding new comments via Ajax form post.
 """
 import datetime
 import logging
+import math
 import urllib
 import operator
 from django.shortcuts import get_object_or_404
@@ -41,6 +42,8 @@ from askbot.utils import functions
 from askbot.utils.html import sanitize_html
 from askbot.utils.decorators import anonymous_forbidden, ajax_only, get_only
 from askbot.search.state_manager import SearchState, DummySearchState
+from askbot.search import keyset
+from askbot.search import listing_index
 from askbot.templatetags import extra_tags
 from askbot.conf import settings as askbot_settings
 from askbot.views import context
@@ -89,15 +92,32 @@ def questions(request, **kwargs):
     if meta_data['non_existing_tags']:
         search_state = search_state.remove_tags(meta_data['non_existing_tags'])
 
-    paginator = Paginator(qs, page_size)
-    if paginator.num_pages < search_state.page:
-        search_state.page = 1
-    page = paginator.page(search_state.page)
-    page.object_list = list(page.object_list) # evaluate the queryset
+    #common listings for the anonymous visitors are served
+    #from the precomputed index, see askbot.search.listing_index
+    page = None
+    if listing_index.can_serve(request.user, search_state):
+        page = listing_index.get_page(search_state, page_size)
 
-    # INFO: Because for the time being we need question posts and thread authors
-    #       down the pipeline, we have to precache them in thread objects
-    models.Thread.objects.precache_view_data_hack(threads=page.object_list)
+    if page is not None and page.count is not None:
+        questions_count = page.count
+    else:
+        #the count is only needed for the paginator and the question counter,
+        #the page itself is fetched by the keyset, see askbot.search.keyset
+        questions_count = keyset.get_cached_count(qs)
+    page_count = max(1, int(math.ceil(float(questions_count) / page_size)))
+    if page_count < search_state.page and not search_state.cursor:
+        search_state = search_state.change_page(1)
+        page = None
+    if page is None:
+        page = keyset.KeysetPage(qs, search_state, page_size)
+    if page.number != search_state.page:
+        search_state = search_state.change_page(page.number)
+
+    #summary snippets are loaded with one cache request, the missing ones
+    #are rendered with question posts and thread authors fetched in bulk
+    models.Thread.objects.prefetch_summary_html(
+                                    page.object_list, visitor=request.user
+                                )
 
     related_tags = Tag.objects.get_related_to_search(
                         threads=page.object_list,
@@ -114,14 +134,16 @@ def questions(request, **kwargs):
                         )
 
     paginator_context = {
-        'is_paginated' : (paginator.count > page_size),
+        'is_paginated' : (questions_count > page_size),
 
-        'pages': paginator.num_pages,
+        'pages': page_count,
         'page': search_state.page,
         'has_previous': page.has_previous(),
         'has_next': page.has_next(),
         'previous': page.previous_page_number(),
         'next': page.next_page_number(),
+        'previous_cursor': page.previous_cursor,
+        'next_cursor': page.next_cursor,
 
         'base_url' : search_state.query_string(),
         'page_size' : page_size,
@@ -146,7 +168,7 @@ def questions(request, **kwargs):
     reset_method_count = len(filter(None, [search_state.query, search_state.tags, meta_data.get('author_name', None)]))
 
     if request.is_ajax():
-        q_count = paginator.count
+        q_count = questions_count
 
         question_counter = ungettext('%(q_num)s question', '%(q_num)s questions', q_count)
         question_counter = question_counter % {'q_num': humanize.intcomma(q_count),}
@@ -217,7 +239,7 @@ def questions(request, **kwargs):
             'page_size': page_size,
             'query': search_state.query,
             'threads' : page,
-            'questions_count' : paginator.count,
+            'questions_count' : questions_count,
             'reset_method_count': reset_method_count,
             'scope': search_state.scope,
             'show_sort_by_relevance': conf.should_show_sort_by_relevance(),
@@ -614,14 +636,16 @@ def revisions(request, id, post_type = None):
     post = get_object_or_404(models.Post, post_type=post_type, id=id)
     revisions = list(models.PostRevision.objects.filter(post=post))
     revisions.reverse()
+    #each revision is rendered once, though used in two diffs
+    revision_html = [sanitize_html(revision.html) for revision in revisions]
     for i, revision in enumerate(revisions):
         if i == 0:
-            revision.diff = sanitize_html(revisions[i].html)
+            revision.diff = revision_html[i]
             revision.summary = _('initial version')
         else:
             revision.diff = htmldiff(
-                sanitize_html(revisions[i-1].html),
-                sanitize_html(revision.html)
+                revision_html[i-1],
+                revision_html[i]
             )
 
     data = {
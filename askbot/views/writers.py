@@ -5,6 +5,7 @@
 This module contains views that allow adding, editing, and deleting main textual content.
 """
 import datetime
+import hashlib
 import logging
 import os
 import os.path
@@ -18,7 +19,10 @@ from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, Http404
+from django.http import HttpResponseNotModified
 from django.utils import simplejson
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from django.utils.html import strip_tags, escape
 from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_lazy
@@ -591,24 +595,15 @@ def __generate_comments_json(obj, user):#non-view generates json data for the po
     """
     models.Post.objects.precache_comments(for_posts=[obj], visitor=user)
     comments = obj._cached_comments
+    if user.is_authenticated():
+        permissions = user.get_comment_permissions(comments)
+    else:
+        permissions = dict([(comment.id, (False, False)) for comment in comments])
 
     # {"Id":6,"PostId":38589,"CreationDate":"an hour ago","Text":"hello there!","UserDisplayName":"Jarrod Dixon","UserUrl":"/users/3/jarrod-dixon","DeleteUrl":null}
     json_comments = []
     for comment in comments:
-
-        if user and user.is_authenticated():
-            try:
-                user.assert_can_delete_comment(comment)
-                #/posts/392845/comments/219852/delete
-                #todo translate this url
-                is_deletable = True
-            except exceptions.PermissionDenied:
-                is_deletable = False
-            is_editable = template_filters.can_edit_comment(comment.author, comment)
-        else:
-            is_deletable = False
-            is_editable = False
-
+        is_deletable, is_editable = permissions[comment.id]
 
         comment_owner = comment.author
         tz = ' ' + template_filters.TIMEZONE_STR
@@ -623,13 +618,27 @@ def __generate_comments_json(obj, user):#non-view generates json data for the po
             'is_editable': is_editable,
             'points': comment.points,
             'score': comment.points, #to support js
-            'upvoted_by_user': getattr(comment, 'upvoted_by_user', False)
+            'upvoted_by_user': bool(getattr(comment, 'upvoted_by_user', False))
         }
         json_comments.append(comment_data)
 
     data = simplejson.dumps(json_comments)
     return HttpResponse(data, mimetype="application/json")
 
+def __make_response_conditional(request, response):
+    """adds ETag to the response with the hash of the content,
+    and replaces it with the empty "304 Not Modified" response
+    when the client already has the same content
+
+    the response is private, because it depends on the visitor
+    """
+    content_hash = hashlib.md5(response.content).hexdigest()
+    if content_hash in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    response['ETag'] = quote_etag(content_hash)
+    patch_cache_control(response, private=True, must_revalidate=True, max_age=0)
+    return response
+
 @csrf.csrf_exempt
 @decorators.check_spam('comment')
 def post_comments(request):#generic ajax handler to load comments to an object
@@ -646,6 +655,7 @@ def post_comments(request):#generic ajax handler to load comments to an object
 
     if request.method == "GET":
         response = __generate_comments_json(obj, user)
+        response = __make_response_conditional(request, response)
     elif request.method == "POST":
         try:
             if user.is_anonymous():